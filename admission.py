@@ -0,0 +1,252 @@
+"""Admission control: keep overload from spreading across routes.
+
+Every route shares the same workers and database pool, so a spike of
+homepage loads or bcrypt-heavy logins would otherwise leave nothing for
+cheap pages. Requests are sorted into classes (ROUTE_CLASSES) and each
+class has a `Gate`: at most `limit` of its requests run at once, and the
+rest queue for a slot for up to `deadline` seconds.
+
+Load is shed early rather than after the wait. A Gate keeps a moving
+average of how long its requests take. If a new request would have to
+wait longer than the deadline, or the queue is already `max_queue` long,
+it is turned away at once with a 503 and a Retry-After. That happens
+before Flask sees the request, so a shed request never touches the
+session or the database. Endpoints in DEGRADABLE are not queued at all:
+if their gate has no free slot they run in degraded mode
+(``degraded()``), which the homepage answers with the last timeline it
+showed the user and no counters. Degraded requests are cheap but not free,
+so they go through a 'degraded' gate of their own, and are shed like any
+other once that is full too.
+
+`TokenBuckets` limits how often each user may write (likes, follows,
+warbles). The buckets live in memory, in a bounded LRU. A worker's
+limits are its own, so with N workers a user gets up to N times the
+rate.
+"""
+
+import math
+import time
+from collections import OrderedDict
+from threading import Lock, Semaphore
+
+from flask import request
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import ClosingIterator
+
+# Endpoints not listed are 'default'; None is never gated.
+ROUTE_CLASSES = {
+    'homepage': 'feed',
+    'api_timeline': 'feed',
+    'login': 'auth',
+    'signup': 'auth',
+    'static': None,
+    'api_stream': None,
+}
+
+# Endpoints that run degraded instead of queuing.
+DEGRADABLE = {'homepage'}
+
+# Weight of the latest request in a Gate's average service time.
+SMOOTHING = 0.1
+
+DEGRADED_KEY = 'warbler.degraded'
+RELEASE_KEY = 'warbler.admission.release'
+
+
+class Gate:
+    """At most `limit` requests at once; others queue up to `deadline` secs."""
+
+    def __init__(self, name, limit, deadline, max_queue=None):
+        self.name = name
+        self.limit = limit
+        self.deadline = deadline
+        self.max_queue = limit * 4 if max_queue is None else max_queue
+        self.service_time = 0.0
+        self.waiting = 0
+        self.shed = 0
+        self._slots = Semaphore(limit)
+        self._lock = Lock()
+
+    def expected_wait(self, position=None):
+        """Roughly how long the `position`th in the queue waits for a slot."""
+
+        position = self.waiting + 1 if position is None else position
+        return position * self.service_time / self.limit
+
+    def try_admit(self):
+        """Take a slot if one is free right now."""
+
+        return self._slots.acquire(blocking=False)
+
+    def admit(self):
+        """Take a slot, queuing for one if it's worth it. False if shed."""
+
+        if self.try_admit():
+            return True
+        with self._lock:
+            if (self.waiting >= self.max_queue
+                    or self.expected_wait() > self.deadline):
+                self.shed += 1
+                return False
+            self.waiting += 1
+        try:
+            admitted = self._slots.acquire(timeout=self.deadline)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        if not admitted:
+            with self._lock:
+                self.shed += 1
+        return admitted
+
+    def release(self, elapsed):
+        """Give back a slot held for `elapsed` secs."""
+
+        with self._lock:
+            self.service_time += SMOOTHING * (elapsed - self.service_time)
+        self._slots.release()
+
+    def retry_after(self):
+        """Whole seconds to suggest waiting before trying again."""
+
+        return max(1, math.ceil(self.expected_wait()))
+
+
+def make_gates(config):
+    """{class: Gate} sized by the app's config."""
+
+    deadline = config['QUEUE_DEADLINE']
+    return {
+        'feed': Gate('feed', config['FEED_CONCURRENCY'], deadline),
+        'auth': Gate('auth', config['AUTH_CONCURRENCY'], deadline),
+        'default': Gate('default', config['DEFAULT_CONCURRENCY'], deadline),
+        'degraded': Gate('degraded', config['DEGRADED_CONCURRENCY'], deadline),
+    }
+
+
+def hold_until_sent():
+    """Keep the current request's slot until its body has been sent, rather
+    than giving it back at teardown (for streamed pages)."""
+
+    request.environ.pop(RELEASE_KEY, None)
+
+
+def degraded():
+    """Is the current request running in degraded mode?"""
+
+    return bool(request.environ.get(DEGRADED_KEY))
+
+
+class Admission:
+    """WSGI middleware running each of `app`'s requests through its
+    class's Gate.
+
+    A slot is given back when the request is torn down, or, after
+    ``hold_until_sent``, when the server closes the body.
+    """
+
+    def __init__(self, app, gates):
+        self.wsgi_app = app.wsgi_app
+        self.url_map = app.url_map
+        self.gates = gates
+        app.wsgi_app = self
+        app.teardown_request(self._teardown)
+
+    @staticmethod
+    def _teardown(exc):
+        release = request.environ.pop(RELEASE_KEY, None)
+        if release:
+            release()
+
+    @staticmethod
+    def _releaser(gate):
+        """Give back `gate`'s slot on the first call only."""
+
+        start = time.monotonic()
+        pending = [True]
+
+        def release():
+            if pending and pending.pop():
+                gate.release(time.monotonic() - start)
+
+        return release
+
+    def _endpoint(self, environ):
+        try:
+            endpoint, _ = self.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            # 404s, 405s and redirects are cheap; let Flask answer them.
+            return None
+        return endpoint
+
+    def __call__(self, environ, start_response):
+        endpoint = self._endpoint(environ)
+        gate = self.gates.get(ROUTE_CLASSES.get(endpoint, 'default')) if endpoint else None
+        if gate is None:
+            return self.wsgi_app(environ, start_response)
+
+        if endpoint not in DEGRADABLE:
+            admitted = gate.admit()
+        elif gate.try_admit():
+            admitted = True
+        else:
+            # Run degraded, within a gate of its own.
+            environ[DEGRADED_KEY] = True
+            gate = self.gates['degraded']
+            admitted = gate.admit()
+        if not admitted:
+            return self._shed(gate, environ, start_response)
+
+        release = environ[RELEASE_KEY] = self._releaser(gate)
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except BaseException:
+            release()
+            raise
+        return ClosingIterator(body, release)
+
+    @staticmethod
+    def _shed(gate, environ, start_response):
+        headers = [('Retry-After', str(gate.retry_after()))]
+        if environ.get('PATH_INFO', '').startswith('/api/'):
+            body = b'{"error":"Too busy, try again shortly."}'
+            headers.append(('Content-Type', 'application/json'))
+        else:
+            body = b"Warbler is very busy right now. Please try again in a moment."
+            headers.append(('Content-Type', 'text/plain; charset=utf-8'))
+        headers.append(('Content-Length', str(len(body))))
+        start_response('503 Service Unavailable', headers)
+        return [body]
+
+
+class TokenBuckets:
+    """Per-key rate limits: `rate` actions per sec, in bursts of `burst`.
+
+    Keeps the `maxsize` most recently used buckets. Dropping the least
+    recently used one at worst forgives what its key had spent.
+    """
+
+    def __init__(self, rate, burst, maxsize=100000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def take(self, key, now=None):
+        """Spend a token of `key`'s bucket. Returns 0 if there was one,
+        else the secs until there will be."""
+
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, then = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - then) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
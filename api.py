@@ -0,0 +1,234 @@
+"""Helpers for the JSON API.
+
+Pages are read as projected columns (never ORM objects) and serialized
+straight from the result rows. Output is compact JSON: no whitespace, Unix
+timestamps, and each author listed once per page in ``users`` rather than
+repeated on every message.
+
+Pagination is by keyset cursor: ``next`` is an opaque token holding the sort
+key of the last item, and passing it back as ``?cursor=`` returns the items
+after it. Unlike OFFSET, fetching page 1000 costs the same as page 1.
+"""
+
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from flask import Response, request
+from sqlalchemy import select, tuple_
+
+from media import media_url
+from models import Follows, Message, User, db
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.user_id,
+    User.username,
+    User.image_url,
+)
+
+USER_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.bio,
+)
+
+
+# A row shaped like MESSAGE_COLUMNS, for messages not read from the table.
+MessageRow = namedtuple('MessageRow', 'id text timestamp user_id username image_url')
+
+
+class BadCursor(ValueError):
+    """The ?cursor= parameter couldn't be decoded."""
+
+
+def to_json(payload, status=200):
+    """A compact JSON response."""
+
+    body = json.dumps(payload, separators=(',', ':'))
+    return Response(body, status=status, mimetype='application/json')
+
+
+def error(message, status):
+    return to_json({'error': message}, status)
+
+
+def unix_time(timestamp):
+    return int(timestamp.replace(tzinfo=timezone.utc).timestamp())
+
+
+def encode_cursor(*key):
+    raw = json.dumps(key, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, *types):
+    """The key in `cursor`, which must be a list of values of `types`.
+    Raises BadCursor for anything else, tampered cursors included."""
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise BadCursor(cursor)
+    # (bool is an int to isinstance, but never a valid key.)
+    if (not isinstance(key, list) or len(key) != len(types)
+            or not all(isinstance(value, kind) and not isinstance(value, bool)
+                       for value, kind in zip(key, types))):
+        raise BadCursor(cursor)
+    return key
+
+
+def page_limit():
+    """The ?limit= parameter, clamped to 1..MAX_LIMIT."""
+
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def serialize_messages(rows):
+    """{'messages': [...], 'users': {id: {...}}} from MESSAGE_COLUMNS rows."""
+
+    messages = []
+    users = {}
+    for row in rows:
+        messages.append({
+            'id': row.id,
+            'text': row.text,
+            'ts': unix_time(row.timestamp),
+            'user_id': row.user_id,
+        })
+        if row.user_id not in users:
+            users[row.user_id] = {
+                'username': row.username,
+                'image_url': media_url(row.image_url, 'timeline'),
+            }
+    return {'messages': messages, 'users': users}
+
+
+def message_cursor(row):
+    """The cursor just past message `row`."""
+
+    # Page on the exact timestamp, not the whole seconds sent in 'ts', so
+    # rows sharing a second aren't skipped.
+    return encode_cursor(row.timestamp.isoformat(), row.id)
+
+
+def timestamp_key(cursor):
+    """The (timestamp, id) key held by a `message_cursor`-style cursor."""
+
+    timestamp, message_id = decode_cursor(cursor, str, int)
+    try:
+        return datetime.fromisoformat(timestamp), message_id
+    except ValueError:
+        raise BadCursor(cursor)
+
+
+def message_page(*where, cursor=None, after=None, limit=DEFAULT_LIMIT, archived=None):
+    """Newest-first page of visible messages matching `where`.
+
+    Returns (rows, next cursor or None). With `after` (a cursor from an
+    earlier page) it instead returns the messages *newer* than that,
+    oldest-first, and the next cursor is where to poll from next time.
+
+    `archived(before, limit)`, if given, returns MessageRows older than
+    the (timestamp, id) key `before` from the archive; pages that run
+    out of table rows continue with those.
+    """
+
+    stmt = (select(*MESSAGE_COLUMNS)
+            .join(User, User.id == Message.user_id)
+            .where(Message.deleted_at.is_(None),
+                   User.deleted_at.is_(None),
+                   *where)
+            .limit(limit + 1))
+    key = tuple_(Message.timestamp, Message.id)
+
+    if after:
+        stmt = (stmt
+                .where(key > timestamp_key(after))
+                .order_by(Message.timestamp, Message.id))
+        rows = db.session.execute(stmt).all()[:limit]
+        return rows, message_cursor(rows[-1]) if rows else after
+
+    stmt = stmt.order_by(Message.timestamp.desc(), Message.id.desc())
+    if cursor:
+        stmt = stmt.where(key < timestamp_key(cursor))
+
+    rows = db.session.execute(stmt).all()
+    if archived and len(rows) <= limit:
+        older = archived(timestamp_key(cursor) if cursor else None, limit + 1 - len(rows))
+        rows = sorted(rows + older, key=lambda row: (row.timestamp, row.id), reverse=True)
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, message_cursor(rows[-1])
+
+
+def shard_message_page(router, user_ids, cursor=None, after=None, limit=DEFAULT_LIMIT):
+    """Like message_page, for the messages of `user_ids` read from the
+    shards through `router` (see sharding.py)."""
+
+    if after:
+        page = router.timeline(user_ids, limit, after=timestamp_key(after))
+        more = False
+    else:
+        page = router.timeline(user_ids, limit + 1,
+                               before=timestamp_key(cursor) if cursor else None)
+        more = len(page) > limit
+        page = page[:limit]
+
+    # Authors live on the main database; tombstoned ones are left out.
+    authors = {user.id: user for user in db.session.execute(
+        select(User.id, User.username, User.image_url)
+        .where(User.id.in_({row.user_id for row in page}),
+               User.deleted_at.is_(None)))}
+    rows = [MessageRow(row.id, row.text, row.timestamp, row.user_id,
+                       authors[row.user_id].username, authors[row.user_id].image_url)
+            for row in page if row.user_id in authors]
+
+    if after:
+        return rows, message_cursor(page[-1]) if page else after
+    return rows, message_cursor(page[-1]) if more else None
+
+
+def follower_page(user_id, cursor=None, limit=DEFAULT_LIMIT, hidden=()):
+    """Page of `user_id`'s followers by id, leaving out the ids in `hidden`
+    (e.g. filters.hidden_ids). Returns (rows, next cursor)."""
+
+    stmt = (select(*USER_COLUMNS)
+            .join(Follows, Follows.user_following_id == User.id)
+            .where(Follows.user_being_followed_id == user_id,
+                   User.deleted_at.is_(None))
+            .order_by(User.id)
+            .limit(limit + 1))
+
+    if len(hidden):
+        stmt = stmt.where(User.id.not_in([int(id) for id in hidden]))
+    if cursor:
+        (last_id,) = decode_cursor(cursor, int)
+        stmt = stmt.where(User.id > last_id)
+
+    rows = db.session.execute(stmt).all()
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].id)
+
+
+def serialize_users(rows):
+    return [{
+        'id': row.id,
+        'username': row.username,
+        'image_url': media_url(row.image_url, 'card'),
+        'bio': row.bio,
+    } for row in rows]
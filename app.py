@@ -1,14 +1,65 @@
+import contextvars
+import math
 import os
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from threading import Lock, Thread
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+from flask import (Flask, Response, render_template, request, flash, redirect, session, g, url_for,
+                   abort, send_file, has_request_context)
 # from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import and_, func, literal, or_, select, tuple_, union_all
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import (db, connect_db, User, Message, Likes, Follows, KnownFollowers, Mutes,
+                    Blocks, Rewarbles)
+from writebehind import EdgeBuffer, SharedOverlay, write_edges
+import deletion
+import api
+import export
+from live import Hub, LocalBackend, PostgresBackend
+import assembly
+import ranking
+from assembly import Section
+from graph import FollowGraph
+from trending import Trending, start_sync
+from views import ViewCounter
+import notifications
+from cache import make_cache
+from availability import Availability
+from archive import Archive
+import outbox
+import admission
+import filters
+import media
+from media import MediaStore, BadImage
+import sharding
+from sharding import ShardRouter
+from admission import Admission, TokenBuckets
 from flask_bcrypt import Bcrypt
 
 CURR_USER_KEY = "curr_user"
+# Id of the newest outbox event the curr user made (see waiting_on_own_write).
+LAST_WRITE_KEY = "last_write"
+SUGGESTIONS = 20
+KNOWN_FOLLOWERS_NAMED = 2
+
+# How long the last timeline shown to a user is kept for degraded mode.
+LAST_TIMELINE_TTL = 24 * 3600
+
+# Streamed list pages: rows fetched from the server-side cursor at a time,
+# and template output events sent per write.
+STREAM_ROWS = 100
+STREAM_BUFFER = 50
+
+# Warbles per page of a user's likes.
+LIKES_PAGE = 50
+
+# A year: how long browsers may keep a media variant.
+MEDIA_MAX_AGE = 365 * 24 * 3600
 
 def create_app():
     app = Flask(__name__)
@@ -20,6 +71,78 @@ def create_app():
     app.config['SQLALCHEMY_ECHO'] = False
     app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+    # Comma-separated shard databases for messages/likes (see sharding.py).
+    # Leave unset to keep everything on the main database.
+    app.config['SHARD_DATABASE_URIS'] = [
+        uri for uri in os.environ.get('SHARD_DATABASE_URLS', '').split(',') if uri
+    ]
+    # Set to a local file path to buffer like/follow writes (see writebehind.py).
+    # Each process logs to this path with its pid appended.
+    app.config['WRITE_BEHIND_LOG'] = os.environ.get('WRITE_BEHIND_LOG')
+    # Set to run the deleted-account purge worker inside the app process
+    # instead of as its own `python deletion.py` process.
+    app.config['DELETION_WORKER'] = bool(os.environ.get('DELETION_WORKER'))
+    # Live timeline streams (see live.py): where the page connects, and how
+    # new-warble events reach the process serving them ('local'/'postgres').
+    app.config['LIVE_STREAM_URL'] = os.environ.get('LIVE_STREAM_URL', '/api/v1/stream')
+    app.config['LIVE_BACKEND'] = os.environ.get('LIVE_BACKEND', 'local')
+    # Pages assembled from concurrent sections (see assembly.py): how long a
+    # section may take before the page renders without it.
+    app.config['PAGE_SECTION_TIMEOUT'] = float(os.environ.get('PAGE_SECTION_TIMEOUT', 2.0))
+    app.config['PAGE_SECTION_WORKERS'] = int(os.environ.get('PAGE_SECTION_WORKERS', 8))
+    # Snapshot of the follow graph to memory-map (see graph.py); without one
+    # each worker builds its own from the follows table.
+    app.config['FOLLOW_GRAPH_SNAPSHOT'] = os.environ.get('FOLLOW_GRAPH_SNAPSHOT')
+    # Seconds before a worker rebuilds its own follow graph (no snapshot) in
+    # the background, to drop deleted accounts.
+    app.config['FOLLOW_GRAPH_REFRESH'] = float(os.environ.get('FOLLOW_GRAPH_REFRESH', 60))
+    # Seconds between reads of follows (made by any worker) from the outbox
+    # into this worker's follow graph.
+    app.config['FOLLOW_GRAPH_SYNC'] = float(os.environ.get('FOLLOW_GRAPH_SYNC', 1.0))
+    # Seconds between reads of new messages into this process's trending
+    # windows (after a backfill at startup); 0 turns it off.
+    app.config['TRENDING_SYNC'] = float(os.environ.get('TRENDING_SYNC', 10))
+    # Seconds between flushes of view counts to the database (see views.py).
+    app.config['VIEW_FLUSH_INTERVAL'] = float(os.environ.get('VIEW_FLUSH_INTERVAL', 10))
+    # Set to 0 to fold old notification events into groups (see
+    # notifications.py) from `python notifications.py compact` instead of
+    # in-process.
+    app.config['NOTIFICATION_COMPACTION'] = bool(int(os.environ.get('NOTIFICATION_COMPACTION', 1)))
+    # Cache tiers beyond the per-process one (see cache.py): a SQLite file
+    # shared by the workers on this host (set it empty to go without, with
+    # a single worker), and a redis:// (or memory://) URL. Versions read
+    # from the outermost tier are reused for CACHE_VERSION_TTL secs.
+    app.config['CACHE_PATH'] = os.environ.get(
+        'CACHE_PATH', os.path.join(app.instance_path, 'cache.sqlite3'))
+    app.config['CACHE_URL'] = os.environ.get('CACHE_URL')
+    app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 300))
+    app.config['CACHE_VERSION_TTL'] = float(os.environ.get('CACHE_VERSION_TTL', 1.0))
+    # Where old months of messages are moved to (see archive.py), and how
+    # old a month has to be. Leave the directory unset to keep everything
+    # in the messages table.
+    app.config['MESSAGE_ARCHIVE_DIR'] = os.environ.get('MESSAGE_ARCHIVE_DIR')
+    app.config['ARCHIVE_AFTER'] = timedelta(days=int(os.environ.get('ARCHIVE_AFTER_DAYS', 180)))
+    # Set to 0 to run the outbox consumers as their own `python outbox.py
+    # run` process instead of inside the app process.
+    app.config['OUTBOX_RUNNER'] = bool(int(os.environ.get('OUTBOX_RUNNER', 1)))
+    # Admission control (see admission.py): requests of each class of route
+    # run at once, and secs one may queue before it's turned away (503).
+    app.config['FEED_CONCURRENCY'] = int(os.environ.get('FEED_CONCURRENCY', 8))
+    app.config['AUTH_CONCURRENCY'] = int(os.environ.get('AUTH_CONCURRENCY', 4))
+    app.config['DEFAULT_CONCURRENCY'] = int(os.environ.get('DEFAULT_CONCURRENCY', 32))
+    # Degraded homepages (served while the feed gate is full) run at once.
+    app.config['DEGRADED_CONCURRENCY'] = int(os.environ.get('DEGRADED_CONCURRENCY', 16))
+    app.config['QUEUE_DEADLINE'] = float(os.environ.get('QUEUE_DEADLINE', 1.0))
+    # Likes, follows and warbles each user may make per minute, in bursts
+    # of up to WRITE_BURST.
+    app.config['WRITE_RATE'] = float(os.environ.get('WRITE_RATE', 30))
+    app.config['WRITE_BURST'] = int(os.environ.get('WRITE_BURST', 10))
+    # Where uploaded pictures and their resized variants are kept (see
+    # media.py), how many threads resize them, and how long a request for
+    # a variant that isn't ready waits before getting the original.
+    app.config['MEDIA_DIR'] = os.environ.get('MEDIA_DIR', os.path.join(app.instance_path, 'media'))
+    app.config['MEDIA_WORKERS'] = int(os.environ.get('MEDIA_WORKERS', 2))
+    app.config['MEDIA_WAIT'] = float(os.environ.get('MEDIA_WAIT', 2.0))
     # toolbar = DebugToolbarExtension(app)
 
     connect_db(app)
@@ -31,6 +154,102 @@ def create_app():
 
 app = create_app()
 
+gates = admission.make_gates(app.config)
+Admission(app, gates)
+write_limits = TokenBuckets(app.config['WRITE_RATE'] / 60, app.config['WRITE_BURST'])
+
+cache = make_cache(app.config)
+
+# Built on first use (see availability.py).
+availability = Availability()
+
+archive = None
+if app.config['MESSAGE_ARCHIVE_DIR']:
+    archive = Archive(app.config['MESSAGE_ARCHIVE_DIR'])
+
+media_store = MediaStore(app.config['MEDIA_DIR'], workers=app.config['MEDIA_WORKERS'])
+
+# Messages and likes on their authors' shards, or None when sharding is off
+# (see sharding.py). The purge worker finds it in app.extensions.
+shard_router = ShardRouter.from_config(app.config)
+app.extensions['shard_router'] = shard_router
+
+
+def invalidate_from_outbox(events):
+    """Outbox consumer: invalidate the cached data each change touches.
+
+    A deleted account also drops out of the follower counts of everyone it
+    followed, and the following counts of everyone following it. (If the
+    purge has already removed its follows, those counts catch up within
+    CACHE_TTL.)
+    """
+
+    for event in events:
+        kind, user_id, target_id = event.kind, event.user_id, event.target_id
+        if kind.startswith('message.'):
+            cache.bump('messages', user_id)
+        elif kind.startswith('like.'):
+            cache.bump('likes', user_id)
+        elif kind.startswith('follow.'):
+            cache.bump('followers', target_id)
+            cache.bump('following', user_id)
+        elif kind.startswith(('mute.', 'block.')):
+            cache.bump('filters', user_id)
+            if kind.startswith('block.'):
+                # The other side's filter has the block too.
+                cache.bump('filters', target_id)
+        elif kind == 'user.updated':
+            cache.bump('user', user_id)
+        elif kind == 'user.deleted':
+            cache.bump('user', user_id)
+            for followed_id in Follows.followed_ids(user_id):
+                cache.bump('followers', followed_id)
+            for follower_id in Follows.follower_ids(user_id):
+                cache.bump('following', follower_id)
+
+
+def publish_from_outbox(events):
+    """Outbox consumer: publish new warbles to the live streams."""
+
+    for event in events:
+        if event.kind == 'message.created':
+            hub.publish(event.user_id, event.target_id)
+
+
+# Everything that reacts to changes through the outbox (see outbox.py).
+OUTBOX_CONSUMERS = {
+    'cache': invalidate_from_outbox,
+    'notifications': notifications.from_outbox,
+    'live': publish_from_outbox,
+}
+
+# Pending edges are also kept in the outermost cache tier, so every worker
+# can show a user their own likes and follows.
+edge_buffer = None
+if app.config['WRITE_BEHIND_LOG']:
+    edge_buffer = EdgeBuffer.for_process(app, app.config['WRITE_BEHIND_LOG'],
+                                         shared=SharedOverlay(cache.tiers[-1])).start()
+
+if app.config['DELETION_WORKER']:
+    deletion.start_worker(app)
+
+# Built on first use by get_follow_graph(), then kept up to date from the
+# outbox by sync_follow_graph().
+follow_graph = None
+follow_graph_rebuilding = Lock()
+follow_tail = outbox.Tail()
+follow_tail_lock = Lock()
+
+trending = Trending()
+view_counter = ViewCounter(app, interval=app.config['VIEW_FLUSH_INTERVAL'])
+if app.config['TRENDING_SYNC']:
+    start_sync(app, trending, app.config['TRENDING_SYNC'])
+
+if app.config['LIVE_BACKEND'] == 'postgres':
+    hub = Hub(PostgresBackend(app.config['SQLALCHEMY_DATABASE_URI']))
+else:
+    hub = Hub(LocalBackend())
+
 if __name__ == '__main__':
     app.run(debug=True)
 
@@ -38,18 +257,429 @@ if __name__ == '__main__':
 # User signup/login/logout
 
 
+# The outbox runner, the follow graph's sync and the notification
+# compactor start with the first request, and not under app.testing (where
+# tests run them by hand).
+background_started = False
+background_lock = Lock()
+
+
+@app.before_request
+def start_background():
+    """Start the in-process background threads, once."""
+
+    global background_started
+
+    if background_started or app.testing:
+        return
+    with background_lock:
+        if background_started:
+            return
+        if app.config['OUTBOX_RUNNER']:
+            outbox.start_runner(app, OUTBOX_CONSUMERS)
+        Thread(target=follow_graph_syncer, daemon=True).start()
+        if app.config['NOTIFICATION_COMPACTION']:
+            notifications.start_compactor(app)
+        background_started = True
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
+    g.user = None
+    # g outlives the request when an app context was already pushed (as in
+    # the tests), so drop what an earlier request kept for its user.
+    g.pop('following_ids', None)
+    g.pop('hidden_ids', None)
+    g.pop('cache_behind', None)
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = User.active().filter_by(id=session[CURR_USER_KEY]).first()
+        if not g.user:
+            do_logout()
+
+    if g.user:
         print(f"Logged in as: {g.user.username}")
     else:
-        g.user = None
         print("No user logged in.")
 
 
+def save_edge(kind, op, target_id):
+    """Add or remove a 'like'/'follow' edge from the curr user.
+
+    Goes through the write-behind buffer when it's on; otherwise it's
+    written and committed right away.
+    """
+
+    if edge_buffer:
+        edge_buffer.submit(kind, op, g.user.id, target_id)
+    else:
+        write_edges({(kind, g.user.id, target_id): op})
+        db.session.commit()
+
+
+def rate_limited(view):
+    """Turn away the curr user's POSTs to `view` past WRITE_RATE with a 429,
+    saying when to retry."""
+
+    @wraps(view)
+    def limited(*args, **kwargs):
+        if g.user and request.method == 'POST':
+            wait = write_limits.take((view.__name__, g.user.id))
+            if wait:
+                abort(429, "You're doing that too often. Try again in a moment.",
+                      retry_after=math.ceil(wait))
+        return view(*args, **kwargs)
+
+    return limited
+
+
+def apply_pending(kind, ids):
+    """Update set `ids` with the curr user's not-yet-flushed edges."""
+
+    if edge_buffer:
+        for target_id, op in edge_buffer.overlay(kind, g.user.id).items():
+            if op == 'add':
+                ids.add(target_id)
+            else:
+                ids.discard(target_id)
+    return ids
+
+
+def get_follow_graph():
+    """The follow graph: loaded or built once, then kept up to date.
+
+    A user whose own last change this process hasn't read from the outbox
+    yet waits for it to be.
+    """
+
+    global follow_graph
+
+    if follow_graph is not None and has_request_context() and LAST_WRITE_KEY in session:
+        last_write = session[LAST_WRITE_KEY]
+        if last_write > follow_tail.position or last_write in follow_tail.gaps:
+            sync_follow_graph()
+
+    if follow_graph is None:
+        # Follows committed from here on are read onto it.
+        with follow_tail_lock:
+            follow_tail.start()
+        path = app.config['FOLLOW_GRAPH_SNAPSHOT']
+        if path and os.path.exists(path):
+            follow_graph = FollowGraph.load(path)
+        else:
+            follow_graph = FollowGraph.from_db()
+    elif follow_graph.path:
+        follow_graph = follow_graph.reload_if_changed()
+    elif (time.monotonic() - follow_graph.built_at > app.config['FOLLOW_GRAPH_REFRESH']
+          and follow_graph_rebuilding.acquire(blocking=False)):
+        # Keep serving this one while the new one is built.
+        Thread(target=rebuild_follow_graph, daemon=True).start()
+    return follow_graph
+
+
+def rebuild_follow_graph():
+    """Replace the follow graph with a fresh one from the table."""
+
+    global follow_graph
+
+    try:
+        with app.app_context():
+            graph = FollowGraph.from_db()
+        # Follows made here while it was built are replayed onto it.
+        follow_graph = follow_graph.replaced_by(graph)
+    except Exception:
+        app.logger.exception("Rebuilding the follow graph failed")
+    finally:
+        follow_graph_rebuilding.release()
+
+
+def sync_follow_graph():
+    """Apply the follows in the outbox since the last sync to the graph
+    (inside an app context)."""
+
+    with follow_tail_lock:
+        while True:
+            events = follow_tail.read()
+            for event in events:
+                if follow_graph is None:
+                    break
+                if event.kind == 'follow.added':
+                    follow_graph.add(event.user_id, event.target_id)
+                elif event.kind == 'follow.removed':
+                    follow_graph.remove(event.user_id, event.target_id)
+            if len(events) < outbox.BATCH_SIZE:
+                return
+
+
+def follow_graph_syncer():
+    """Sync the follow graph every FOLLOW_GRAPH_SYNC secs, once built."""
+
+    while True:
+        time.sleep(app.config['FOLLOW_GRAPH_SYNC'])
+        if follow_graph is None:
+            continue
+        try:
+            with app.app_context():
+                sync_follow_graph()
+        except Exception:
+            app.logger.exception("Syncing the follow graph failed")
+
+
+def waiting_on_own_write():
+    """Has the cache consumer yet to handle the curr user's own last change?
+
+    Asked once per request; the session forgets the change once it's been
+    handled.
+    """
+
+    if not has_request_context() or LAST_WRITE_KEY not in session:
+        return False
+    if 'cache_behind' not in g:
+        g.cache_behind = not outbox.handled('cache', session[LAST_WRITE_KEY])
+        if not g.cache_behind:
+            del session[LAST_WRITE_KEY]
+    return g.cache_behind
+
+
+def cached(name, deps, compute):
+    """`cache.get_or_set`, but computed afresh for a user who is waiting on
+    their own change to reach the cache."""
+
+    if waiting_on_own_write():
+        return compute()
+    return cache.get_or_set(name, deps, compute)
+
+
+def viewer_following_ids():
+    """Ids of the users the curr user follows (cached for the request)."""
+
+    if 'following_ids' not in g:
+        g.following_ids = apply_pending('follow', set(Follows.followed_ids(g.user.id)))
+    return g.following_ids
+
+
+def viewer_hidden_ids():
+    """Sorted ids of the accounts hidden from the curr user by mutes and
+    blocks (cached, and kept for the request)."""
+
+    if not g.user:
+        return filters.EMPTY
+    if 'hidden_ids' not in g:
+        g.hidden_ids = cached(f"hidden:{g.user.id}", [('filters', g.user.id)],
+                              lambda: filters.hidden_ids(g.user.id))
+    return g.hidden_ids
+
+
+def viewer_relation(user_id):
+    """Mutes/blocks between the curr user and `user_id` (see filters.relation)."""
+
+    if not g.user or g.user.id == user_id:
+        return set()
+    return filters.relation(g.user.id, user_id)
+
+
+def blocked_with(user_id):
+    """Has the curr user blocked `user_id`, or been blocked by them?"""
+
+    # The cached filter settles it unless `user_id` is hidden at all.
+    if filters.visible([user_id], viewer_hidden_ids())[0]:
+        return False
+    return bool(viewer_relation(user_id) & {'blocked', 'blocked_by'})
+
+
+def viewer_liked_ids(message_ids):
+    """Which of `message_ids` does the curr user like?"""
+
+    liked = apply_pending('like', sharding.liked_ids(g.user.id, message_ids))
+    return liked & set(message_ids)
+
+
+def message_count(user_id):
+    """How many warbles `user_id` has posted (cached)."""
+
+    if shard_router:
+        return cached(f"message_count:{user_id}", [('messages', user_id)],
+                      lambda: shard_router.count_messages(user_id))
+    return cached(f"message_count:{user_id}", [('messages', user_id)],
+                  lambda: Message.count_for(user_id))
+
+
+def follower_count(user_id):
+    """How many users follow `user_id` (cached)."""
+
+    return cached(f"follower_count:{user_id}", [('followers', user_id)],
+                  lambda: Follows.follower_count(user_id))
+
+
+def profile_summary(user_id):
+    """(ids of the latest 100 messages, likes count) for `user_id`'s
+    profile (cached)."""
+
+    def compute():
+        if shard_router:
+            return ([row.id for row in shard_router.user_messages(user_id)],
+                    shard_router.count_likes(user_id))
+
+        message_ids = (db.session
+                       .execute(db.select(Message.id)
+                                .where(Message.user_id == user_id,
+                                       Message.deleted_at.is_(None))
+                                .order_by(Message.timestamp.desc())
+                                .limit(100))
+                       .scalars()
+                       .all())
+        return message_ids, Likes.query.filter_by(user_id=user_id).count()
+
+    return cached(f"profile:{user_id}",
+                  [('user', user_id), ('messages', user_id), ('likes', user_id)],
+                  compute)
+
+
+def following_count(user_id):
+    """How many users `user_id` follows (cached)."""
+
+    return cached(f"following_count:{user_id}", [('following', user_id)],
+                  lambda: Follows.following_count(user_id))
+
+
+def follow_counts(user):
+    """(following, followers) counts of `user`, from the table (cached);
+    the follow graph can be behind."""
+
+    return following_count(user.id), follower_count(user.id)
+
+
+def count_active(ids):
+    """How many of the users `ids` aren't deleted."""
+
+    if not len(ids):
+        return 0
+    return db.session.scalar(db.select(func.count())
+                             .where(User.id.in_(ids.tolist()),
+                                    User.deleted_at.is_(None)))
+
+
+def known_followers(user):
+    """KnownFollowers of `user` among the people the curr user follows."""
+
+    if not g.user or g.user.id == user.id:
+        return None
+
+    ids = get_follow_graph().known_followers(g.user.id, user.id)
+    if not len(ids):
+        return None
+    # The graph may still have accounts deleted since it was built.
+    count = count_active(ids)
+
+    # A handful of candidates is plenty to find a couple that aren't deleted.
+    names = (db.session
+             .execute(db.select(User.username)
+                      .where(User.id.in_(ids[:KNOWN_FOLLOWERS_NAMED * 5].tolist()),
+                             User.deleted_at.is_(None))
+                      .order_by(User.id)
+                      .limit(KNOWN_FOLLOWERS_NAMED))
+             .scalars()
+             .all())
+    return KnownFollowers(count, names) if names else None
+
+
+def mutual_follows(user):
+    """How many accounts both the curr user and `user` follow."""
+
+    if not g.user or g.user.id == user.id:
+        return 0
+    return count_active(get_follow_graph().mutual_follows(g.user.id, user.id))
+
+
+@app.context_processor
+def follow_helpers():
+    """Let templates ask about follows without loading relationships."""
+
+    return {
+        'is_following': lambda user: user.id in viewer_following_ids(),
+        'relation_to': lambda user: viewer_relation(user.id),
+        'follow_counts': follow_counts,
+        'known_followers': known_followers,
+        'mutual_follows': mutual_follows,
+    }
+
+
+@app.context_processor
+def count_helpers():
+    """Let templates show counts without loading the rows."""
+
+    return {
+        'message_count': message_count,
+    }
+
+
+@app.context_processor
+def media_helpers():
+    """Let templates pick the size of a picture to show."""
+
+    return {
+        'media_url': media.media_url,
+    }
+
+
+@app.context_processor
+def notification_helpers():
+    """Let the nav show the curr user's unread count."""
+
+    return {
+        'unread_notifications': lambda: notifications.unread_count(g.user.id),
+    }
+
+
+def stream_page(template_name, **context):
+    """Like render_template, but sends the page out as it renders.
+
+    The head and the first cards go out right away. Lists passed in as
+    `yield_per` queries are read from a server-side cursor as the page is
+    written, so memory stays flat however long they are.
+    """
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+
+    stream.enable_buffering(STREAM_BUFFER)
+    admission.hold_until_sent()
+    return Response(stream_in_snapshot(stream))
+
+
+def stream_in_snapshot(chunks):
+    """Iterate `chunks` as the body of the current request, in a snapshot of
+    its contexts.
+
+    stream_with_context pushes the request's contexts again while the body
+    is read, and holds them between chunks; anything else pushed meanwhile
+    (as the test client does between a redirect and the page it leads to)
+    is then popped out of order. A snapshot needs no pushing.
+    """
+
+    snapshot = contextvars.copy_context()
+    session = db.session()
+
+    def generate():
+        try:
+            while True:
+                try:
+                    chunk = snapshot.run(next, chunks)
+                except StopIteration:
+                    return
+                yield chunk
+        finally:
+            if snapshot.run(db.session) is not session:
+                # The request's teardown has removed its session, and the
+                # stream's queries reopened it: close that, and any session
+                # the stream started itself.
+                session.close()
+                snapshot.run(db.session.remove)
+
+    return generate()
+
+
 def do_login(user):
     """Log in user."""
 
@@ -63,6 +693,31 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def uploaded_url(field, kind):
+    """URL of the `kind` picture uploaded in file `field` (see media.py),
+    or None if nothing was uploaded. Raises BadImage."""
+
+    upload = field.data
+    if not upload or not upload.filename:
+        return None
+    # One byte over the limit is enough to turn it away.
+    return media_store.save(upload.read(media.MAX_BYTES + 1), kind)
+
+
+def discard_upload(url):
+    """Delete upload `url` (from `uploaded_url`) unless some user's picture
+    is it: the same bytes may have been uploaded by someone else."""
+
+    if not url:
+        return
+    in_use = db.session.scalar(
+        select(User.id)
+        .where(or_(User.image_url == url, User.header_image_url == url))
+        .limit(1))
+    if in_use is None:
+        media_store.discard(url[len(media.URL_PREFIX):])
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -78,19 +733,35 @@ def signup():
 
     # if form.validate_on_submit():
     if form.is_submitted() and form.validate():
+        # Turn away taken names before paying for the password hash.
+        taken = availability.taken(form.username.data, form.email.data, strict=True)
+        if taken:
+            flash("Username already taken" if 'username' in taken
+                  else "E-mail already in use", 'danger')
+            return render_template('users/signup.html', form=form)
+
+        try:
+            image_url = uploaded_url(form.image_file, 'avatar')
+        except BadImage as exc:
+            form.image_file.errors.append(str(exc))
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
+                image_url=image_url or form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
 
         except IntegrityError:
+            db.session.rollback()
+            discard_upload(image_url)
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        availability.add(user.username, user.email)
         do_login(user)
 
         return redirect("/")
@@ -99,6 +770,42 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
+@app.route('/media/<digest>/<variant>.jpg')
+def media_variant(digest, variant):
+    """Serve a resized upload. Its content never changes, so it's cached
+    for good; until it's rendered, the original stands in, uncached."""
+
+    if not media.DIGEST.match(digest) or variant not in media.VARIANTS:
+        abort(404)
+
+    if media_store.ready(digest, variant, timeout=app.config['MEDIA_WAIT']):
+        resp = send_file(media_store.variant_path(digest, variant),
+                         mimetype='image/jpeg', max_age=MEDIA_MAX_AGE)
+        resp.cache_control.public = True
+        resp.cache_control.immutable = True
+        return resp
+
+    original = media_store.original_path(digest)
+    if not os.path.exists(original):
+        abort(404)
+    return send_file(original, mimetype=media_store.mimetype(digest), max_age=0)
+
+
+@app.route('/users/available')
+def users_available():
+    """Whether ?username= is free, for the signup form: {"username": true}.
+
+    Emails aren't looked up here: anyone could ask, unthrottled, whether an
+    address has an account. Signup itself still turns a taken one away.
+    """
+
+    username = request.args.get('username')
+    if not username:
+        return api.error("Pass a username.", 400)
+
+    return api.to_json({'username': not availability.taken(username)})
+
+
 @app.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
@@ -143,33 +850,82 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = User.active()
+    if search:
+        users = users.filter(User.username.like(f"%{search}%"))
+
+    users = filters.stream_hidden(users.yield_per(STREAM_ROWS), viewer_hidden_ids(),
+                                  key=lambda user: user.id, chunk=STREAM_ROWS)
+    return stream_page('users/index.html', users=users)
+
+
+@app.route('/users/suggestions')
+def users_suggestions():
+    """Show who to follow: accounts followed by the people the curr user
+    follows, ranked by how many of them follow each one.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    # Ask for a few extra in case some have deleted their accounts.
+    ranked = get_follow_graph().suggestions(g.user.id, limit=SUGGESTIONS * 2)
+    mutuals = dict(ranked)
+    found = {user.id: user for user in User.active().filter(User.id.in_(mutuals))}
+    users = [found[user_id] for user_id, _ in ranked if user_id in found]
+    users = filters.drop_hidden(users, viewer_hidden_ids(), key=lambda user: user.id)[:SUGGESTIONS]
+
+    return render_template('users/index.html', users=users, mutuals=mutuals)
+
+
+@app.route('/notifications')
+def show_notifications():
+    """Show the curr user's notifications, and mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    found = notifications.notifications_for(g.user.id)
+    notifications.mark_read(g.user.id)
+    db.session.commit()
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/notifications.html', notifications=found)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.active().filter_by(id=user_id).first_or_404()
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    
-    # Calculate the number of likes for the user
-    likes_count = len(user.likes)
+    message_ids, likes_count = profile_summary(user_id)
+    # A muted account's own profile still shows its warbles; a block doesn't.
+    if blocked_with(user_id):
+        message_ids = []
+    if shard_router:
+        # Read straight from the author's shard.
+        messages = shard_router.user_messages(user_id) if message_ids else []
+        message_ids = [msg.id for msg in messages]
+    else:
+        messages = (Message
+                    .visible()
+                    .filter(Message.id.in_(message_ids))
+                    .order_by(Message.timestamp.desc())
+                    .all())
+
+    like_summaries = sharding.like_summaries(message_ids,
+                                             viewer_following_ids() if g.user else ())
+    if g.user and g.user.id != user_id:
+        view_counter.record(g.user.id, message_ids)
+    seen_by = view_counter.seen_by(message_ids)
 
-    return render_template('users/show.html', user=user, messages=messages, likes_count=likes_count)
+    return render_template('users/show.html', user=user, messages=messages,
+                           likes_count=likes_count, like_summaries=like_summaries,
+                           seen_by=seen_by)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -180,8 +936,15 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    following = (User
+                 .active()
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user_id)
+                 .yield_per(STREAM_ROWS))
+    following = filters.stream_hidden(following, viewer_hidden_ids(),
+                                      key=lambda user: user.id, chunk=STREAM_ROWS)
+    return stream_page('users/following.html', user=user, following=following)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -192,11 +955,19 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    followers = (User
+                 .active()
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user_id)
+                 .yield_per(STREAM_ROWS))
+    followers = filters.stream_hidden(followers, viewer_hidden_ids(),
+                                      key=lambda user: user.id, chunk=STREAM_ROWS)
+    return stream_page('users/followers.html', user=user, followers=followers)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@rate_limited
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -204,9 +975,12 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    followed_user = User.active().filter_by(id=follow_id).first_or_404()
+    if blocked_with(followed_user.id):
+        flash("You can't follow this user.", "danger")
+        return redirect(f"/users/{followed_user.id}")
+
+    save_edge('follow', 'add', followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -219,13 +993,104 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    save_edge('follow', 'remove', follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
+
+def save_filter(kind, op, other_id):
+    """Add or remove a 'mute'/'block' of `other_id` by the curr user.
+
+    Blocking also unfollows both ways, through the write-behind buffer
+    when it's on.
+    """
+
+    model = Mutes if kind == 'mute' else Blocks
+    getattr(model, op)(g.user.id, other_id)
+    outbox.record(f"{kind}.{'added' if op == 'add' else 'removed'}", g.user.id, other_id)
+
+    unfollows = {}
+    if kind == 'block' and op == 'add':
+        unfollows = {('follow', g.user.id, other_id): 'remove',
+                     ('follow', other_id, g.user.id): 'remove'}
+        if edge_buffer:
+            for (edge_kind, user_id, target_id), edge_op in unfollows.items():
+                edge_buffer.submit(edge_kind, edge_op, user_id, target_id)
+            unfollows = {}
+        else:
+            write_edges(unfollows)
+
+    db.session.commit()
+
+
+@app.route('/users/mute/<int:user_id>', methods=['POST'])
+@rate_limited
+def mute_user(user_id):
+    """Hide this user's warbles from the curr user's timelines."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    if user.id == g.user.id:
+        flash("You can't mute yourself.", "danger")
+        return redirect(f"/users/{user.id}")
+
+    save_filter('mute', 'add', user.id)
+    flash(f"Muted @{user.username}.", "success")
+
+    return redirect(f"/users/{user.id}")
+
+
+@app.route('/users/unmute/<int:user_id>', methods=['POST'])
+def unmute_user(user_id):
+    """Show this user's warbles to the curr user again."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    save_filter('mute', 'remove', user_id)
+
+    return redirect(f"/users/{user_id}")
+
+
+@app.route('/users/block/<int:user_id>', methods=['POST'])
+@rate_limited
+def block_user(user_id):
+    """Block this user: unfollow both ways and hide each from the other."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    if user.id == g.user.id:
+        flash("You can't block yourself.", "danger")
+        return redirect(f"/users/{user.id}")
+
+    save_filter('block', 'add', user.id)
+    flash(f"Blocked @{user.username}.", "success")
+
+    return redirect(f"/users/{user.id}")
+
+
+@app.route('/users/unblock/<int:user_id>', methods=['POST'])
+def unblock_user(user_id):
+    """Lift the curr user's block on this user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    save_filter('block', 'remove', user_id)
+
+    return redirect(f"/users/{user_id}")
+
+
 @app.route('/users/add_like/<int:message_id>', methods=['POST'])
+@rate_limited
 def add_like(message_id):
     """Add a like to a warble."""
 
@@ -234,13 +1099,15 @@ def add_like(message_id):
         return redirect("/")
     
     # Ensure user cannot like their own warble
-    message = Message.query.get_or_404(message_id)
+    message = sharding.visible_messages([message_id]).get(message_id) or abort(404)
     if message.user_id == g.user.id:
         flash("You cannot like your own warbles!", "danger")
         return redirect("/")
+    if blocked_with(message.user_id):
+        flash("You can't like this user's warbles.", "danger")
+        return redirect("/")
     
-    g.user.likes.append(message)
-    db.session.commit()
+    save_edge('like', 'add', message.id)
 
     return redirect("/")
 
@@ -252,21 +1119,118 @@ def un_like(message_id):
         flash("Access unathorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(message_id)
-    if message in g.user.likes:
-        g.user.likes.remove(message)
-        db.session.commit()
+    save_edge('like', 'remove', message_id)
+
+    return redirect("/")
+
+
+@app.route('/messages/<int:message_id>/rewarble', methods=['POST'])
+@rate_limited
+def rewarble(message_id):
+    """Re-warble a warble to the curr user's followers."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    message = sharding.visible_messages([message_id]).get(message_id) or abort(404)
+    if message.user_id == g.user.id:
+        flash("You cannot re-warble your own warbles!", "danger")
+        return redirect("/")
+    if blocked_with(message.user_id):
+        flash("You can't re-warble this user's warbles.", "danger")
+        return redirect("/")
+
+    Rewarbles.add(g.user.id, message.id)
+    outbox.record('rewarble.added', g.user.id, message.id)
+    db.session.commit()
+
+    return redirect("/")
+
+
+@app.route('/messages/<int:message_id>/unrewarble', methods=['POST'])
+def unrewarble(message_id):
+    """Undo the curr user's re-warble of a warble."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    Rewarbles.remove(g.user.id, message_id)
+    outbox.record('rewarble.removed', g.user.id, message_id)
+    db.session.commit()
 
     return redirect("/")
 
 @app.route('/users/<int:user_id>/likes')
 def show_user_liked_warbles(user_id):
-    """Show all warbles liked by the user."""
+    """Show a page of the warbles liked by the user, most recently liked
+    first. ?cursor= (from the page's "Older" link) continues after it."""
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    try:
+        liked, cursor = liked_page(user_id, request.args.get('cursor'), LIKES_PAGE)
+    except api.BadCursor:
+        flash("That page of likes couldn't be found.", "danger")
+        return redirect(f"/users/{user_id}/likes")
+
+    messages = filters.drop_hidden(liked, viewer_hidden_ids(), key=lambda msg: msg.user_id)
+    return stream_page('users/liked_warbles.html', messages=messages, user=user,
+                       cursor=cursor)
 
-    user = User.query.get_or_404(user_id)
-    liked_messages = Message.query.join(Likes).filter(Likes.user_id == user_id).all()
 
-    return render_template('users/liked_warbles.html', messages=liked_messages, user=user)
+def liked_page(user_id, cursor=None, limit=LIKES_PAGE):
+    """`user_id`'s liked messages, with their authors, newest like first.
+
+    Pages by keyset on (like time, message id), walking the likes index
+    from the cursor, so every page costs one short range scan and one
+    lookup of its messages whatever the page number or however many likes
+    there are. Returns (messages, next cursor or None).
+    """
+
+    if shard_router:
+        return shard_liked_page(user_id, cursor, limit)
+
+    # Likes of archived messages have no row to join, and are read from
+    # the archive.
+    stmt = (select(Likes.message_id, Likes.timestamp, Message)
+            .outerjoin(Message, Message.id == Likes.message_id)
+            .outerjoin(User, User.id == Message.user_id)
+            .options(contains_eager(Message.user))
+            .where(Likes.user_id == user_id,
+                   or_(Message.id.is_(None),
+                       and_(Message.deleted_at.is_(None), User.deleted_at.is_(None))))
+            .order_by(Likes.timestamp.desc(), Likes.message_id.desc()))
+    if cursor:
+        stmt = stmt.where(tuple_(Likes.timestamp, Likes.message_id) < api.timestamp_key(cursor))
+
+    rows = db.session.execute(stmt.limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = api.encode_cursor(rows[-1].timestamp.isoformat(), rows[-1].message_id)
+
+    messages = (msg or archived_message(message_id) for message_id, _, msg in rows)
+    return [msg for msg in messages if msg], next_cursor
+
+
+def shard_liked_page(user_id, cursor, limit):
+    """liked_page, from the likes on every shard."""
+
+    rows = shard_router.liked_page(user_id, limit + 1,
+                                   before=api.timestamp_key(cursor) if cursor else None)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = api.encode_cursor(rows[-1].timestamp.isoformat(), rows[-1].message_id)
+
+    found = shard_router.messages(row.message_id for row in rows)
+    visible = {msg.id: msg for msg in sharding.with_authors(found.values())}
+    # A like whose message isn't on its shard is of an archived one (or a
+    # deleted one, which the archive doesn't have either).
+    messages = (visible.get(row.message_id) if row.message_id in found
+                else archived_message(row.message_id) for row in rows)
+    return [msg for msg in messages if msg], next_cursor
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -284,13 +1248,23 @@ def edit_profile():
             flash("Incorrect password.", "danger")
             return redirect("/")
         
+        try:
+            image_url = uploaded_url(form.image_file, 'avatar')
+            header_image_url = uploaded_url(form.header_file, 'header')
+        except BadImage as exc:
+            flash(str(exc), "danger")
+            return render_template('users/edit.html', form=form)
+
         g.user.username = form.username.data
         g.user.email = form.email.data
-        g.user.image_url = form.image_url.data or "/static/images/default-pic.png"
-        g.user.header_image_url = form.header_image_url.data or "/static/images/warbler-hero.jpg"
+        g.user.image_url = image_url or form.image_url.data or "/static/images/default-pic.png"
+        g.user.header_image_url = (header_image_url or form.header_image_url.data
+                                   or "/static/images/warbler-hero.jpg")
         g.user.bio = form.bio.data
 
+        outbox.record('user.updated', g.user.id)
         db.session.commit()
+        availability.add(g.user.username, g.user.email)
         flash("Profile updated successfully!", "success")
         return redirect(f"/users/{g.user.id}")
     else:
@@ -310,16 +1284,47 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # Hide the account now; its rows are purged in chunks in the background.
+    g.user.deleted_at = datetime.utcnow()
+    deletion.enqueue('user', g.user.id)
+    outbox.record('user.deleted', g.user.id)
     db.session.commit()
 
     return redirect("/signup")
 
 
+@app.route('/users/export')
+def export_user():
+    """Download all of the curr user's data as NDJSON.
+
+    Streamed as it's read, so it starts right away and never holds the
+    whole account in memory. Pass ?gzip=1 to compress it on the fly.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    lines = export.export_lines(g.user.id, archive=archive)
+    filename = "warbler-export.ndjson"
+    mimetype = "application/x-ndjson"
+
+    if request.args.get('gzip'):
+        lines = export.gzipped(lines)
+        filename += ".gz"
+        mimetype = "application/gzip"
+
+    admission.hold_until_sent()
+    return Response(stream_in_snapshot(lines),
+                    mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+
 ##############################################################################
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@rate_limited
 def messages_add():
     """Add a message:
 
@@ -333,8 +1338,23 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
+        if shard_router:
+            # The shard holds the only copy; it's taken off again if the
+            # event saying it was posted can't be committed.
+            msg_id = shard_router.add_message(g.user.id, form.text.data)
+            outbox.record('message.created', g.user.id, msg_id)
+            try:
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                shard_router.delete_message(g.user.id, msg_id)
+                raise
+            return redirect(f"/users/{g.user.id}")
+
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        outbox.record('message.created', g.user.id, msg.id)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -342,12 +1362,45 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+def archived_message(message_id):
+    """Message `message_id` from the archive, with its author, or None."""
+
+    row = archive.get(message_id) if archive else None
+    if row is None:
+        return None
+    user = User.active().filter_by(id=row.user_id).first()
+    return row._replace(user=user) if user else None
+
+
+def archived_page(user_id):
+    """For api.message_page: `user_id`'s archived messages as MessageRows."""
+
+    def page(before, limit):
+        user = User.active().filter_by(id=user_id).first()
+        if user is None:
+            return []
+        return [api.MessageRow(row.id, row.text, row.timestamp, user.id,
+                               user.username, user.image_url)
+                for row in archive.user_messages(user_id, before, limit)]
+
+    return page
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = sharding.visible_messages([message_id]).get(message_id)
+    if msg is None:
+        msg = archived_message(message_id) or abort(404)
+    like_summaries = sharding.like_summaries([msg.id],
+                                             viewer_following_ids() if g.user else ())
+    if g.user and g.user.id != msg.user_id:
+        view_counter.record(g.user.id, [msg.id])
+    seen_by = view_counter.seen_by([msg.id])
+
+    return render_template('messages/show.html', message=msg,
+                           like_summaries=like_summaries, seen_by=seen_by)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -358,43 +1411,320 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
+    msg = sharding.visible_messages([message_id]).get(message_id) or abort(404)
 
     if msg.user_id != g.user.id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    db.session.delete(msg)
+    # Hide the message now; it and its likes are purged in the background.
+    if shard_router:
+        shard_router.tombstone_message(g.user.id, msg.id)
+    else:
+        msg.deleted_at = datetime.utcnow()
+    deletion.enqueue('message', msg.id)
+    outbox.record('message.deleted', g.user.id, msg.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# JSON API (v1)
+#
+# Same data as the HTML pages, for clients that don't want to scrape them.
+# Every list is paginated by the opaque ?cursor= returned as "next".
+
+
+@app.route('/api/v1/timeline')
+def api_timeline():
+    """Messages of followed users and the curr user, newest first.
+
+    ?after=<cursor> returns only what's newer than that, oldest first; the
+    live homepage uses it to fetch new warbles.
+    """
+
+    if not g.user:
+        return api.error("Login required.", 401)
+
+    following_ids = filters.without(viewer_following_ids() | {g.user.id}, viewer_hidden_ids())
+    try:
+        if shard_router:
+            rows, cursor = api.shard_message_page(shard_router, following_ids,
+                                                  cursor=request.args.get('cursor'),
+                                                  after=request.args.get('after'),
+                                                  limit=api.page_limit())
+        else:
+            rows, cursor = api.message_page(Message.user_id.in_(following_ids),
+                                            cursor=request.args.get('cursor'),
+                                            after=request.args.get('after'),
+                                            limit=api.page_limit())
+    except ValueError:
+        return api.error("Bad cursor.", 400)
+
+    return api.to_json({**api.serialize_messages(rows), 'next': cursor})
+
+
+@app.route('/api/v1/users/<int:user_id>/messages')
+def api_user_messages(user_id):
+    """A user's messages, newest first."""
+
+    # As on the profile page: a mute still shows them, a block doesn't.
+    if blocked_with(user_id):
+        return api.to_json({**api.serialize_messages([]), 'next': None})
+
+    try:
+        if shard_router:
+            rows, cursor = api.shard_message_page(shard_router, [user_id],
+                                                  cursor=request.args.get('cursor'),
+                                                  limit=api.page_limit())
+        else:
+            rows, cursor = api.message_page(Message.user_id == user_id,
+                                            cursor=request.args.get('cursor'),
+                                            limit=api.page_limit(),
+                                            archived=archived_page(user_id) if archive else None)
+    except ValueError:
+        return api.error("Bad cursor.", 400)
+
+    if not rows and not User.active().filter_by(id=user_id).count():
+        return api.error("No such user.", 404)
+
+    return api.to_json({**api.serialize_messages(rows), 'next': cursor})
+
+
+@app.route('/api/v1/users/<int:user_id>/followers')
+def api_user_followers(user_id):
+    """A user's followers."""
+
+    if not g.user:
+        return api.error("Login required.", 401)
+
+    try:
+        rows, cursor = api.follower_page(user_id,
+                                         cursor=request.args.get('cursor'),
+                                         limit=api.page_limit(),
+                                         hidden=viewer_hidden_ids())
+    except ValueError:
+        return api.error("Bad cursor.", 400)
+
+    if not rows and not User.active().filter_by(id=user_id).count():
+        return api.error("No such user.", 404)
+
+    return api.to_json({'users': api.serialize_users(rows), 'next': cursor})
+
+
+@app.route('/api/v1/stream')
+def api_stream():
+    """SSE stream of new warbles from followed users (development fallback).
+
+    Holds a WSGI worker for as long as it's open; in production serve
+    streams from asgi.py instead (see live.py).
+    """
+
+    if not g.user:
+        return api.error("Login required.", 401)
+
+    author_ids = set(filters.without(viewer_following_ids() | {g.user.id}, viewer_hidden_ids()))
+    return Response(hub.stream_sync(author_ids),
+                    mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/v1/messages/<int:message_id>')
+def api_message(message_id):
+    """A single message, with its like summary."""
+
+    if shard_router:
+        rows = [api.MessageRow(msg.id, msg.text, msg.timestamp, msg.user_id,
+                               msg.user.username, msg.user.image_url)
+                for msg in sharding.visible_messages([message_id]).values()]
+    else:
+        rows, _ = api.message_page(Message.id == message_id, limit=1)
+    if not rows or blocked_with(rows[0].user_id):
+        return api.error("No such message.", 404)
+
+    payload = api.serialize_messages(rows)
+    summary = sharding.like_summaries([message_id],
+                                      viewer_following_ids() if g.user else ()).get(message_id)
+    payload['likes'] = summary.count if summary else 0
+    payload['liked_by'] = summary.liked_by if summary else None
+
+    return api.to_json(payload)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
+# Where home_feed reads re-warbles back to when there's less than a page
+# of originals.
+EPOCH = literal(datetime(1970, 1, 1), db.DateTime)
+
+
+def home_feed(author_ids, limit=100):
+    """The `limit` visible messages most recently posted or re-warbled by
+    `author_ids`, each once, with their authors, in one query.
+
+    Each message is placed by its latest activity: the original post, or
+    the last re-warble by one of `author_ids`. Only the `limit` newest
+    originals can place ahead of a re-warble older than the `limit`th of
+    them, so re-warbles are only read back to there.
+    """
+
+    if shard_router:
+        return shard_home_feed(author_ids, limit)
+
+    originals = (select(Message.id.label('message_id'), Message.timestamp.label('at'))
+                 .where(Message.user_id.in_(author_ids), Message.deleted_at.is_(None))
+                 .order_by(Message.timestamp.desc())
+                 .limit(limit)
+                 .subquery())
+    floor = (select(Message.timestamp)
+             .where(Message.user_id.in_(author_ids), Message.deleted_at.is_(None))
+             .order_by(Message.timestamp.desc())
+             .offset(limit - 1)
+             .limit(1)
+             .scalar_subquery())
+    rewarbled = (select(Rewarbles.message_id, Rewarbles.timestamp)
+                 .where(Rewarbles.user_id.in_(author_ids),
+                        Rewarbles.timestamp >= func.coalesce(floor, EPOCH)))
+    activity = union_all(select(originals), rewarbled).subquery()
+    # Pick the page's ids, then load just those with their authors.
+    latest = (select(activity.c.message_id, func.max(activity.c.at).label('at'))
+              .join(Message, Message.id == activity.c.message_id)
+              .where(Message.deleted_at.is_(None))
+              .group_by(activity.c.message_id)
+              .order_by(func.max(activity.c.at).desc(), activity.c.message_id.desc())
+              .limit(limit)
+              .subquery())
+
+    return (Message
+            .visible()
+            .join(latest, latest.c.message_id == Message.id)
+            .options(contains_eager(Message.user))
+            .order_by(latest.c.at.desc(), Message.id.desc())
+            .all())
+
+
+def shard_home_feed(author_ids, limit=100):
+    """home_feed, with the originals merged from the shards and the
+    re-warbles (from the main database) looked up there."""
+
+    originals = shard_router.timeline(author_ids, limit)
+    floor = originals[-1].timestamp if len(originals) == limit else datetime(1970, 1, 1)
+    at = {row.id: row.timestamp for row in originals}
+    rewarbled = db.session.execute(
+        select(Rewarbles.message_id, func.max(Rewarbles.timestamp))
+        .where(Rewarbles.user_id.in_(author_ids), Rewarbles.timestamp >= floor)
+        .group_by(Rewarbles.message_id)).all()
+    for message_id, timestamp in rewarbled:
+        at[message_id] = max(at.get(message_id, timestamp), timestamp)
+
+    rows = {row.id: row for row in originals}
+    rows.update(shard_router.messages(set(at) - set(rows)))
+    latest = sorted(rows.values(), key=lambda row: (at[row.id], row.id), reverse=True)
+    return sharding.with_authors(latest[:limit])
+
+
+def last_timeline_key(user_id, ranked):
+    return f"last_timeline:{user_id}:{'top' if ranked else 'latest'}"
+
+
+def degraded_homepage(ranked):
+    """The homepage when its gate is full: the last timeline shown to the
+    curr user, without counters, like summaries or live updates."""
+
+    message_ids = cache.peek(last_timeline_key(g.user.id, ranked)) or []
+    found = sharding.visible_messages(message_ids)
+    messages = filters.drop_hidden((found[msg_id] for msg_id in message_ids if msg_id in found),
+                                   viewer_hidden_ids(), key=lambda msg: msg.user_id)
+
+    return render_template('home.html', messages=messages,
+                           likes=viewer_liked_ids(message_ids),
+                           like_summaries={}, rewarbled=set(), rewarbled_by={}, seen_by={},
+                           stats={'messages': None, 'following': None, 'followers': None},
+                           feed_unavailable=not messages, degraded=True,
+                           live_cursor=None, trending={}, ranked=ranked)
+
+
 @app.route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, or with
+      ?feed=top the 100 best-ranked from their network (see ranking.py)
+
+    The feed and the sidebar counters are read concurrently, then the likes
+    on the feed; any section that's too slow is left out of the page. Under
+    overload it's served degraded instead (see admission.py).
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        
-        liked_message_ids = [like.id for like in g.user.likes]
-
-        return render_template('home.html', messages=messages, likes=liked_message_ids)
+        ranked = request.args.get('feed') == 'top'
+        if admission.degraded():
+            return degraded_homepage(ranked)
+
+        following_ids = viewer_following_ids()
+        # Muted and blocked authors come off the IN lists, not the queries.
+        hidden = viewer_hidden_ids()
+
+        if ranked:
+            second_degree = [user_id for user_id, _ in get_follow_graph().suggestions(
+                g.user.id, limit=ranking.SECOND_DEGREE_AUTHORS)]
+            feed = Section(ranking.ranked_feed,
+                           [g.user.id, set(filters.without(following_ids, hidden)),
+                            filters.without(second_degree, hidden)],
+                           fallback=[])
+        else:
+            feed = Section(home_feed, [filters.without(following_ids | {g.user.id}, hidden)],
+                           fallback=[])
+
+        sections, failed = assembly.gather(app, {
+            'messages': feed,
+            'message_count': Section(message_count, [g.user.id]),
+            'follower_count': Section(follower_count, [g.user.id]),
+        })
+        # Re-warbles can bring in warbles by hidden authors.
+        messages = filters.drop_hidden(sections['messages'], hidden, key=lambda msg: msg.user_id)
+        message_ids = [msg.id for msg in messages]
+        if 'messages' not in failed:
+            cache.put(last_timeline_key(g.user.id, ranked), (), message_ids,
+                      ttl=LAST_TIMELINE_TTL)
+        view_counter.record(g.user.id, [msg.id for msg in messages if msg.user_id != g.user.id])
+
+        on_feed, _ = assembly.gather(app, {
+            'liked_ids': Section(sharding.liked_ids, [g.user.id, message_ids], fallback=set()),
+            'like_summaries': Section(sharding.like_summaries, [message_ids, following_ids],
+                                      fallback={}),
+            'rewarbled_ids': Section(Rewarbles.rewarbled_ids, [g.user.id, message_ids],
+                                     fallback=set()),
+            'rewarbled_by': Section(Rewarbles.summaries, [message_ids, following_ids],
+                                    fallback={}),
+            'seen_by': Section(view_counter.seen_by, [message_ids], fallback={}),
+        })
+        liked_message_ids = apply_pending('like', on_feed['liked_ids']) & set(message_ids)
+
+        stats = {
+            'messages': sections['message_count'],
+            'following': len(following_ids),
+            'followers': sections['follower_count'],
+        }
+        # New warbles only stream into the chronological feed, after the
+        # newest original in it (the first may be an older re-warble).
+        live_cursor = None
+        if messages and not ranked:
+            live_cursor = api.message_cursor(max(messages, key=lambda msg: (msg.timestamp, msg.id)))
+        trending_terms = {window: trending.top(window) for window in trending.windows}
+
+        return render_template('home.html', messages=messages, likes=liked_message_ids,
+                               like_summaries=on_feed['like_summaries'],
+                               rewarbled=on_feed['rewarbled_ids'],
+                               rewarbled_by=on_feed['rewarbled_by'],
+                               seen_by=on_feed['seen_by'], stats=stats,
+                               feed_unavailable='messages' in failed,
+                               live_cursor=live_cursor, trending=trending_terms,
+                               ranked=ranked)
 
     else:
         return render_template('home-anon.html')
@@ -407,10 +1737,24 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
+@app.after_request
+def remember_last_write(response):
+    """Keep the id of the newest outbox event the curr user's request made
+    in their session (see `waiting_on_own_write`)."""
+
+    newest = db.session.info.pop('outbox_newest', None)
+    if newest and g.get('user'):
+        session[LAST_WRITE_KEY] = newest
+    return response
+
+
 @app.after_request
 def add_header(req):
     """Add non-caching headers on every request."""
 
+    # Except on responses that can be cached forever (media variants).
+    if req.cache_control.immutable:
+        return req
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
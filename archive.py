@@ -0,0 +1,377 @@
+"""Cold archive of old messages.
+
+Timelines and profiles only ever read the last few weeks of ``messages``,
+but the table (and its indexes) grow forever. The archive job moves whole
+months older than ARCHIVE_AFTER out of the table into immutable segment
+files, so the hot table, and every index scan on it, stays the size of the
+recent months.
+
+This stands in for native monthly partitioning. On Postgres every unique
+key of a partitioned table must include the partition key, so
+``message_views`` and the notification tables could no longer reference
+``messages.id``. Routing to a table per month on SQLite would take the
+ORM mapping away from every query. Here the hot table keeps its schema,
+and the monthly cut happens in the archive.
+
+A segment holds up to SEGMENT_ROWS messages of one month, sorted by id,
+stored column by column: ids (delta-encoded), authors, timestamps (µs),
+like counts and text, each compressed with zlib. Its header records the
+row count and the id and timestamp ranges, so a lookup opens only the
+segments that can match. Decompressed segments are kept in a small LRU.
+
+Archived messages are read-only. Their likes and re-warbles are other
+users' data, so they stay where they are (neither table has a foreign key
+to ``messages``), and a segment also keeps each message's like count as
+of archiving. What else refers to the message goes with it: view counts
+(``message_views``) and notification events and groups about it. Archive
+only months old enough that nobody misses those. With sharding on, the
+messages are read from and deleted on the shards (their likes stay there
+too).
+
+``messages_show``, the liked pages, the ``/api/v1/users/<id>/messages``
+pagination and exports read through to the archive. Purging a deleted
+account drops the likes and re-warbles of its archived messages, then
+rewrites the segments that hold them.
+
+Archive by hand (or from cron) like:
+
+    python archive.py run
+"""
+
+import os
+import sys
+import zlib
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from threading import Lock
+
+import numpy as np
+from sqlalchemy import delete, func, select
+
+from flask import current_app
+
+import sharding
+from models import (db, Likes, Message, MessageViews, NotificationEvent,
+                    NotificationGroup, User)
+
+MAGIC = b'WMA1'
+COLUMNS = ('ids', 'user_ids', 'timestamps', 'likes', 'text_ends', 'text')
+HEADER = np.dtype([('magic', 'S4'), ('rows', '<i4'),
+                   ('min_id', '<i8'), ('max_id', '<i8'),
+                   ('min_ts', '<i8'), ('max_ts', '<i8'),
+                   ('lengths', '<i8', (len(COLUMNS),))])
+SUFFIX = '.wma'
+
+ARCHIVE_AFTER = timedelta(days=180)
+SEGMENT_ROWS = 10000
+
+# How many decompressed segments to keep in memory.
+CACHE_SEGMENTS = 8
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class ArchivedMessage(namedtuple('ArchivedMessage', 'id text timestamp user_id likes user',
+                                 defaults=(None,))):
+    """A message read from the archive; `user` is filled in by the caller."""
+
+    archived = True
+
+
+_Columns = namedtuple('_Columns', COLUMNS)
+
+
+def _micros(timestamp):
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def _datetime(micros):
+    return EPOCH + timedelta(microseconds=int(micros))
+
+
+def month_start(timestamp):
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(start):
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+class Segment(namedtuple('Segment', 'path rows min_id max_id min_ts max_ts lengths')):
+    """A segment file's header."""
+
+    @classmethod
+    def open(cls, path):
+        header = np.fromfile(path, dtype=HEADER, count=1)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError(f"{path} is not a message archive segment")
+        return cls(path, int(header['rows']), int(header['min_id']), int(header['max_id']),
+                   int(header['min_ts']), int(header['max_ts']),
+                   tuple(int(n) for n in header['lengths']))
+
+    def read(self):
+        """The segment's decompressed _Columns."""
+
+        with open(self.path, 'rb') as f:
+            f.seek(HEADER.itemsize)
+            raw = [zlib.decompress(f.read(length)) for length in self.lengths]
+        return _Columns(
+            np.cumsum(np.frombuffer(raw[0], dtype='<i8')),
+            np.frombuffer(raw[1], dtype='<i4'),
+            np.frombuffer(raw[2], dtype='<i8') + self.min_ts,
+            np.frombuffer(raw[3], dtype='<i4'),
+            np.frombuffer(raw[4], dtype='<i8'),
+            raw[5])
+
+
+def write_segment(path, rows):
+    """Write (id, user_id, timestamp, likes, text) rows to a segment at `path`."""
+
+    rows = sorted(rows)
+    ids = np.array([row[0] for row in rows], dtype='<i8')
+    timestamps = np.array([_micros(row[2]) for row in rows], dtype='<i8')
+    texts = [row[4].encode() for row in rows]
+    min_ts = int(timestamps.min())
+
+    columns = [
+        np.diff(ids, prepend=0).astype('<i8').tobytes(),
+        np.array([row[1] for row in rows], dtype='<i4').tobytes(),
+        (timestamps - min_ts).astype('<i8').tobytes(),
+        np.array([row[3] for row in rows], dtype='<i4').tobytes(),
+        np.cumsum([len(text) for text in texts], dtype='<i8').tobytes(),
+        b''.join(texts),
+    ]
+    compressed = [zlib.compress(column, 6) for column in columns]
+    header = np.array([(MAGIC, len(rows), ids[0], ids[-1], min_ts, int(timestamps.max()),
+                        [len(data) for data in compressed])], dtype=HEADER)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(header.tobytes())
+        for data in compressed:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Archive:
+    """The segment files in `directory`."""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._listed = None
+        self._segments = []
+        self._columns = OrderedDict()
+        self._lock = Lock()
+
+    def segments(self):
+        """Headers of every segment, oldest first (re-listed when the
+        directory changes)."""
+
+        mtime = os.stat(self.directory).st_mtime_ns
+        with self._lock:
+            if mtime != self._listed:
+                self._segments = sorted(
+                    (Segment.open(os.path.join(self.directory, name))
+                     for name in os.listdir(self.directory) if name.endswith(SUFFIX)),
+                    key=lambda segment: (segment.min_ts, segment.min_id))
+                self._listed = mtime
+            return list(self._segments)
+
+    def _read(self, segment):
+        with self._lock:
+            if segment in self._columns:
+                self._columns.move_to_end(segment)
+                return self._columns[segment]
+        columns = segment.read()
+        with self._lock:
+            self._columns[segment] = columns
+            if len(self._columns) > CACHE_SEGMENTS:
+                self._columns.popitem(last=False)
+        return columns
+
+    @staticmethod
+    def _row(columns, i):
+        start = int(columns.text_ends[i - 1]) if i else 0
+        return ArchivedMessage(int(columns.ids[i]),
+                               columns.text[start:int(columns.text_ends[i])].decode(),
+                               _datetime(columns.timestamps[i]),
+                               int(columns.user_ids[i]),
+                               int(columns.likes[i]))
+
+    def get(self, message_id):
+        """The ArchivedMessage with `message_id`, or None."""
+
+        for segment in self.segments():
+            if segment.min_id <= message_id <= segment.max_id:
+                columns = self._read(segment)
+                i = int(np.searchsorted(columns.ids, message_id))
+                if i < segment.rows and columns.ids[i] == message_id:
+                    return self._row(columns, i)
+        return None
+
+    def user_messages(self, user_id, before=None, limit=20):
+        """`user_id`'s newest ArchivedMessages older than the (timestamp, id)
+        key `before`, newest first."""
+
+        before_ts, before_id = ((_micros(before[0]), before[1]) if before
+                                else (np.iinfo(np.int64).max, 0))
+        found = []
+        for segment in sorted(self.segments(), key=lambda s: s.max_ts, reverse=True):
+            if segment.min_ts > before_ts:
+                continue
+            # Segments from here on are all older than what we have.
+            if len(found) >= limit and segment.max_ts < found[limit - 1][0]:
+                break
+            columns = self._read(segment)
+            ts = columns.timestamps
+            match = (columns.user_ids == user_id) & (
+                (ts < before_ts) | ((ts == before_ts) & (columns.ids < before_id)))
+            for i in np.flatnonzero(match):
+                found.append((int(ts[i]), int(columns.ids[i]), segment, int(i)))
+            found.sort(key=lambda item: (item[0], item[1]), reverse=True)
+
+        return [self._row(self._read(segment), i) for _, _, segment, i in found[:limit]]
+
+    def iter_user(self, user_id):
+        """Every ArchivedMessage of `user_id`, oldest segment first."""
+
+        for segment in self.segments():
+            columns = self._read(segment)
+            for i in np.flatnonzero(columns.user_ids == user_id):
+                yield self._row(columns, int(i))
+
+    def _first_holding(self, user_id):
+        """(segment, its columns) of the first segment with `user_id`'s
+        messages, or (None, None)."""
+
+        for segment in self.segments():
+            columns = self._read(segment)
+            if (columns.user_ids == user_id).any():
+                return segment, columns
+        return None, None
+
+    def purge_ids(self, user_id):
+        """Ids of the `user_id` messages the next `purge_user` removes."""
+
+        _, columns = self._first_holding(user_id)
+        if columns is None:
+            return []
+        return columns.ids[columns.user_ids == user_id].tolist()
+
+    def purge_user(self, user_id):
+        """Rewrite the first segment holding `user_id`'s messages without
+        them; returns how many were removed (0 once there are none)."""
+
+        segment, columns = self._first_holding(user_id)
+        if segment is None:
+            return 0
+        keep = columns.user_ids != user_id
+        rows = [self._row(columns, int(i)) for i in np.flatnonzero(keep)]
+        if rows:
+            write_segment(segment.path,
+                          [(r.id, r.user_id, r.timestamp, r.likes, r.text) for r in rows])
+        else:
+            os.remove(segment.path)
+        return int((~keep).sum())
+
+    def archive_old(self, older_than=ARCHIVE_AFTER, now=None, chunk=SEGMENT_ROWS):
+        """Move visible messages of whole months older than `older_than`
+        into segments (in app context); returns how many were moved.
+
+        Each chunk is written to its segment before its rows are deleted. A
+        run interrupted in between rewrites the same segment (it's named by
+        month and first id), so nothing is archived twice.
+        """
+
+        cutoff = month_start((now or datetime.utcnow()) - older_than)
+        router = current_app.extensions.get('shard_router')
+        moved = 0
+        while True:
+            if router:
+                oldest = router.oldest_before(cutoff, excluded=sharding.deleted_user_ids())
+            else:
+                oldest = db.session.scalar(
+                    select(func.min(Message.timestamp))
+                    .join(User, User.id == Message.user_id)
+                    .where(Message.timestamp < cutoff,
+                           Message.deleted_at.is_(None),
+                           User.deleted_at.is_(None)))
+            if oldest is None:
+                return moved
+            start = month_start(oldest)
+            moved += self._archive_chunk(start, next_month(start), chunk)
+
+    def _archive_chunk(self, start, end, chunk):
+        router = current_app.extensions.get('shard_router')
+        if router:
+            return self._archive_shard_chunk(router, start, end, chunk)
+
+        rows = db.session.execute(
+            select(Message.id, Message.user_id, Message.timestamp, Message.text)
+            .join(User, User.id == Message.user_id)
+            .where(Message.timestamp >= start,
+                   Message.timestamp < end,
+                   Message.deleted_at.is_(None),
+                   User.deleted_at.is_(None))
+            .order_by(Message.id)
+            .limit(chunk)).all()
+        ids = [row.id for row in rows]
+        # Count only this chunk's likes, not group the whole table.
+        like_counts = dict(db.session.execute(
+            select(Likes.message_id, func.count())
+            .where(Likes.message_id.in_(ids))
+            .group_by(Likes.message_id)).all())
+
+        path = os.path.join(self.directory, f"{start:%Y-%m}-{ids[0]}{SUFFIX}")
+        write_segment(path, [(row.id, row.user_id, row.timestamp,
+                              like_counts.get(row.id, 0), row.text)
+                             for row in rows])
+
+        _drop_references(ids)
+        messages = Message.__table__
+        db.session.execute(delete(messages).where(messages.c.id.in_(ids)))
+        db.session.commit()
+        return len(rows)
+
+    def _archive_shard_chunk(self, router, start, end, chunk):
+        """_archive_chunk, for messages that live on the shards."""
+
+        rows = router.messages_between(start, end, chunk, excluded=sharding.deleted_user_ids())
+        like_counts = router.like_counts([row.id for row in rows])
+
+        path = os.path.join(self.directory, f"{start:%Y-%m}-{rows[0].id}{SUFFIX}")
+        write_segment(path, [(row.id, row.user_id, row.timestamp,
+                              like_counts.get(row.id, 0), row.text)
+                             for row in rows])
+
+        _drop_references([row.id for row in rows])
+        db.session.commit()
+
+        by_author = {}
+        for row in rows:
+            by_author.setdefault(row.user_id, []).append(row.id)
+        router.drop_archived(by_author)
+        return len(rows)
+
+
+def _drop_references(message_ids):
+    """Delete the view counts and notifications about `message_ids`."""
+
+    for model in (MessageViews, NotificationEvent, NotificationGroup):
+        table = model.__table__
+        db.session.execute(delete(table).where(table.c.message_id.in_(message_ids)))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['run']:
+        sys.exit(__doc__)
+
+    from app import app, archive
+
+    if archive is None:
+        sys.exit("Set MESSAGE_ARCHIVE_DIR to archive messages.")
+    with app.app_context():
+        print(f"Archived {archive.archive_old(app.config['ARCHIVE_AFTER'])} messages.")
@@ -0,0 +1,12 @@
+"""ASGI entry point for live timeline streams (see live.py).
+
+Run it next to the Flask app like:
+
+    LIVE_BACKEND=postgres uvicorn asgi:app --port 5001
+"""
+
+from app import app as flask_app, hub, CURR_USER_KEY
+from live import asgi_app
+from models import Follows
+
+app = asgi_app(flask_app, hub, Follows.followed_ids, CURR_USER_KEY)
@@ -0,0 +1,88 @@
+"""Concurrent assembly of page sections.
+
+A page made of independent reads (the feed, the sidebar counters, ...)
+shouldn't pay for them one after another. `gather` runs each section in a
+shared thread pool, inside its own app context, so each gets its own
+session and pooled connection and the reads overlap in the database; the
+page then waits roughly as long as its slowest section instead of the sum.
+
+Every section has a timeout and a fallback. A section that is too slow or
+fails is logged and replaced by its fallback, so the page degrades (e.g.
+hides a counter) instead of erroring. On Postgres the section's statement
+is also given a matching ``statement_timeout``, so the abandoned query
+doesn't keep the connection busy.
+"""
+
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy import text
+
+from models import db
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 2.0
+DEFAULT_WORKERS = 8
+
+_pool = None
+_pool_lock = Lock()
+
+
+class Section(namedtuple('Section', 'func args fallback timeout')):
+    """`func(*args)`, or `fallback` if it takes longer than `timeout` secs."""
+
+    def __new__(cls, func, args=(), fallback=None, timeout=None):
+        return super().__new__(cls, func, tuple(args), fallback, timeout)
+
+
+def pool(app):
+    """The shared section pool, sized by PAGE_SECTION_WORKERS."""
+
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=app.config.get('PAGE_SECTION_WORKERS', DEFAULT_WORKERS),
+                thread_name_prefix='page-section')
+    return _pool
+
+
+def _run(app, section, timeout):
+    with app.app_context():
+        if db.session.get_bind().dialect.name == 'postgresql':
+            db.session.execute(
+                text(f"SET LOCAL statement_timeout = {int(timeout * 1000)}"))
+        # Leaving the context closes the session, which detaches (but keeps
+        # loaded) whatever the section returns.
+        return section.func(*section.args)
+
+
+def gather(app, sections):
+    """Run {name: Section} concurrently; return ({name: result}, failed names).
+
+    Sections without their own timeout get PAGE_SECTION_TIMEOUT.
+    """
+
+    default_timeout = app.config.get('PAGE_SECTION_TIMEOUT', DEFAULT_TIMEOUT)
+    start = monotonic()
+
+    futures = {}
+    for name, section in sections.items():
+        timeout = section.timeout or default_timeout
+        futures[name] = (pool(app).submit(_run, app, section, timeout), timeout)
+
+    results = {}
+    failed = set()
+    for name, (future, timeout) in futures.items():
+        try:
+            results[name] = future.result(max(0, start + timeout - monotonic()))
+        except Exception:
+            future.cancel()
+            log.warning("Page section %r failed or timed out", name, exc_info=True)
+            results[name] = sections[name].fallback
+            failed.add(name)
+    return results, failed
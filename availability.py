@@ -0,0 +1,167 @@
+"""Username/email availability, checked before anything is hashed.
+
+Signing up bcrypt-hashes the password, by far the most expensive thing we
+do, so a taken username shouldn't get that far. Every username and email
+in the users table is kept in a Bloom filter: a bit array where each item
+sets a few hashed bits. An item whose bits aren't all set was never added,
+so most available names are answered from memory; the rest (taken names
+and ~1% false positives) are settled by an indexed lookup.
+
+Each worker builds its filter on first use and adds the names it sees
+signed up or changed. Before answering "available" for a signup it also
+catches up on users created by other workers since (``id >`` the highest
+id it has seen); ``/users/available`` does so at most every CATCH_UP
+seconds. A username changed by another worker's ``edit_profile`` isn't
+caught up on, so signup still handles the IntegrityError.
+"""
+
+import hashlib
+import math
+import time
+from threading import Lock
+
+import numpy as np
+from sqlalchemy import func, or_, select
+
+from models import db, User
+
+ERROR_RATE = 0.01
+MIN_CAPACITY = 10000
+CATCH_UP = 1.0
+
+FIELDS = ('username', 'email')
+
+
+class BloomFilter:
+    """Set membership with no false negatives and ~`error_rate` false
+    positives, for up to `capacity` items."""
+
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self.count = 0
+
+    def _positions(self, items):
+        """Bit positions of each of `items`, shape (len(items), hashes)."""
+
+        h1 = np.empty(len(items), dtype=np.int64)
+        h2 = np.empty(len(items), dtype=np.int64)
+        for row, item in enumerate(items):
+            digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+            h1[row] = int.from_bytes(digest[:8], 'little') % self.size
+            h2[row] = int.from_bytes(digest[8:], 'little') % (self.size - 1) + 1
+        return (h1[:, None] + np.arange(self.hashes) * h2[:, None]) % self.size
+
+    def add_many(self, items):
+        items = list(items)
+        if not items:
+            return
+        positions = self._positions(items).ravel()
+        np.bitwise_or.at(self.bits, positions >> 3,
+                         np.left_shift(1, positions & 7).astype(np.uint8))
+        self.count += len(items)
+
+    def add(self, item):
+        self.add_many([item])
+
+    def __contains__(self, item):
+        positions = self._positions([item])[0]
+        return bool(((self.bits[positions >> 3] >> (positions & 7)) & 1).all())
+
+
+def _items(username, email):
+    return [f"username:{username}", f"email:{email}"]
+
+
+class Availability:
+    """Which usernames and emails are taken."""
+
+    def __init__(self, error_rate=ERROR_RATE):
+        self.error_rate = error_rate
+        self.filter = None
+        self.watermark = 0
+        self.caught_up = 0.0
+        self._lock = Lock()
+
+    def rebuild(self, chunk=10000):
+        """Build the filter from the users table (in app context)."""
+
+        total = db.session.scalar(select(func.count()).select_from(User))
+        bloom = BloomFilter(max(MIN_CAPACITY, 2 * total), self.error_rate)
+        watermark = self._load(bloom, select(User.id, User.username, User.email)
+                               .execution_options(yield_per=chunk), chunk)
+        with self._lock:
+            self.filter, self.watermark = bloom, watermark
+            self.caught_up = time.monotonic()
+        return bloom
+
+    @staticmethod
+    def _load(bloom, query, chunk=10000):
+        """Add the (id, username, email) rows of `query`; returns the top id."""
+
+        watermark = 0
+        items = []
+        for user_id, username, email in db.session.execute(query):
+            items.extend(_items(username, email))
+            watermark = max(watermark, user_id)
+            if len(items) >= chunk:
+                bloom.add_many(items)
+                items = []
+        bloom.add_many(items)
+        return watermark
+
+    def catch_up(self, bloom):
+        """Add users created (by any worker) since the filter last looked."""
+
+        # Under the lock: two threads setting bits in the same byte at once
+        # could lose one.
+        with self._lock:
+            newest = self._load(bloom, select(User.id, User.username, User.email)
+                                .where(User.id > self.watermark))
+            self.watermark = max(self.watermark, newest)
+            self.caught_up = time.monotonic()
+
+    def add(self, username, email):
+        """Note a username and email just taken (signup or profile edit)."""
+
+        with self._lock:
+            if self.filter is None:
+                return
+            self.filter.add_many(_items(username, email))
+            # Past capacity the error rate climbs; start over, bigger.
+            if self.filter.count > self.filter.capacity:
+                self.filter = None
+
+    @staticmethod
+    def _maybe_taken(bloom, asked):
+        return {field for field, value in asked.items()
+                if f"{field}:{value}" in bloom}
+
+    def taken(self, username=None, email=None, strict=False):
+        """The fields of `username`/`email` that are already in use.
+
+        With `strict`, users created by other workers are always caught up
+        on first; otherwise at most every CATCH_UP seconds.
+        """
+
+        asked = {field: value for field, value in zip(FIELDS, (username, email)) if value}
+        if not asked:
+            return set()
+        bloom = self.filter or self.rebuild()
+
+        maybe = self._maybe_taken(bloom, asked)
+        if len(maybe) < len(asked) and (
+                strict or time.monotonic() - self.caught_up > CATCH_UP):
+            self.catch_up(bloom)
+            maybe = self._maybe_taken(bloom, asked)
+        if not maybe:
+            return set()
+
+        columns = {'username': User.username, 'email': User.email}
+        rows = db.session.execute(
+            select(User.username, User.email)
+            .where(or_(*(columns[field] == asked[field] for field in maybe)))).all()
+        return {field for field in maybe
+                for row in rows if getattr(row, field) == asked[field]}
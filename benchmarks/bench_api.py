@@ -0,0 +1,89 @@
+"""Benchmark the JSON API against the HTML pages it replaces for clients.
+
+For the timeline and a user's messages, compares bytes on the wire and
+server CPU time per page of the HTML route and the /api/v1 route.
+
+Run like:
+
+    python benchmarks/bench_api.py
+
+By default this uses a throwaway in-memory SQLite database; set DATABASE_URL
+to benchmark against Postgres (its tables are dropped and recreated!).
+"""
+
+import os
+import sys
+from time import process_time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows
+
+USERS = 50
+MESSAGES_PER_USER = 40
+ROUNDS = 50
+
+
+def setup():
+    """A viewer who follows USERS authors with MESSAGES_PER_USER each."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(db.insert(User), [
+        dict(username=f"user{i}", email=f"user{i}@test.com", password="x",
+             image_url="/static/images/default-pic.png",
+             header_image_url="/static/images/warbler-hero.jpg")
+        for i in range(USERS + 1)
+    ])
+    ids = db.session.execute(db.select(User.id).order_by(User.id)).scalars().all()
+    viewer, authors = ids[0], ids[1:]
+
+    db.session.execute(db.insert(Message), [
+        dict(text="Lorem ipsum dolor sit amet, consectetur adipiscing elit " * 2,
+             user_id=author)
+        for author in authors for _ in range(MESSAGES_PER_USER)
+    ])
+    db.session.execute(db.insert(Follows), [
+        dict(user_following_id=viewer, user_being_followed_id=author)
+        for author in authors
+    ])
+    db.session.commit()
+    return viewer, authors[0]
+
+
+def measure(client, url):
+    """(bytes, CPU ms) per request for `url`."""
+
+    size = len(client.get(url).data)
+    start = process_time()
+    for _ in range(ROUNDS):
+        client.get(url)
+    return size, (process_time() - start) * 1000 / ROUNDS
+
+
+if __name__ == '__main__':
+    app.config['TESTING'] = True
+    # Keep the per-request "Logged in as" prints out of the timings.
+    sys.stdout, stdout = open(os.devnull, 'w'), sys.stdout
+
+    with app.app_context():
+        viewer, author = setup()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = viewer
+
+    pages = [
+        ("timeline", "/", "/api/v1/timeline?limit=100"),
+        ("user messages", f"/users/{author}", f"/api/v1/users/{author}/messages?limit=100"),
+    ]
+    results = [(name, measure(client, html), measure(client, json))
+               for name, html, json in pages]
+
+    sys.stdout = stdout
+    print(f"{'page':<15} {'html bytes':>10} {'json bytes':>10} {'html ms':>8} {'json ms':>8}")
+    for name, (html_size, html_ms), (json_size, json_ms) in results:
+        print(f"{name:<15} {html_size:>10} {json_size:>10} {html_ms:>8.2f} {json_ms:>8.2f}")
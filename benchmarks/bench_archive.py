@@ -0,0 +1,91 @@
+"""Benchmark hot queries as the messages table grows, before and after
+archiving its old months.
+
+Fills the table with MONTHS months of messages from USERS authors, then
+times the first page of one author's messages and the newest messages of
+everyone, with the whole history in the table and again once everything
+older than ARCHIVE_AFTER has been moved to the archive.
+
+Run like:
+
+    python benchmarks/bench_archive.py
+
+By default this uses a throwaway in-memory SQLite database; set DATABASE_URL
+to benchmark against Postgres (its tables are dropped and recreated!).
+"""
+
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import app
+from archive import Archive, ARCHIVE_AFTER
+import api
+from models import db, User, Message
+
+USERS = 200
+MONTHS = 24
+TOTALS = (20000, 100000, 300000)
+ROUNDS = 200
+
+
+def setup(total):
+    """`total` messages spread evenly over the last MONTHS months."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(db.insert(User), [
+        dict(username=f"user{i}", email=f"user{i}@test.com", password="x")
+        for i in range(USERS)
+    ])
+    ids = db.session.execute(db.select(User.id).order_by(User.id)).scalars().all()
+
+    now = datetime.utcnow()
+    step = timedelta(days=30 * MONTHS) / total
+    for start in range(0, total, 10000):
+        db.session.execute(db.insert(Message), [
+            dict(text="Lorem ipsum dolor sit amet, consectetur adipiscing elit",
+                 user_id=ids[i % USERS], timestamp=now - step * (total - i))
+            for i in range(start, min(start + 10000, total))
+        ])
+    db.session.commit()
+    return ids[0]
+
+
+def measure(query):
+    """Mean ms per call of `query`."""
+
+    query()
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        query()
+    return (perf_counter() - start) * 1000 / ROUNDS
+
+
+def timings(author):
+    return (measure(lambda: api.message_page(Message.user_id == author)),
+            measure(lambda: api.message_page()))
+
+
+if __name__ == '__main__':
+    print(f"{'messages':>9} {'hot rows':>9} {'profile ms':>11} {'':>7} "
+          f"{'recent ms':>10} {'':>7}")
+    print(f"{'':>9} {'':>9} {'before':>11} {'after':>7} {'before':>10} {'after':>7}")
+
+    for total in TOTALS:
+        with app.app_context(), tempfile.TemporaryDirectory() as directory:
+            author = setup(total)
+            profile_before, recent_before = timings(author)
+
+            Archive(directory).archive_old(ARCHIVE_AFTER)
+            hot = db.session.scalar(db.select(db.func.count()).select_from(Message))
+            profile_after, recent_after = timings(author)
+
+        print(f"{total:>9} {hot:>9} {profile_before:>11.2f} {profile_after:>7.2f} "
+              f"{recent_before:>10.2f} {recent_after:>7.2f}")
@@ -0,0 +1,87 @@
+"""Benchmark like/follow write paths as the user's collections grow.
+
+Compares the old ORM collection paths (``g.user.likes.append(...)``,
+``message in g.user.likes``), which load the whole collection, with the
+direct edge operations (``Likes.add``/``Likes.remove``), which don't.
+
+Run like:
+
+    python benchmarks/bench_edges.py
+
+By default this uses a throwaway in-memory SQLite database; set DATABASE_URL
+to benchmark against Postgres (its tables are dropped and recreated!).
+"""
+
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import app
+from models import db, User, Message, Likes
+
+SIZES = [100, 1000, 10000, 50000]
+ROUNDS = 20
+
+
+def timed(fn):
+    """Average seconds per call of `fn` over ROUNDS rounds."""
+
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        fn()
+        db.session.commit()
+        db.session.expire_all()
+    return (perf_counter() - start) / ROUNDS
+
+
+def setup(size):
+    """A liker with `size` existing likes and one more message to like."""
+
+    db.drop_all()
+    db.create_all()
+
+    author = User(username="author", email="a@a.com", password="x")
+    liker = User(username="liker", email="l@l.com", password="x")
+    db.session.add_all([author, liker])
+    db.session.commit()
+
+    db.session.execute(db.insert(Message), [
+        dict(text="warble", user_id=author.id) for _ in range(size + 1)
+    ])
+    ids = db.session.execute(db.select(Message.id)).scalars().all()
+    db.session.execute(db.insert(Likes), [
+        dict(user_id=liker.id, message_id=mid) for mid in ids[:-1]
+    ])
+    db.session.commit()
+
+    return liker.id, ids[-1]
+
+
+def orm_like_unlike(liker_id, message_id):
+    user = db.session.get(User, liker_id)
+    message = db.session.get(Message, message_id)
+    if message in user.likes:
+        user.likes.remove(message)
+    else:
+        user.likes.append(message)
+
+
+def edge_like_unlike(liker_id, message_id):
+    if Likes.liked_ids(liker_id, [message_id]):
+        Likes.remove(liker_id, message_id)
+    else:
+        Likes.add(liker_id, message_id)
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        print(f"{'likes':>8} {'orm ms':>10} {'edge ms':>10}")
+        for size in SIZES:
+            liker_id, message_id = setup(size)
+            orm = timed(lambda: orm_like_unlike(liker_id, message_id))
+            edge = timed(lambda: edge_like_unlike(liker_id, message_id))
+            print(f"{size:>8} {orm * 1000:>10.2f} {edge * 1000:>10.2f}")
+        db.drop_all()
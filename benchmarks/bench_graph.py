@@ -0,0 +1,88 @@
+"""Benchmark "who to follow" and "followers you know" on the follow graph.
+
+Builds a random graph where popular accounts attract most follows, then
+times FollowGraph.suggestions against the same friends-of-friends count done
+over Python dicts of sets, the shape the ORM relationships would give us at
+best, and FollowGraph.known_followers on the most-followed account against
+intersecting Python lists.
+
+Run like:
+
+    python benchmarks/bench_graph.py
+"""
+
+import os
+import sys
+from collections import Counter
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from graph import FollowGraph
+
+USERS = 200_000
+FOLLOWS_PER_USER = 50
+VIEWERS = 200
+
+
+def random_edges(rng):
+    followers = np.repeat(np.arange(1, USERS + 1, dtype=np.int32), FOLLOWS_PER_USER)
+    # Zipf-ish popularity: low ids get followed far more often.
+    followed = (rng.pareto(1.2, len(followers)) * 50).astype(np.int64) % USERS + 1
+    keep = followers != followed
+    pairs = np.unique(np.stack([followers[keep], followed[keep]], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1].astype(np.int32)
+
+
+def naive_suggestions(following, user_id, limit=10):
+    counts = Counter()
+    for followed_id in following.get(user_id, ()):
+        counts.update(following.get(followed_id, ()))
+    mine = following.get(user_id, set())
+    ranked = sorted((-n, candidate) for candidate, n in counts.items()
+                    if candidate != user_id and candidate not in mine)
+    return [(candidate, -n) for n, candidate in ranked[:limit]]
+
+
+def per_call_ms(func, viewers):
+    start = perf_counter()
+    for viewer in viewers:
+        func(int(viewer))
+    return (perf_counter() - start) * 1000 / len(viewers)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    followers, followed = random_edges(rng)
+    viewers = rng.integers(1, USERS + 1, VIEWERS)
+
+    start = perf_counter()
+    graph = FollowGraph.from_edges(followers, followed)
+    build_s = perf_counter() - start
+
+    following = {}
+    for follower_id, followed_id in zip(followers.tolist(), followed.tolist()):
+        following.setdefault(follower_id, set()).add(followed_id)
+
+    csr_ms = per_call_ms(graph.suggestions, viewers)
+    naive_ms = per_call_ms(lambda viewer: naive_suggestions(following, viewer), viewers)
+
+    star = int(np.bincount(followed).argmax())
+    star_followers = graph.followers(star).tolist()
+    known_ms = per_call_ms(lambda viewer: graph.known_followers(viewer, star), viewers)
+    list_ms = per_call_ms(
+        lambda viewer: [f for f in following.get(viewer, ()) if f in star_followers],
+        viewers[:10])
+
+    assert ([n for _, n in graph.suggestions(int(viewers[0]))]
+            == [n for _, n in naive_suggestions(following, int(viewers[0]))])
+
+    size_mb = sum(adjacency.indptr.nbytes + adjacency.indices.nbytes
+                  for adjacency in (graph._following, graph._followers)) / 2**20
+    print(f"{len(graph.indices)} follows, {USERS} users: CSR is {size_mb:.1f}MB, "
+          f"built in {build_s:.2f}s")
+    print(f"suggestions  CSR: {csr_ms:.2f} ms   dict of sets: {naive_ms:.2f} ms")
+    print(f"followers you know ({len(star_followers)} followers)  "
+          f"CSR: {known_ms:.3f} ms   lists: {list_ms:.2f} ms")
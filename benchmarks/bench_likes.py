@@ -0,0 +1,121 @@
+"""Benchmark a user's liked-warbles page for light and heavy likers.
+
+Each liker has liked LIKES warbles by AUTHORS different authors. The first
+page and a page deep in their likes (followed by its "Older" cursor) are
+timed, and their SQL statements counted. The times should stay flat as
+LIKES grows.
+
+Run like:
+
+    python benchmarks/bench_likes.py
+
+By default this uses a throwaway in-memory SQLite database; set DATABASE_URL
+to benchmark against Postgres (its tables are dropped and recreated!).
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import event
+
+import app as app_module
+from app import app
+from models import db, User, Message, Likes
+
+AUTHORS = 200
+LIKES = (100, 10_000, 100_000)
+ROUNDS = 50
+
+
+def setup():
+    """{likes: liker id}, for a liker with each number of LIKES."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(db.insert(User), [
+        dict(username=f"user{i}", email=f"user{i}@test.com", password="x",
+             image_url="/static/images/default-pic.png",
+             header_image_url="/static/images/warbler-hero.jpg")
+        for i in range(AUTHORS + len(LIKES))
+    ])
+    ids = db.session.execute(db.select(User.id).order_by(User.id)).scalars().all()
+    authors, likers = ids[:AUTHORS], ids[AUTHORS:]
+
+    now = datetime.utcnow()
+    db.session.execute(db.insert(Message), [
+        dict(text="Lorem ipsum dolor sit amet, consectetur adipiscing elit",
+             user_id=authors[n % AUTHORS], timestamp=now - timedelta(seconds=n))
+        for n in range(max(LIKES))
+    ])
+    message_ids = db.session.execute(db.select(Message.id).order_by(Message.id)).scalars().all()
+
+    for liker, count in zip(likers, LIKES):
+        db.session.execute(db.insert(Likes), [
+            dict(user_id=liker, message_id=message_id,
+                 timestamp=now - timedelta(seconds=n))
+            for n, message_id in enumerate(message_ids[:count])
+        ])
+    db.session.commit()
+    db.session.execute(db.text("ANALYZE"))
+    db.session.commit()
+    return dict(zip(LIKES, likers))
+
+
+def deep_url(liker):
+    """The URL of the page after the middle of `liker`'s likes."""
+
+    msg, liked_at = (db.session
+                     .query(Message, Likes.timestamp)
+                     .join(Likes, Likes.message_id == Message.id)
+                     .filter(Likes.user_id == liker)
+                     .order_by(Likes.timestamp.desc(), Likes.message_id.desc())
+                     .offset(Likes.query.filter_by(user_id=liker).count() // 2)
+                     .first())
+    cursor = app_module.api.encode_cursor(liked_at.isoformat(), msg.id)
+    return f"/users/{liker}/likes?cursor={cursor}"
+
+
+def measure(client, engine, url):
+    """(statements, ms) per load of `url`."""
+
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    client.get(url)
+    event.listen(engine, "before_cursor_execute", count)
+    client.get(url)
+    event.remove(engine, "before_cursor_execute", count)
+
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        client.get(url)
+    return len(statements), (perf_counter() - start) * 1000 / ROUNDS
+
+
+if __name__ == '__main__':
+    app.config['TESTING'] = True
+    # Keep the per-request prints out of the timings.
+    sys.stdout, stdout = open(os.devnull, 'w'), sys.stdout
+
+    with app.app_context():
+        likers = setup()
+        engine = db.engine
+        urls = {count: (f"/users/{liker}/likes", deep_url(liker))
+                for count, liker in likers.items()}
+
+    client = app.test_client()
+    results = [(count, *measure(client, engine, first), *measure(client, engine, deep))
+               for count, (first, deep) in urls.items()]
+
+    sys.stdout = stdout
+    print(f"{'likes':>8} {'statements':>11} {'first ms':>9} {'statements':>11} {'deep ms':>8}")
+    for count, first_statements, first_ms, deep_statements, deep_ms in results:
+        print(f"{count:>8} {first_statements:>11} {first_ms:>9.2f} {deep_statements:>11} {deep_ms:>8.2f}")
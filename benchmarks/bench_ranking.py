@@ -0,0 +1,72 @@
+"""Benchmark scoring ranked-feed candidates.
+
+Scores CANDIDATES warbles with ranking.score over columnar NumPy arrays and
+picks the top 100, against the same formula applied per Message-like object
+in a Python loop and sorted.
+
+Run like:
+
+    python benchmarks/bench_ranking.py
+"""
+
+import math
+import os
+import sys
+from collections import namedtuple
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ranking
+
+CANDIDATES = ranking.CANDIDATES
+ROUNDS = 200
+
+Candidate = namedtuple('Candidate', 'id age_hours likes affinity distance')
+
+
+def loop_scores(candidates):
+    weights = ranking.DISTANCE_WEIGHTS.tolist()
+    scored = []
+    for c in candidates:
+        recency = 2.0 ** (-c.age_hours / ranking.HALF_LIFE_HOURS)
+        velocity = c.likes / (c.age_hours + 2.0)
+        scored.append((recency
+                       * (1.0 + ranking.LIKE_WEIGHT * math.log1p(velocity))
+                       * (1.0 + ranking.AFFINITY_WEIGHT * c.affinity)
+                       * weights[c.distance], c.id))
+    scored.sort(reverse=True)
+    return [message_id for _, message_id in scored[:100]]
+
+
+def numpy_scores(ids, age, likes, affinity, distance):
+    scores = ranking.score(age, likes, affinity, distance)
+    return ids[ranking.top_indices(scores, 100)]
+
+
+def per_call_ms(func, *args):
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        func(*args)
+    return (perf_counter() - start) * 1000 / ROUNDS
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    ids = np.arange(CANDIDATES, dtype=np.int64)
+    age = rng.uniform(0, 72, CANDIDATES)
+    likes = rng.poisson(3, CANDIDATES).astype(np.float64)
+    affinity = rng.dirichlet(np.ones(50))[rng.integers(0, 50, CANDIDATES)]
+    distance = rng.choice([1, 2], CANDIDATES, p=[0.8, 0.2])
+
+    objects = [Candidate(*row) for row in zip(ids.tolist(), age.tolist(), likes.tolist(),
+                                              affinity.tolist(), distance.tolist())]
+
+    assert loop_scores(objects)[:10] == numpy_scores(ids, age, likes, affinity, distance)[:10].tolist()
+
+    numpy_ms = per_call_ms(numpy_scores, ids, age, likes, affinity, distance)
+    loop_ms = per_call_ms(loop_scores, objects)
+    print(f"scoring {CANDIDATES} candidates, top 100:")
+    print(f"  numpy: {numpy_ms:.3f} ms   python loop: {loop_ms:.2f} ms")
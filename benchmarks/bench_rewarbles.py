@@ -0,0 +1,138 @@
+"""Benchmark the homepage feed with and without heavy re-warble traffic.
+
+A viewer follows USERS authors with MESSAGES_PER_USER warbles each. The
+homepage is timed, and its SQL statements counted, first with no
+re-warbles and then once each author has re-warbled REWARBLES_PER_USER of
+the others' warbles (many of them the same ones, so the feed has to
+deduplicate them).
+
+Run like:
+
+    python benchmarks/bench_rewarbles.py
+
+By default this uses a throwaway in-memory SQLite database; set DATABASE_URL
+to benchmark against Postgres (its tables are dropped and recreated!).
+"""
+
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import event
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Rewarbles
+
+USERS = 100
+MESSAGES_PER_USER = 50
+REWARBLES_PER_USER = (0, 50, 500)
+ROUNDS = 50
+
+
+def setup():
+    """The viewer's id, and the ids of the warbles they can see."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(db.insert(User), [
+        dict(username=f"user{i}", email=f"user{i}@test.com", password="x",
+             image_url="/static/images/default-pic.png",
+             header_image_url="/static/images/warbler-hero.jpg")
+        for i in range(USERS + 1)
+    ])
+    ids = db.session.execute(db.select(User.id).order_by(User.id)).scalars().all()
+    viewer, authors = ids[0], ids[1:]
+
+    now = datetime.utcnow()
+    db.session.execute(db.insert(Message), [
+        dict(text="Lorem ipsum dolor sit amet, consectetur adipiscing elit",
+             user_id=author, timestamp=now - timedelta(minutes=i * USERS + n))
+        for n, author in enumerate(authors) for i in range(MESSAGES_PER_USER)
+    ])
+    db.session.execute(db.insert(Follows), [
+        dict(user_following_id=viewer, user_being_followed_id=author)
+        for author in authors
+    ])
+    db.session.commit()
+    message_ids = db.session.execute(db.select(Message.id)).scalars().all()
+    return viewer, authors, message_ids
+
+
+def add_rewarbles(authors, message_ids, per_user):
+    """Have each author re-warble `per_user` warbles, favouring the newest
+    few hundred so that many are re-warbled by several authors."""
+
+    db.session.execute(db.delete(Rewarbles))
+    rng = random.Random(0)
+    popular = sorted(message_ids)[-300:]
+    now = datetime.utcnow()
+    rows = []
+    for author in authors:
+        for message_id in rng.sample(popular + message_ids, per_user):
+            rows.append(dict(user_id=author, message_id=message_id,
+                             timestamp=now - timedelta(seconds=rng.randrange(86400))))
+    # A message picked twice by the same author is only re-warbled once.
+    rows = list({(row['user_id'], row['message_id']): row for row in rows}.values())
+    if rows:
+        db.session.execute(db.insert(Rewarbles), rows)
+    db.session.commit()
+    # Plan against the new table sizes, as autovacuum would.
+    db.session.execute(db.text("ANALYZE"))
+    db.session.commit()
+    return len(rows)
+
+
+def measure(client, engine):
+    """(statements, ms) per homepage load."""
+
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    def load():
+        app_module.cache.clear()
+        client.get("/")
+
+    load()
+    event.listen(engine, "before_cursor_execute", count)
+    load()
+    event.remove(engine, "before_cursor_execute", count)
+    per_load = len(statements)
+
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        load()
+    return per_load, (perf_counter() - start) * 1000 / ROUNDS
+
+
+if __name__ == '__main__':
+    app.config['TESTING'] = True
+    # Keep the per-request "Logged in as" prints out of the timings.
+    sys.stdout, stdout = open(os.devnull, 'w'), sys.stdout
+
+    with app.app_context():
+        viewer, authors, message_ids = setup()
+        engine = db.engine
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = viewer
+
+    results = []
+    for per_user in REWARBLES_PER_USER:
+        with app.app_context():
+            total = add_rewarbles(authors, message_ids, per_user)
+        results.append((total, *measure(client, engine)))
+
+    sys.stdout = stdout
+    print(f"{'rewarbles':>10} {'statements':>11} {'ms':>8}")
+    for total, statements, ms in results:
+        print(f"{total:>10} {statements:>11} {ms:>8.2f}")
@@ -0,0 +1,385 @@
+"""Tiered cache shared by the web workers, with versioned invalidation.
+
+A value is looked up in each tier in turn, and copied into the faster
+tiers when found further down:
+
+- `LocalTier`: a per-process LRU dict.
+- `FileTier`: a SQLite file shared by every worker on the host
+  (CACHE_PATH, by default in the app's instance folder), so a value
+  computed by one worker serves them all, and a bump by one reaches them
+  all.
+- `RedisTier`: an optional networked tier shared across hosts
+  (CACHE_URL=redis://...; needs the ``redis`` package). ``memory://``
+  puts a `LocalTier` in its place, for development.
+
+Nothing is ever deleted to invalidate it. Each cached value is derived
+from some entities, like ``('messages', 5)`` (user 5's warbles), and its
+key includes their current version numbers. Writers `bump` an entity's
+version, which lives in the outermost tier, so every worker's next lookup
+builds a new key and misses, and everything derived from the entity is
+invalidated at once. The stale entries just age out (TTL and LRU).
+
+Reading the versions from the outermost tier on every lookup would cost a
+round trip to it even for a value held locally, so each worker keeps the
+versions it read for VERSION_TTL seconds. Its own bumps show at once;
+other workers' within VERSION_TTL.
+
+When a hot key misses, only one caller computes it: other threads in the
+process wait for its result, and other processes wait (up to
+LOCK_TIMEOUT) for it to appear in the shared tiers, guarded by a lock
+entry added there.
+"""
+
+import os
+import pickle
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Event, Lock, local
+
+DEFAULT_TTL = 300
+VERSION_TTL = 1.0
+LOCK_TIMEOUT = 5.0
+POLL_INTERVAL = 0.01
+
+
+class LocalTier:
+    """In-process LRU of up to `maxsize` entries."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = Lock()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[1] <= now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry[0]
+        return found
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def add(self, key, value, ttl):
+        """Set `key` unless it's already set; returns whether it was."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                return False
+            self._entries[key] = (value, time.monotonic() + ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def versions(self, keys):
+        with self._lock:
+            return {key: self._versions[key] for key in keys if key in self._versions}
+
+    def bump(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            return self._versions[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+class FileTier:
+    """A SQLite file shared by the processes on one host."""
+
+    # Sweep out expired entries every this many sets.
+    SWEEP_EVERY = 1000
+
+    def __init__(self, path, timeout=LOCK_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._local = local()
+        self._sets = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS entries "
+                     "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS versions "
+                     "(key TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+    def _conn(self):
+        # sqlite3 connections can't be shared between threads.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None)
+        return conn
+
+    @staticmethod
+    def _marks(keys):
+        return ','.join('?' * len(keys))
+
+    def get_many(self, keys):
+        keys = list(keys)
+        rows = self._conn().execute(
+            f"SELECT key, value FROM entries WHERE key IN ({self._marks(keys)}) "
+            f"AND expires > ?", [*keys, time.time()])
+        return {key: pickle.loads(value) for key, value in rows}
+
+    def set(self, key, value, ttl):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                     (key, pickle.dumps(value), now + ttl))
+        self._sets += 1
+        if self._sets % self.SWEEP_EVERY == 0:
+            conn.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+
+    def add(self, key, value, ttl):
+        now = time.time()
+        cursor = self._conn().execute(
+            "INSERT INTO entries VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE "
+            "SET value = excluded.value, expires = excluded.expires "
+            "WHERE entries.expires <= ?",
+            (key, pickle.dumps(value), now + ttl, now))
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def versions(self, keys):
+        keys = list(keys)
+        return dict(self._conn().execute(
+            f"SELECT key, version FROM versions WHERE key IN ({self._marks(keys)})", keys))
+
+    def bump(self, key):
+        return self._conn().execute(
+            "INSERT INTO versions VALUES (?, 1) ON CONFLICT (key) DO UPDATE "
+            "SET version = version + 1 RETURNING version", (key,)).fetchone()[0]
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM entries")
+        conn.execute("DELETE FROM versions")
+
+
+class RedisTier:
+    """A Redis server shared across hosts."""
+
+    def __init__(self, url, prefix='warbler:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        keys = list(keys)
+        values = self.client.mget([self.prefix + key for key in keys])
+        return {key: pickle.loads(value)
+                for key, value in zip(keys, values) if value is not None}
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=int(ttl) or 1)
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(self.prefix + key, pickle.dumps(value),
+                                    ex=int(ttl) or 1, nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def versions(self, keys):
+        keys = list(keys)
+        values = self.client.mget([f"{self.prefix}v:{key}" for key in keys])
+        return {key: int(value) for key, value in zip(keys, values) if value is not None}
+
+    def bump(self, key):
+        return self.client.incr(f"{self.prefix}v:{key}")
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class _Flight:
+    """One in-process computation of a key that others are waiting on."""
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+
+
+class Cache:
+    """Versioned lookups through `tiers`, fastest first.
+
+    The last tier holds the entity versions, so it should be the most
+    widely shared one.
+    """
+
+    def __init__(self, tiers, ttl=DEFAULT_TTL, lock_timeout=LOCK_TIMEOUT,
+                 version_ttl=VERSION_TTL):
+        self.tiers = list(tiers)
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.version_ttl = version_ttl
+        self._flights = {}
+        self._flights_lock = Lock()
+        # "entity:id" -> (version, monotonic time it's good until)
+        self._versions = {}
+        self._versions_lock = Lock()
+
+    def key(self, name, deps):
+        """`name` plus the current version of each (entity, id) in `deps`."""
+
+        names = [f"{entity}:{entity_id}" for entity, entity_id in deps]
+        return name + '|' + ','.join(f"{n}@{v}" for n, v in self._current(names).items())
+
+    def _current(self, names):
+        """{name: version} for `names`, read through the local copies."""
+
+        now = time.monotonic()
+        versions = {}
+        with self._versions_lock:
+            for name in names:
+                entry = self._versions.get(name)
+                versions[name] = entry[0] if entry and entry[1] > now else None
+        missing = [name for name, version in versions.items() if version is None]
+        if missing:
+            read = self.tiers[-1].versions(missing)
+            with self._versions_lock:
+                if len(self._versions) > 100000:
+                    self._versions = {name: entry for name, entry in self._versions.items()
+                                      if entry[1] > now}
+                for name in missing:
+                    versions[name] = read.get(name, 0)
+                    self._versions[name] = (versions[name], now + self.version_ttl)
+        return versions
+
+    def bump(self, entity, entity_id):
+        """Invalidate everything derived from `entity` `entity_id`."""
+
+        name = f"{entity}:{entity_id}"
+        version = self.tiers[-1].bump(name)
+        with self._versions_lock:
+            self._versions[name] = (version, time.monotonic() + self.version_ttl)
+        return version
+
+    def _lookup(self, key):
+        for position, tier in enumerate(self.tiers):
+            found = tier.get_many([key])
+            if key in found:
+                for faster in self.tiers[:position]:
+                    faster.set(key, found[key], self.ttl)
+                return found[key]
+        return None
+
+    def _store(self, key, value, ttl):
+        for tier in self.tiers:
+            tier.set(key, value, ttl)
+
+    def get_or_set(self, name, deps, compute, ttl=None):
+        """The cached `name` (derived from `deps`), else `compute()`.
+
+        Only one caller per key computes it at a time. None is never
+        cached.
+        """
+
+        key = self.key(name, deps)
+        value = self._lookup(key)
+        if value is not None:
+            return value
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait(self.lock_timeout)
+            # If the leader failed or is too slow, compute it ourselves.
+            return flight.value if flight.value is not None else compute()
+
+        try:
+            flight.value = self._compute(key, compute, ttl or self.ttl)
+            return flight.value
+        finally:
+            flight.done.set()
+            with self._flights_lock:
+                del self._flights[key]
+
+    def _compute(self, key, compute, ttl):
+        if len(self.tiers) == 1:
+            value = compute()
+            if value is not None:
+                self._store(key, value, ttl)
+            return value
+
+        # Other processes: whoever adds the lock computes; the rest wait for
+        # its value to show up, up to the lock's lifetime.
+        shared = self.tiers[-1]
+        lock_key = 'lock:' + key
+        locked = shared.add(lock_key, 1, self.lock_timeout)
+        if not locked:
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(POLL_INTERVAL)
+                value = self._lookup(key)
+                if value is not None:
+                    return value
+        try:
+            value = compute()
+            if value is not None:
+                self._store(key, value, ttl)
+            return value
+        finally:
+            if locked:
+                shared.delete(lock_key)
+
+    def peek(self, name, deps=()):
+        """The cached `name` (derived from `deps`) if it's there; never
+        computes it."""
+
+        return self._lookup(self.key(name, deps))
+
+    def put(self, name, deps, value, ttl=None):
+        """Cache `value` as `name` (derived from `deps`)."""
+
+        self._store(self.key(name, deps), value, ttl or self.ttl)
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
+        with self._versions_lock:
+            self._versions.clear()
+
+
+def make_cache(config):
+    """A Cache with the tiers that `config` asks for."""
+
+    tiers = [LocalTier(config.get('CACHE_LOCAL_SIZE', 10000))]
+    if config.get('CACHE_PATH'):
+        tiers.append(FileTier(config['CACHE_PATH']))
+    url = config.get('CACHE_URL')
+    if url == 'memory://':
+        tiers.append(LocalTier())
+    elif url:
+        tiers.append(RedisTier(url))
+    return Cache(tiers, ttl=config.get('CACHE_TTL', DEFAULT_TTL),
+                 version_ttl=config.get('CACHE_VERSION_TTL', VERSION_TTL))
@@ -0,0 +1,374 @@
+"""Background purging of deleted users and messages.
+
+``delete_user`` and ``messages_destroy`` only tombstone the row (set its
+``deleted_at``, which hides it from every query) and queue a DeletionJob in
+the same transaction, so they return right away no matter how much data the
+account has.
+
+This module works through the queued jobs. Each step deletes at most `chunk`
+rows in its own short transaction and records the job's progress (stage and
+rows deleted) in that same transaction, so locks are only ever held briefly
+and a worker can be stopped at any point and resumed where it left off.
+
+A step that fails is rolled back and recorded on its job (``attempts``,
+``last_error``), and the job is put off for RETRY_MIN secs, doubling with
+each failure in a row up to RETRY_MAX. Workers meanwhile get on with the
+jobs behind it.
+
+Run a worker like:
+
+    python deletion.py
+"""
+
+from datetime import datetime, timedelta
+from threading import Event, Thread
+
+from flask import current_app
+from sqlalchemy import delete, or_, select, tuple_
+
+import sharding
+from archive import Archive
+
+from models import (db, Blocks, DeletionJob, Follows, Likes, Message, MessageViews, Mutes,
+                    NotificationActor, NotificationEvent, NotificationGroup, Rewarbles,
+                    User)
+
+DEFAULT_CHUNK = 1000
+
+# Secs a failing job is put off for: RETRY_MIN, doubling up to RETRY_MAX.
+RETRY_MIN = 10
+RETRY_MAX = 3600
+
+
+def _delete_some(table, key_columns, where, chunk):
+    """Delete up to `chunk` rows of `table` matching `where`."""
+
+    key = key_columns[0] if len(key_columns) == 1 else tuple_(*key_columns)
+    picked = select(*key_columns).where(*where).limit(chunk)
+    return db.session.execute(delete(table).where(key.in_(picked))).rowcount
+
+
+def _purge_follows(user_id, chunk):
+    follows = Follows.__table__
+    return _delete_some(
+        follows,
+        [follows.c.user_following_id, follows.c.user_being_followed_id],
+        [or_(follows.c.user_following_id == user_id,
+             follows.c.user_being_followed_id == user_id)],
+        chunk)
+
+
+def _purge_filters(user_id, chunk):
+    """Delete a chunk of the user's mutes and blocks, either way round."""
+
+    mutes = Mutes.__table__
+    removed = _delete_some(
+        mutes,
+        [mutes.c.user_id, mutes.c.muted_user_id],
+        [or_(mutes.c.user_id == user_id, mutes.c.muted_user_id == user_id)],
+        chunk)
+    if removed:
+        return removed
+
+    blocks = Blocks.__table__
+    return _delete_some(
+        blocks,
+        [blocks.c.user_id, blocks.c.blocked_user_id],
+        [or_(blocks.c.user_id == user_id, blocks.c.blocked_user_id == user_id)],
+        chunk)
+
+
+def _purge_user_likes(user_id, chunk):
+    likes = Likes.__table__
+    return _delete_some(likes, [likes.c.id], [likes.c.user_id == user_id], chunk)
+
+
+def _purge_user_rewarbles(user_id, chunk):
+    rewarbles = Rewarbles.__table__
+    return _delete_some(
+        rewarbles, [rewarbles.c.user_id, rewarbles.c.message_id],
+        [rewarbles.c.user_id == user_id], chunk)
+
+
+def _purge_user_messages(user_id, chunk):
+    """Delete a chunk of the user's messages, draining their likes and
+    re-warbles first."""
+
+    router = current_app.extensions.get('shard_router')
+    if router:
+        ids = router.message_ids(user_id, chunk)
+        if not ids:
+            return 0
+        return (_purge_rewarbles_of(ids, chunk) or _purge_views_of(ids)
+                or router.purge_messages(user_id, ids))
+
+    ids = (db.session
+           .execute(select(Message.id)
+                    .where(Message.user_id == user_id)
+                    .limit(chunk))
+           .scalars()
+           .all())
+    if not ids:
+        return 0
+
+    removed = (_purge_likes_on(ids, chunk) or _purge_rewarbles_of(ids, chunk)
+               or _purge_views_of(ids))
+    if removed:
+        return removed
+
+    messages = Message.__table__
+    return db.session.execute(
+        delete(messages).where(messages.c.id.in_(ids))).rowcount
+
+
+def _purge_user_notifications(user_id, chunk):
+    """Delete a chunk of the user's notifications, and those they caused."""
+
+    events = NotificationEvent.__table__
+    removed = _delete_some(
+        events, [events.c.id],
+        [or_(events.c.user_id == user_id, events.c.actor_id == user_id)],
+        chunk)
+    if removed:
+        return removed
+
+    groups = NotificationGroup.__table__
+    removed = _delete_some(groups, [groups.c.id], [groups.c.user_id == user_id], chunk)
+    if removed:
+        return removed
+
+    actors = NotificationActor.__table__
+    return _delete_some(
+        actors, [actors.c.user_id, actors.c.key, actors.c.actor_id],
+        [or_(actors.c.user_id == user_id, actors.c.actor_id == user_id)],
+        chunk)
+
+
+def _purge_user_archive(user_id, chunk):
+    """Rewrite one archive segment without the user's messages, draining
+    their likes and re-warbles first."""
+
+    directory = current_app.config.get('MESSAGE_ARCHIVE_DIR')
+    if not directory:
+        return 0
+    archive = Archive(directory)
+    ids = archive.purge_ids(user_id)
+    router = current_app.extensions.get('shard_router')
+    removed = (_purge_likes_on(ids, chunk) or _purge_rewarbles_of(ids, chunk)
+               or (router.purge_likes(user_id, ids) if router and ids else 0))
+    if removed:
+        return removed
+    return archive.purge_user(user_id)
+
+
+def _purge_user_shards(user_id, chunk):
+    """Delete a chunk of the user's messages and likes on the shards."""
+
+    router = current_app.extensions.get('shard_router')
+    return router.purge_user(user_id, chunk) if router else 0
+
+
+def _purge_user_row(user_id, chunk):
+    users = User.__table__
+    return db.session.execute(
+        delete(users).where(users.c.id == user_id)).rowcount
+
+
+def _purge_likes_on(message_ids, chunk):
+    likes = Likes.__table__
+    return _delete_some(
+        likes, [likes.c.id], [likes.c.message_id.in_(message_ids)], chunk)
+
+
+def _purge_message_likes(message_id, chunk):
+    return _purge_likes_on([message_id], chunk)
+
+
+def _purge_rewarbles_of(message_ids, chunk):
+    rewarbles = Rewarbles.__table__
+    return _delete_some(
+        rewarbles, [rewarbles.c.user_id, rewarbles.c.message_id],
+        [rewarbles.c.message_id.in_(message_ids)], chunk)
+
+
+def _purge_message_rewarbles(message_id, chunk):
+    return _purge_rewarbles_of([message_id], chunk)
+
+
+def _purge_message_notifications(message_id, chunk):
+    events = NotificationEvent.__table__
+    removed = _delete_some(
+        events, [events.c.id], [events.c.message_id == message_id], chunk)
+    if removed:
+        return removed
+
+    groups = NotificationGroup.__table__
+    return _delete_some(
+        groups, [groups.c.id], [groups.c.message_id == message_id], chunk)
+
+
+def _purge_message_shard(message_id, chunk):
+    """Delete the message from its author's shard."""
+
+    router = current_app.extensions.get('shard_router')
+    if router is None:
+        return 0
+    author_id = sharding.message_authors([message_id], deleted=True).get(message_id)
+    if author_id is None:
+        return 0
+    return router.delete_message(author_id, message_id)
+
+
+def _purge_views_of(message_ids):
+    views = MessageViews.__table__
+    return db.session.execute(
+        delete(views).where(views.c.message_id.in_(message_ids))).rowcount
+
+
+def _purge_message_views(message_id, chunk):
+    return _purge_views_of([message_id])
+
+
+def _purge_message_row(message_id, chunk):
+    messages = Message.__table__
+    return db.session.execute(
+        delete(messages).where(messages.c.id == message_id)).rowcount
+
+
+# The stages each kind of job goes through, in order. A stage is finished
+# once its function deletes nothing.
+PURGE_STAGES = {
+    'user': [
+        ('follows', _purge_follows),
+        ('filters', _purge_filters),
+        ('likes', _purge_user_likes),
+        ('rewarbles', _purge_user_rewarbles),
+        ('notifications', _purge_user_notifications),
+        ('messages', _purge_user_messages),
+        ('archive', _purge_user_archive),
+        ('shards', _purge_user_shards),
+        ('user', _purge_user_row),
+    ],
+    'message': [
+        ('likes', _purge_message_likes),
+        ('rewarbles', _purge_message_rewarbles),
+        ('notifications', _purge_message_notifications),
+        ('views', _purge_message_views),
+        ('shards', _purge_message_shard),
+        ('message', _purge_message_row),
+    ],
+}
+
+
+def enqueue(kind, target_id):
+    """Queue the purge of a tombstoned user or message. Caller commits."""
+
+    job = DeletionJob(kind=kind,
+                      target_id=target_id,
+                      stage=PURGE_STAGES[kind][0][0],
+                      rows_deleted=0)
+    db.session.add(job)
+    return job
+
+
+def _backoff(attempts):
+    return timedelta(seconds=min(RETRY_MAX, RETRY_MIN * 2 ** (attempts - 1)))
+
+
+def step(chunk=DEFAULT_CHUNK):
+    """Do one bounded chunk of work on the oldest unfinished job that isn't
+    being put off.
+
+    Returns the job worked on, or None if there was nothing to do. Jobs are
+    claimed with SKIP LOCKED, so several workers can run side by side.
+    """
+
+    now = datetime.utcnow()
+    job = (DeletionJob
+           .query
+           .filter(DeletionJob.finished_at.is_(None),
+                   or_(DeletionJob.next_attempt_at.is_(None),
+                       DeletionJob.next_attempt_at <= now))
+           .order_by(DeletionJob.id)
+           .with_for_update(skip_locked=True)
+           .first())
+    if job is None:
+        db.session.commit()
+        return None
+
+    stages = PURGE_STAGES[job.kind]
+    names = [name for name, _ in stages]
+    try:
+        with db.session.begin_nested():
+            removed = dict(stages)[job.stage](job.target_id, chunk)
+    except Exception as exc:
+        job.attempts += 1
+        job.last_error = f"{job.stage}: {exc!r}"
+        job.next_attempt_at = now + _backoff(job.attempts)
+        db.session.commit()
+        current_app.logger.warning("Purge of %s #%s failed (%d in a row): %r",
+                                   job.kind, job.target_id, job.attempts, exc)
+        return job
+
+    job.rows_deleted += removed
+    job.attempts = 0
+    job.next_attempt_at = None
+
+    if not removed:
+        position = names.index(job.stage) + 1
+        if position < len(names):
+            job.stage = names[position]
+        else:
+            job.stage = 'done'
+            job.finished_at = datetime.utcnow()
+
+    db.session.commit()
+    return job
+
+
+def run_pending(chunk=DEFAULT_CHUNK, max_steps=None):
+    """Work through queued jobs until none are left (or `max_steps`)."""
+
+    steps = 0
+    while max_steps is None or steps < max_steps:
+        if step(chunk) is None:
+            break
+        steps += 1
+    return steps
+
+
+def work(app, stop, chunk=DEFAULT_CHUNK, idle=1.0):
+    """Keep purging until `stop` is set, sleeping `idle` secs when idle.
+
+    A chunk that fails is rolled back and logged, and the worker carries
+    on after a pause; the job's progress wasn't saved, so it's retried.
+    """
+
+    while not stop.is_set():
+        with app.app_context():
+            try:
+                job = step(chunk)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Purge step failed; retrying")
+                job = None
+        if job is None:
+            stop.wait(idle)
+
+
+def start_worker(app, chunk=DEFAULT_CHUNK):
+    """Run a purge worker in a background thread; returns its stop Event."""
+
+    stop = Event()
+    Thread(target=work, args=(app, stop, chunk), daemon=True).start()
+    return stop
+
+
+if __name__ == '__main__':
+    from app import app
+
+    print("Purging deleted users and messages; Ctrl-C to stop.")
+    try:
+        work(app, Event())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,119 @@
+"""Streaming NDJSON export of a user's data.
+
+One JSON object per line: the profile first, then every message, like,
+re-warble, followed user and follower. Each table is read through a
+server-side cursor (``yield_per``) and written out as it's read, so an
+account with millions of rows exports in constant memory, and the first
+bytes go out immediately. With sharding on, messages and likes are read
+from the shards a chunk at a time instead.
+
+Export from the command line like:
+
+    python export.py <user_id> > export.ndjson
+    python export.py <user_id> --gzip > export.ndjson.gz
+"""
+
+import json
+import sys
+import zlib
+
+from sqlalchemy import select
+
+import sharding
+from models import db, Follows, Likes, Message, Rewarbles, User
+
+CHUNK = 1000
+
+# Flush compressed output at least every this many lines, so a slow export
+# still trickles out instead of sitting in the compressor.
+GZIP_FLUSH_LINES = 1000
+
+
+def _line(record):
+    return json.dumps(record, separators=(',', ':'), default=str).encode() + b'\n'
+
+
+def _stream(stmt, chunk):
+    return db.session.execute(stmt.execution_options(yield_per=chunk))
+
+
+def export_lines(user_id, chunk=CHUNK, archive=None):
+    """Yield the NDJSON lines (bytes) of `user_id`'s export, including
+    their messages in `archive` (see archive.py)."""
+
+    user = db.session.execute(
+        select(User.id, User.username, User.email, User.image_url,
+               User.header_image_url, User.bio, User.location)
+        .where(User.id == user_id, User.deleted_at.is_(None))).one()
+    yield _line({'type': 'user', **user._asdict()})
+
+    router = sharding.current_router()
+    if router:
+        messages = router.iter_user(user_id, chunk)
+    else:
+        messages = _stream(select(Message.id, Message.text, Message.timestamp)
+                           .where(Message.user_id == user_id,
+                                  Message.deleted_at.is_(None))
+                           .order_by(Message.id), chunk)
+    for row in messages:
+        yield _line({'type': 'message', 'id': row.id, 'text': row.text,
+                     'timestamp': row.timestamp.isoformat()})
+
+    for row in (archive.iter_user(user_id) if archive else ()):
+        yield _line({'type': 'message', 'id': row.id, 'text': row.text,
+                     'timestamp': row.timestamp.isoformat(), 'archived': True})
+
+    if router:
+        likes = router.iter_likes(user_id, chunk)
+    else:
+        likes = _stream(select(Likes.message_id, Likes.timestamp)
+                        .where(Likes.user_id == user_id)
+                        .order_by(Likes.message_id), chunk)
+    for row in likes:
+        yield _line({'type': 'like', 'message_id': row.message_id,
+                     'timestamp': row.timestamp.isoformat()})
+
+    for row in _stream(select(Rewarbles.message_id, Rewarbles.timestamp)
+                       .where(Rewarbles.user_id == user_id)
+                       .order_by(Rewarbles.message_id), chunk):
+        yield _line({'type': 'rewarble', 'message_id': row.message_id,
+                     'timestamp': row.timestamp.isoformat()})
+
+    for followed_id in _stream(select(Follows.user_being_followed_id)
+                               .where(Follows.user_following_id == user_id)
+                               .order_by(Follows.user_being_followed_id),
+                               chunk).scalars():
+        yield _line({'type': 'following', 'user_id': followed_id})
+
+    for follower_id in _stream(select(Follows.user_following_id)
+                               .where(Follows.user_being_followed_id == user_id)
+                               .order_by(Follows.user_following_id),
+                               chunk).scalars():
+        yield _line({'type': 'follower', 'user_id': follower_id})
+
+
+def gzipped(lines, level=6):
+    """Gzip an iterable of byte strings on the fly."""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for count, line in enumerate(lines, 1):
+        data = compressor.compress(line)
+        if count == 1 or count % GZIP_FLUSH_LINES == 0:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+if __name__ == '__main__':
+    from app import app, archive
+
+    if len(sys.argv) not in (2, 3) or sys.argv[2:] not in ([], ['--gzip']):
+        sys.exit(__doc__)
+
+    with app.app_context():
+        lines = export_lines(int(sys.argv[1]), archive=archive)
+        if '--gzip' in sys.argv:
+            lines = gzipped(lines)
+        for data in lines:
+            sys.stdout.buffer.write(data)
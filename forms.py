@@ -1,13 +1,21 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileAllowed, FileField
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length, Optional
+
+IMAGE_TYPES = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+
 class UserEditForm(FlaskForm):
     """Form for editing user profile."""
 
     username = StringField('Username', validators=[DataRequired()])
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     image_url = StringField('(Optional) Image URL', validators=[Optional()])
+    image_file = FileField('(Optional) Upload an Image',
+                           validators=[FileAllowed(IMAGE_TYPES, 'Images only!')])
     header_image_url = StringField('(Optional) Header Image URL', validators=[Optional()])
+    header_file = FileField('(Optional) Upload a Header Image',
+                            validators=[FileAllowed(IMAGE_TYPES, 'Images only!')])
     bio = TextAreaField('Bio', validators=[Optional()])
     password = PasswordField('Password', validators=[Length(min=6)])
 
@@ -26,6 +34,8 @@ class UserAddForm(FlaskForm):
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('(Optional) Image URL')
+    image_file = FileField('(Optional) Upload an Image',
+                           validators=[FileAllowed(IMAGE_TYPES, 'Images only!')])
 
 
 class LoginForm(FlaskForm):
@@ -0,0 +1,358 @@
+"""Compact in-memory follow graph, for "who to follow" suggestions and
+"followers you know".
+
+Walking friends-of-friends through ``User.following`` loads a User object
+per edge. Instead the whole ``follows`` table is held as CSR adjacency
+lists: ``indptr`` (one int32 per user id) and ``indices`` (one int32 per
+follow), so the people user ``u`` follows are the sorted ids
+``indices[indptr[u]:indptr[u + 1]]``. The same pair of arrays is kept the
+other way round for who follows ``u``. A million follows take about 8MB in
+all.
+
+The CSR arrays never change once built. Follows made or removed since then
+are kept in small per-user ``added``/``removed`` sets and applied on read;
+``compact()`` folds them back into fresh arrays once there are enough.
+Merging those into a big account's follower list is the one costly read,
+so merged lists are cached per user until their next follow change.
+
+A snapshot file can be written once (e.g. from cron) and memory-mapped by
+every web worker, so they share one copy in the page cache:
+
+    python graph.py snapshot follow-graph.bin
+
+Each worker reads the follows made by every worker from the outbox onto
+its graph every FOLLOW_GRAPH_SYNC seconds (and before answering a user
+whose own follow it hasn't read yet; see ``sync_follow_graph`` in app.py).
+It picks up a newer snapshot the next time it asks for the graph (see
+``FollowGraph.reload_if_changed``). Without a snapshot, each worker
+rebuilds its graph from the table in the background every
+FOLLOW_GRAPH_REFRESH seconds, to drop deleted accounts (see
+``get_follow_graph``). Either way the graph can be behind, so it only
+ranks and intersects; the follower and following counts shown come from
+the table.
+
+A graph records when its follows were read (``taken_at``, kept in the
+snapshot too), and logs the follows made on it since. The graph replacing
+it gets those made since its own read replayed onto it, and any made on
+the old one after that are passed on (``replaced_by``), so a worker's own
+follows survive a reload or rebuild that started before them.
+
+Deleted (tombstoned) accounts are left out of the graph when it's built.
+"""
+
+import os
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from threading import RLock
+
+import numpy as np
+
+from models import db, Follows, User
+
+MAGIC = b'WFG3'
+HEADER = np.dtype([('magic', 'S4'), ('nodes', '<i4'), ('edges', '<i8'), ('taken_at', '<f8')])
+
+# Rebuild the CSR arrays once this many follows are pending on top of them.
+COMPACT_AFTER = 10000
+
+# How many merged adjacency lists to keep per direction.
+CACHE_SIZE = 1024
+
+
+def intersect_sorted(a, b):
+    """Ids in both sorted, duplicate-free arrays `a` and `b` (sorted).
+
+    Binary-searches each id of the shorter array in the longer one, so it
+    costs O(m log n): intersecting a few hundred followees with millions of
+    followers takes microseconds.
+    """
+
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return a[:0]
+    positions = np.searchsorted(b, a)
+    positions[positions == len(b)] = 0
+    return a[b[positions] == a]
+
+
+def _csr(sources, targets, nodes):
+    """(indptr, indices) listing each source's targets, sorted."""
+
+    order = np.lexsort((targets, sources))
+    indptr = np.zeros(nodes + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=nodes), out=indptr[1:])
+    return indptr, targets[order]
+
+
+class _Adjacency:
+    """One direction of the graph: CSR arrays plus pending changes."""
+
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+        self.added = {}
+        self.removed = {}
+        self._merged = OrderedDict()
+
+    def base(self, user_id):
+        if user_id + 1 >= len(self.indptr):
+            return self.indices[:0]
+        return self.indices[self.indptr[user_id]:self.indptr[user_id + 1]]
+
+    def get(self, user_id):
+        added = self.added.get(user_id)
+        removed = self.removed.get(user_id)
+        if not added and not removed:
+            return self.base(user_id)
+
+        if user_id in self._merged:
+            self._merged.move_to_end(user_id)
+            return self._merged[user_id]
+
+        ids = self.base(user_id)
+        if removed:
+            ids = ids[~np.isin(ids, list(removed))]
+        if added:
+            ids = np.union1d(ids, np.fromiter(added, dtype=np.int32))
+        self._merged[user_id] = ids
+        if len(self._merged) > CACHE_SIZE:
+            self._merged.popitem(last=False)
+        return ids
+
+    def change(self, user_id, other_id, adding):
+        self._merged.pop(user_id, None)
+        into, out_of = (self.added, self.removed) if adding else (self.removed, self.added)
+        into.setdefault(user_id, set()).add(other_id)
+        out_of.get(user_id, set()).discard(other_id)
+
+    def gather(self, user_ids):
+        """Everything `user_ids` point to, concatenated (with repeats)."""
+
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        changed = np.isin(user_ids, list(set(self.added) | set(self.removed)))
+        base = user_ids[~changed & (user_ids + 1 < len(self.indptr))]
+
+        # The unchanged lists are CSR slices: index them all in one go.
+        starts = self.indptr[base].astype(np.int64)
+        lengths = self.indptr[base + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        positions = offsets + np.arange(len(offsets))
+        return np.concatenate([self.indices[positions]]
+                              + [self.get(int(user_id)) for user_id in user_ids[changed]])
+
+    def edges(self):
+        """(sources, targets) of every edge, pending changes included."""
+
+        changed = {user_id: self.get(user_id)
+                   for user_id in set(self.added) | set(self.removed)}
+        sources = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int32),
+                            np.diff(self.indptr))
+        unchanged = ~np.isin(sources, list(changed))
+        return (np.concatenate([sources[unchanged]]
+                               + [np.full(len(ids), user_id, dtype=np.int32)
+                                  for user_id, ids in changed.items()]),
+                np.concatenate([self.indices[unchanged]] + list(changed.values())))
+
+
+class FollowGraph:
+    """Who follows whom, by user id."""
+
+    def __init__(self, indptr, indices, followers_indptr, followers_indices, path=None,
+                 taken_at=None):
+        self._following = _Adjacency(indptr, indices)
+        self._followers = _Adjacency(followers_indptr, followers_indices)
+        self.path = path
+        self.mtime = os.stat(path).st_mtime if path else None
+        self.built_at = time.monotonic()
+        # Wall-clock time the follows were read at.
+        self.taken_at = time.time() if taken_at is None else taken_at
+        self.pending = 0
+        # (follower_id, followed_id, adding, at) of follows made since.
+        self._log = []
+        self._successor = None
+        self._lock = RLock()
+
+    @property
+    def indptr(self):
+        return self._following.indptr
+
+    @property
+    def indices(self):
+        return self._following.indices
+
+    @classmethod
+    def from_edges(cls, followers, followed, taken_at=None):
+        """Build from parallel sequences of follower and followed ids."""
+
+        followers = np.asarray(followers, dtype=np.int32)
+        followed = np.asarray(followed, dtype=np.int32)
+        nodes = int(max(followers.max(initial=-1), followed.max(initial=-1))) + 1
+
+        return cls(*_csr(followers, followed, nodes), *_csr(followed, followers, nodes),
+                   taken_at=taken_at)
+
+    @classmethod
+    def from_db(cls, chunk=10000):
+        """Build from the follows table (inside an app context), leaving
+        out deleted accounts."""
+
+        taken_at = time.time()
+        follower = db.aliased(User)
+        followee = db.aliased(User)
+        followers = array('i')
+        followed = array('i')
+        rows = db.session.execute(
+            db.select(Follows.user_following_id, Follows.user_being_followed_id)
+            .join(follower, follower.id == Follows.user_following_id)
+            .join(followee, followee.id == Follows.user_being_followed_id)
+            .where(follower.deleted_at.is_(None), followee.deleted_at.is_(None))
+            .execution_options(yield_per=chunk))
+        for follower_id, followed_id in rows:
+            followers.append(follower_id)
+            followed.append(followed_id)
+        return cls.from_edges(np.frombuffer(followers, dtype=np.int32),
+                              np.frombuffer(followed, dtype=np.int32),
+                              taken_at=taken_at)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a snapshot written by `save`."""
+
+        header = np.fromfile(path, dtype=HEADER, count=1)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError(f"{path} is not a follow graph snapshot")
+
+        nodes, edges = int(header['nodes']), int(header['edges'])
+        arrays = []
+        offset = HEADER.itemsize
+        for length in (nodes + 1, edges, nodes + 1, edges):
+            arrays.append(np.memmap(path, dtype='<i4', mode='r',
+                                    offset=offset, shape=(length,)))
+            offset += length * 4
+        return cls(*arrays, path, taken_at=float(header['taken_at']))
+
+    def save(self, path):
+        """Write a snapshot of the graph, pending follows included."""
+
+        self.compact()
+        header = np.array([(MAGIC, len(self.indptr) - 1, len(self.indices), self.taken_at)],
+                          dtype=HEADER)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(header.tobytes())
+            for adjacency in (self._following, self._followers):
+                f.write(adjacency.indptr.astype('<i4').tobytes())
+                f.write(adjacency.indices.astype('<i4').tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def reload_if_changed(self):
+        """The graph in a newer snapshot of our file, else ourselves."""
+
+        if self.path is None:
+            return self
+        try:
+            if os.stat(self.path).st_mtime == self.mtime:
+                return self
+        except FileNotFoundError:
+            return self
+        return self.replaced_by(FollowGraph.load(self.path))
+
+    def replaced_by(self, graph):
+        """Hand over to `graph`, read later than us: replay onto it the
+        follows made on us since it was read, and pass on any made from now
+        on. Returns `graph`."""
+
+        with self._lock:
+            for follower_id, followed_id, adding, at in self._log:
+                if at >= graph.taken_at:
+                    graph._change(follower_id, followed_id, adding, at)
+            self._successor = graph
+        return graph
+
+    def following(self, user_id):
+        """Sorted array of the ids `user_id` follows."""
+
+        with self._lock:
+            return self._following.get(user_id)
+
+    def followers(self, user_id):
+        """Sorted array of the ids following `user_id`."""
+
+        with self._lock:
+            return self._followers.get(user_id)
+
+    def add(self, follower_id, followed_id):
+        self._change(follower_id, followed_id, True, time.time())
+
+    def remove(self, follower_id, followed_id):
+        self._change(follower_id, followed_id, False, time.time())
+
+    def _change(self, follower_id, followed_id, adding, at):
+        with self._lock:
+            if self._successor is not None:
+                return self._successor._change(follower_id, followed_id, adding, at)
+            self._following.change(follower_id, followed_id, adding)
+            self._followers.change(followed_id, follower_id, adding)
+            self._log.append((follower_id, followed_id, adding, at))
+            self.pending += 1
+            if self.pending >= COMPACT_AFTER:
+                self.compact()
+
+    def compact(self):
+        """Fold pending follows into new CSR arrays."""
+
+        with self._lock:
+            if self.pending:
+                rebuilt = FollowGraph.from_edges(*self._following.edges())
+                self._following = rebuilt._following
+                self._followers = rebuilt._followers
+                self.pending = 0
+
+    def known_followers(self, viewer_id, user_id):
+        """Sorted ids of the people `viewer_id` follows who follow `user_id`."""
+
+        return intersect_sorted(self.following(viewer_id), self.followers(user_id))
+
+    def mutual_follows(self, viewer_id, user_id):
+        """Sorted ids of the people both `viewer_id` and `user_id` follow."""
+
+        return intersect_sorted(self.following(viewer_id), self.following(user_id))
+
+    def suggestions(self, user_id, limit=10):
+        """[(id, mutuals)] of accounts followed by those `user_id` follows.
+
+        Ranked by how many of the people `user_id` follows follow them (most
+        first, then lowest id), leaving out `user_id` and whoever they
+        already follow.
+        """
+
+        following = self.following(user_id)
+        if not len(following):
+            return []
+
+        with self._lock:
+            reached = self._following.gather(following)
+        candidates, mutuals = np.unique(reached, return_counts=True)
+        keep = ~np.isin(candidates, following) & (candidates != user_id)
+        candidates, mutuals = candidates[keep], mutuals[keep]
+
+        top = np.lexsort((candidates, -mutuals))[:limit]
+        return [(int(candidates[i]), int(mutuals[i])) for i in top]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != 'snapshot':
+        sys.exit(__doc__)
+
+    from app import app
+
+    with app.app_context():
+        graph = FollowGraph.from_db()
+    graph.save(sys.argv[2])
+    print(f"Wrote {len(graph.indices)} follows of {len(graph.indptr) - 1} users "
+          f"to {sys.argv[2]}")
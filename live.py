@@ -0,0 +1,315 @@
+"""Live timeline updates over Server-Sent Events.
+
+When a warble is committed, the outbox's 'live' consumer publishes
+``{"id", "user_id"}`` to the Hub. Every open stream whose viewer follows
+that author gets a tiny ``warble`` event; the page then asks ``/api/v1/timeline?after=`` for just
+the new messages instead of reloading the whole feed.
+
+Subscribers are multiplexed on one asyncio event loop, so an idle stream
+costs a coroutine and a small queue, not a thread. In production run the
+streams as their own ASGI app (see asgi.py):
+
+    uvicorn asgi:app --port 5001
+
+and point LIVE_STREAM_URL at it. The web workers and the stream server are
+different processes, so set LIVE_BACKEND=postgres to carry events between
+them with LISTEN/NOTIFY. ``/api/v1/stream`` on the Flask app is a
+development fallback that ties up a WSGI worker per open stream.
+"""
+
+import asyncio
+import json
+import logging
+import queue
+import select
+import time
+from http.cookies import SimpleCookie
+from threading import Lock, Thread
+
+HEARTBEAT = 15
+QUEUE_SIZE = 100
+
+# Seconds before reconnecting a dropped LISTEN connection, doubling per
+# failed attempt up to the max.
+RECONNECT_MIN = 1
+RECONNECT_MAX = 60
+
+log = logging.getLogger(__name__)
+
+
+def format_event(event):
+    """An SSE frame for `event`."""
+
+    return f"event: warble\ndata: {json.dumps(event, separators=(',', ':'))}\n\n".encode()
+
+
+PING = b": ping\n\n"
+
+
+##############################################################################
+# Backends: how published events reach every process with subscribers.
+
+
+class LocalBackend:
+    """Deliver events within this process only.
+
+    Enough when the same process publishes and serves the streams (e.g. the
+    development fallback), and a stand-in for a cross-process backend in
+    tests.
+    """
+
+    def __init__(self):
+        self._callbacks = []
+
+    def publish(self, payload):
+        for callback in self._callbacks:
+            callback(payload)
+
+    def listen(self, callback):
+        self._callbacks.append(callback)
+
+
+class PostgresBackend:
+    """Deliver events to every process via Postgres LISTEN/NOTIFY."""
+
+    channel = 'warbles'
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self._conn = None
+        self._lock = Lock()
+
+    def _connect(self):
+        import psycopg2
+
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        return conn
+
+    def publish(self, payload):
+        with self._lock:
+            try:
+                self._notify(payload)
+            except Exception:
+                # Likely a connection that dropped since the last publish.
+                if self._conn is not None:
+                    self._conn.close()
+                self._conn = None
+                self._notify(payload)
+
+    def _notify(self, payload):
+        if self._conn is None or self._conn.closed:
+            self._conn = self._connect()
+        with self._conn.cursor() as cur:
+            cur.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+
+    def listen(self, callback):
+        Thread(target=self._listen, args=(callback,), daemon=True).start()
+
+    def _listen(self, callback):
+        """Deliver notifications to `callback`, reconnecting whenever the
+        connection drops (a restarted or failed-over database, a network
+        blip). Events sent while disconnected are missed; streams catch up
+        on their next delta fetch."""
+
+        delay = RECONNECT_MIN
+        while True:
+            try:
+                conn = self._connect()
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute(f"LISTEN {self.channel}")
+                    delay = RECONNECT_MIN
+                    self._receive(conn, callback)
+                finally:
+                    conn.close()
+            except Exception:
+                log.warning("LISTEN connection lost; reconnecting in %ss", delay, exc_info=True)
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    def _receive(self, conn, callback):
+        while True:
+            if select.select([conn], [], [], HEARTBEAT)[0]:
+                conn.poll()
+                while conn.notifies:
+                    payload = conn.notifies.pop(0).payload
+                    try:
+                        callback(payload)
+                    except Exception:
+                        log.exception("Live event callback failed for %r", payload)
+
+
+##############################################################################
+# Hub
+
+
+class Hub:
+    """Fan out new-warble events to the streams that follow their author."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or LocalBackend()
+        self.loop = None
+        self._loop_lock = Lock()
+        # author id -> callbacks of the streams following that author
+        self._subscribers = {}
+        self.backend.listen(self._deliver)
+
+    def bind(self, loop):
+        """Use `loop` (e.g. the ASGI server's) for fan-out."""
+
+        with self._loop_lock:
+            if self.loop is None or self.loop.is_closed():
+                self.loop = loop
+
+    def ensure_loop(self):
+        """Start a fan-out loop in a background thread if there isn't one."""
+
+        with self._loop_lock:
+            if self.loop is None or self.loop.is_closed():
+                self.loop = asyncio.new_event_loop()
+                Thread(target=self.loop.run_forever, daemon=True).start()
+        return self.loop
+
+    def publish(self, user_id, message_id):
+        """Announce that `user_id` posted `message_id`."""
+
+        self.backend.publish(json.dumps({'id': message_id, 'user_id': user_id}))
+
+    def _deliver(self, payload):
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._fan_out, json.loads(payload))
+
+    def _fan_out(self, event):
+        for callback in list(self._subscribers.get(event['user_id'], ())):
+            try:
+                callback(event)
+            except (asyncio.QueueFull, queue.Full):
+                # A stream that isn't keeping up just misses the ping; its
+                # next delta fetch picks the message up anyway.
+                pass
+
+    # These must run on the hub's loop.
+
+    def _add(self, author_ids, callback):
+        for author_id in author_ids:
+            self._subscribers.setdefault(author_id, set()).add(callback)
+
+    def _remove(self, author_ids, callback):
+        for author_id in author_ids:
+            callbacks = self._subscribers.get(author_id)
+            if callbacks:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self._subscribers[author_id]
+
+    async def stream(self, author_ids, disconnected):
+        """Yield SSE frames for `author_ids` until `disconnected` is done."""
+
+        events = asyncio.Queue(QUEUE_SIZE)
+        self._add(author_ids, events.put_nowait)
+        try:
+            while True:
+                get = asyncio.ensure_future(events.get())
+                done, _ = await asyncio.wait(
+                    {get, disconnected}, timeout=HEARTBEAT,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if get in done:
+                    yield format_event(get.result())
+                else:
+                    get.cancel()
+                    if disconnected in done:
+                        return
+                    yield PING
+        finally:
+            self._remove(author_ids, events.put_nowait)
+
+    def stream_sync(self, author_ids):
+        """Blocking generator of SSE frames, for the WSGI fallback."""
+
+        loop = self.ensure_loop()
+        events = queue.Queue(QUEUE_SIZE)
+        loop.call_soon_threadsafe(self._add, author_ids, events.put_nowait)
+        try:
+            yield PING
+            while True:
+                try:
+                    yield format_event(events.get(timeout=HEARTBEAT))
+                except queue.Empty:
+                    yield PING
+        finally:
+            loop.call_soon_threadsafe(self._remove, author_ids, events.put_nowait)
+
+
+##############################################################################
+# ASGI app
+
+
+def session_user_id(flask_app, headers, session_key):
+    """The logged-in user id from the Flask session cookie, if any."""
+
+    cookie_header = headers.get(b'cookie', b'').decode('latin-1')
+    morsel = SimpleCookie(cookie_header).get(flask_app.config['SESSION_COOKIE_NAME'])
+    if morsel is None:
+        return None
+
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        data = serializer.loads(
+            morsel.value,
+            max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return None
+    return data.get(session_key)
+
+
+def asgi_app(flask_app, hub, followed_ids, session_key):
+    """An ASGI app serving ``GET /stream`` for the logged-in user.
+
+    The user is whoever `session_key` in the Flask session cookie names.
+    `followed_ids(user_id)` is called (in a thread, inside an app context)
+    to find whose warbles the stream should carry.
+    """
+
+    def load_authors(user_id):
+        with flask_app.app_context():
+            return set(followed_ids(user_id)) | {user_id}
+
+    async def respond(send, status, body=b''):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        if scope['path'] != '/stream':
+            return await respond(send, 404, b'Not found.')
+
+        user_id = session_user_id(flask_app, dict(scope['headers']), session_key)
+        if user_id is None:
+            return await respond(send, 401, b'Login required.')
+
+        loop = asyncio.get_running_loop()
+        hub.bind(loop)
+        author_ids = await loop.run_in_executor(None, load_authors, user_id)
+
+        async def wait_for_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        disconnected = asyncio.ensure_future(wait_for_disconnect())
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'),
+                                (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        try:
+            async for frame in hub.stream(author_ids, disconnected):
+                await send({'type': 'http.response.body', 'body': frame,
+                            'more_body': True})
+        finally:
+            disconnected.cancel()
+        await send({'type': 'http.response.body', 'body': b''})
+
+    return app
@@ -0,0 +1,261 @@
+"""Uploaded avatars and header images, stored locally in fixed sizes.
+
+Profile pictures used to be any URL, so every timeline pulled full-size
+images from third-party hosts. An upload is stored once under MEDIA_DIR,
+named by the SHA-256 of its bytes, so the same picture uploaded twice is
+one file. The user's ``image_url``/``header_image_url`` becomes
+``/media/<digest>``.
+
+A worker pool decodes each upload once and writes the VARIANTS its KIND
+needs: square 'timeline' (48px) and 'card' (128px) avatars, and a 'hero'
+header no bigger than 1500x500, all as JPEG. Templates pick a variant
+with `media_url`. Other URLs (the defaults, older external ones) pass
+through unchanged. Variants are served as
+``/media/<digest>/<variant>.jpg``. A URL's content never changes, so its
+response can be cached forever. A variant that isn't ready yet is waited
+for briefly, then the original is served uncached in its place.
+
+Each kind an upload was saved as is marked by an empty ``<kind>.kind``
+file beside it, so variants missing for any stored upload (after a crash,
+or once a new variant is added) are rendered for its kinds only, like:
+
+    python media.py render
+"""
+
+import hashlib
+import io
+import os
+import re
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, get_ident
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+URL_PREFIX = '/media/'
+
+# name -> (how to fit it, (width, height)). Renaming a variant gives it new
+# URLs, so change the name along with its size.
+VARIANTS = {
+    'timeline': ('crop', (48, 48)),
+    'card': ('crop', (128, 128)),
+    'hero': ('shrink', (1500, 500)),
+}
+
+# What each kind of upload is shown as.
+KINDS = {
+    'avatar': ('timeline', 'card'),
+    'header': ('hero',),
+}
+
+MAX_BYTES = 5 * 1024 * 1024
+# Larger images are refused before decoding (decompression bombs).
+MAX_PIXELS = 40_000_000
+QUALITY = 85
+
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+
+class BadImage(ValueError):
+    """An upload that isn't an image we can use."""
+
+
+def media_url(url, variant):
+    """The URL of `variant` of image `url`, if it's an upload; else `url`."""
+
+    if url and url.startswith(URL_PREFIX):
+        return f"{url}/{variant}.jpg"
+    return url
+
+
+def kind_of(variant):
+    return next(kind for kind, variants in KINDS.items() if variant in variants)
+
+
+class MediaStore:
+    """Content-addressed uploads under `root`, and a pool of `workers`
+    threads rendering their variants."""
+
+    def __init__(self, root, workers=2):
+        self.root = root
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='media')
+        self._pending = {}
+        self._lock = Lock()
+
+    def _path(self, digest, name):
+        return os.path.join(self.root, digest[:2], digest, name)
+
+    def original_path(self, digest):
+        return self._path(digest, 'original')
+
+    def variant_path(self, digest, variant):
+        return self._path(digest, f"{variant}.jpg")
+
+    def kind_path(self, digest, kind):
+        return self._path(digest, f"{kind}.kind")
+
+    def save(self, data, kind):
+        """Store uploaded bytes `data` as a `kind` image and queue its
+        variants; returns its URL. Raises BadImage."""
+
+        if len(data) > MAX_BYTES:
+            raise BadImage("Images can be at most 5 MB.")
+        try:
+            # Only reads the header; the pixels are decoded by the worker.
+            with Image.open(io.BytesIO(data)) as image:
+                width, height = image.size
+                image.verify()
+        except (UnidentifiedImageError, OSError, SyntaxError):
+            raise BadImage("That file isn't an image we can read.")
+        if width * height > MAX_PIXELS:
+            raise BadImage("That image is too large.")
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.original_path(digest)
+        if not os.path.exists(path):
+            _write(path, data)
+        if not os.path.exists(self.kind_path(digest, kind)):
+            _write(self.kind_path(digest, kind), b'')
+        self.submit(digest, KINDS[kind])
+        return URL_PREFIX + digest
+
+    def discard(self, digest):
+        """Delete upload `digest` and its variants, once any queued renders
+        of it are done. Only for an upload nothing refers to."""
+
+        with self._lock:
+            futures = [future for (pending, _), future in self._pending.items()
+                       if pending == digest]
+        for future in futures:
+            future.exception()
+        shutil.rmtree(os.path.dirname(self.original_path(digest)), ignore_errors=True)
+
+    def close(self):
+        """Wait for queued renders, then stop the pool."""
+
+        self._pool.shutdown(wait=True)
+
+    def submit(self, digest, variants):
+        """Queue `variants` of `digest` to be rendered; returns the Future
+        (shared with an identical job already queued)."""
+
+        key = (digest, tuple(variants))
+        with self._lock:
+            future = self._pending.get(key)
+            queued = future is None
+            if queued:
+                future = self._pool.submit(self.render, digest, variants)
+                self._pending[key] = future
+        # Outside the lock: a job already done runs the callback right here.
+        if queued:
+            future.add_done_callback(lambda _: self._forget(key))
+        return future
+
+    def _forget(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def render(self, digest, variants):
+        """Decode `digest`'s original once and write whichever of
+        `variants` are missing."""
+
+        missing = [variant for variant in variants
+                   if not os.path.exists(self.variant_path(digest, variant))]
+        if not missing:
+            return
+
+        with Image.open(self.original_path(digest)) as image:
+            # JPEGs can decode straight at a fraction of their size.
+            image.draft('RGB', max((VARIANTS[variant][1] for variant in missing),
+                                   key=lambda size: size[0] * size[1]))
+            image = _flatten(ImageOps.exif_transpose(image))
+
+        for variant in missing:
+            fit, size = VARIANTS[variant]
+            if fit == 'crop':
+                resized = ImageOps.fit(image, size, Image.LANCZOS)
+            else:
+                resized = image.copy()
+                resized.thumbnail(size, Image.LANCZOS)
+            out = io.BytesIO()
+            resized.save(out, 'JPEG', quality=QUALITY, optimize=True, progressive=True)
+            _write(self.variant_path(digest, variant), out.getvalue())
+
+    def ready(self, digest, variant, timeout=0):
+        """Is `variant` of `digest` on disk? Waits up to `timeout` secs for
+        it to be rendered if the original is there."""
+
+        if os.path.exists(self.variant_path(digest, variant)):
+            return True
+        if not timeout or not os.path.exists(self.original_path(digest)):
+            return False
+        try:
+            self.submit(digest, KINDS[kind_of(variant)]).result(timeout)
+        except Exception:
+            return False
+        return os.path.exists(self.variant_path(digest, variant))
+
+    def digests(self):
+        """Every stored upload's digest."""
+
+        for shard in sorted(os.listdir(self.root)) if os.path.isdir(self.root) else ():
+            for digest in sorted(os.listdir(os.path.join(self.root, shard))):
+                if DIGEST.match(digest):
+                    yield digest
+
+    def kinds(self, digest):
+        """The kinds `digest` was uploaded as. Uploads stored before kinds
+        were marked go by the variants they have (or, with none, every kind)."""
+
+        kinds = [kind for kind in KINDS if os.path.exists(self.kind_path(digest, kind))]
+        return kinds or [kind for kind, variants in KINDS.items()
+                         if any(os.path.exists(self.variant_path(digest, variant))
+                                for variant in variants)] or list(KINDS)
+
+    def render_missing(self):
+        """Render every variant missing for any upload's kinds; returns how
+        many uploads were checked."""
+
+        futures = [self.submit(digest, [variant for kind in self.kinds(digest)
+                                        for variant in KINDS[kind]])
+                   for digest in self.digests()]
+        for future in futures:
+            future.result()
+        return len(futures)
+
+    def mimetype(self, digest):
+        """The original's content type, from its header."""
+
+        with Image.open(self.original_path(digest)) as image:
+            return image.get_format_mimetype()
+
+
+def _flatten(image):
+    """`image` as RGB, with any transparency on white."""
+
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _write(path, data):
+    """Write `data` to `path` all at once, so readers never see part of it."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.{os.getpid()}.{get_ident()}.partial"
+    with open(partial, 'wb') as f:
+        f.write(data)
+    os.replace(partial, path)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['render']:
+        sys.exit(__doc__)
+
+    from app import media_store
+
+    print(f"Checked {media_store.render_missing()} uploads.")
@@ -0,0 +1,72 @@
+"""Schema migrations, for databases made before a change to their tables.
+
+``db.create_all()`` at startup makes any table that's missing, but never
+changes one that already exists: a new column, key or index on an existing
+table needs a script. Each is a SQL file in migrations/, applied in name
+order, once per database, and recorded in ``schema_migrations``.
+
+Scripts are written so that they also run cleanly on a database that
+create_all has already given the new schema (``IF NOT EXISTS`` and the
+like), so a new database can be migrated as well. They are for Postgres.
+
+Stop the app, migrate, then start the new version:
+
+    python migrate.py
+"""
+
+import os
+import sys
+from datetime import datetime
+
+from sqlalchemy import (MetaData, Table, Column, String, DateTime, create_engine,
+                        insert, select)
+
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('name', String(200), primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def scripts(directory=DIRECTORY):
+    """(name, path) of every migration script, in the order they apply."""
+
+    return [(name[:-len('.sql')], os.path.join(directory, name))
+            for name in sorted(os.listdir(directory)) if name.endswith('.sql')]
+
+
+def upgrade(engine, directory=DIRECTORY):
+    """Apply the scripts `engine`'s database hasn't had, each in its own
+    transaction; returns their names."""
+
+    metadata.create_all(engine)
+    with engine.connect() as conn:
+        done = set(conn.execute(select(schema_migrations.c.name)).scalars())
+
+    applied = []
+    for name, path in scripts(directory):
+        if name in done:
+            continue
+        with open(path) as f:
+            sql = f.read()
+        with engine.begin() as conn:
+            conn.exec_driver_sql(sql)
+            conn.execute(insert(schema_migrations).values(
+                name=name, applied_at=datetime.utcnow()))
+        applied.append(name)
+    return applied
+
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        sys.exit(__doc__)
+
+    # Not through app.py: importing it starts workers that would query the
+    # tables before they're migrated.
+    engine = create_engine(os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+    applied = upgrade(engine)
+    print(f"Applied {', '.join(applied)}." if applied else "Up to date.")
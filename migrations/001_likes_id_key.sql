@@ -0,0 +1,29 @@
+-- user-027: likes get their own id key, and at most one row per
+-- (user_id, message_id), so liking twice is a no-op.
+--
+-- Databases from before this keyed likes on (id, user_id, message_id), and
+-- id had no default: the same like could be stored twice, and two likes
+-- could share an id.
+
+CREATE SEQUENCE IF NOT EXISTS likes_id_seq OWNED BY likes.id;
+SELECT setval('likes_id_seq', COALESCE((SELECT max(id) FROM likes), 0) + 1, false);
+ALTER TABLE likes ALTER COLUMN id SET DEFAULT nextval('likes_id_seq');
+
+-- Keep the first of each repeated like, then give shared ids new ones.
+DELETE FROM likes a
+ USING likes b
+ WHERE a.user_id = b.user_id
+   AND a.message_id = b.message_id
+   AND (a.id, a.ctid) > (b.id, b.ctid);
+
+UPDATE likes
+   SET id = nextval('likes_id_seq')
+ WHERE ctid IN (SELECT ctid
+                  FROM (SELECT ctid, row_number() OVER (PARTITION BY id ORDER BY ctid) AS n
+                          FROM likes) numbered
+                 WHERE n > 1);
+
+ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_pkey;
+ALTER TABLE likes ADD PRIMARY KEY (id);
+ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_user_id_message_id_key;
+ALTER TABLE likes ADD CONSTRAINT likes_user_id_message_id_key UNIQUE (user_id, message_id);
@@ -0,0 +1,5 @@
+-- user-029: deleting an account or a warble tombstones it first, and the
+-- deletion worker purges it later.
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP WITHOUT TIME ZONE;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP WITHOUT TIME ZONE;
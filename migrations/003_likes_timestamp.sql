@@ -0,0 +1,20 @@
+-- user-050: likes record when they were made, and a user's liked page is
+-- read newest like first through (user_id, timestamp, message_id).
+--
+-- Likes from before this have no time of their own; the liked message's
+-- time is the closest we have (a like can't be older than its message).
+
+ALTER TABLE likes ADD COLUMN IF NOT EXISTS timestamp TIMESTAMP WITHOUT TIME ZONE;
+
+UPDATE likes
+   SET timestamp = messages.timestamp
+  FROM messages
+ WHERE likes.message_id = messages.id
+   AND likes.timestamp IS NULL;
+
+UPDATE likes SET timestamp = now() AT TIME ZONE 'utc' WHERE timestamp IS NULL;
+
+ALTER TABLE likes ALTER COLUMN timestamp SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS ix_likes_user_id_timestamp_message_id
+    ON likes (user_id, timestamp, message_id);
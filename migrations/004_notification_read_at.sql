@@ -0,0 +1,6 @@
+-- user-040: the unread count is of notification groups with something new
+-- since the user last read them, so counters remember when that was.
+--
+-- (notification_actors is a new table; the app creates it on start.)
+
+ALTER TABLE IF EXISTS notification_counters ADD COLUMN IF NOT EXISTS read_at TIMESTAMP WITHOUT TIME ZONE;
@@ -0,0 +1,6 @@
+-- user-029: a purge step that fails is recorded on its job, and the job is
+-- put off for a while, so it can't hold up the jobs queued behind it.
+
+ALTER TABLE IF EXISTS deletion_jobs ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE IF EXISTS deletion_jobs ADD COLUMN IF NOT EXISTS last_error TEXT;
+ALTER TABLE IF EXISTS deletion_jobs ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP WITHOUT TIME ZONE;
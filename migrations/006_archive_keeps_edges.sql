@@ -0,0 +1,11 @@
+-- user-043: archiving a month moves its messages out of the table but
+-- keeps their likes and re-warbles, so those no longer reference messages.
+-- (The purge worker deletes them along with their message instead.)
+--
+-- Also the index timelines and profiles read a user's messages through,
+-- for databases made before it.
+
+ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey;
+ALTER TABLE IF EXISTS rewarbles DROP CONSTRAINT IF EXISTS rewarbles_message_id_fkey;
+
+CREATE INDEX IF NOT EXISTS ix_messages_user_id_timestamp ON messages (user_id, timestamp);
@@ -0,0 +1,4 @@
+-- user-044: ids an outbox consumer read past, because their transactions
+-- hadn't committed yet, are kept with its checkpoint and looked for again.
+
+ALTER TABLE IF EXISTS outbox_checkpoints ADD COLUMN IF NOT EXISTS gaps TEXT NOT NULL DEFAULT '{}';
@@ -0,0 +1,7 @@
+-- user-026: with sharding on, messages live only on the shards, so view
+-- counts and notifications no longer reference the messages table. The
+-- purge worker and the archiver delete them along with their message.
+
+ALTER TABLE IF EXISTS message_views DROP CONSTRAINT IF EXISTS message_views_message_id_fkey;
+ALTER TABLE IF EXISTS notification_events DROP CONSTRAINT IF EXISTS notification_events_message_id_fkey;
+ALTER TABLE IF EXISTS notification_groups DROP CONSTRAINT IF EXISTS notification_groups_message_id_fkey;
@@ -1,9 +1,12 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import namedtuple
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -18,6 +21,23 @@ def connect_db(app):
     db.init_app(app)
 
 
+def insert_ignore(table, dialect_name=None):
+    """INSERT into `table` that silently skips rows which already exist.
+
+    Compiles to ``INSERT ... ON CONFLICT DO NOTHING`` so that repeating an
+    insert (a double-click, a retried request) is a no-op instead of an
+    IntegrityError.
+    """
+
+    dialect_name = dialect_name or db.session.get_bind().dialect.name
+
+    if dialect_name == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect_name == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return insert(table).prefix_with('IGNORE')
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -35,11 +55,178 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Make `follower_id` follow `followed_id` (no-op if already)."""
+
+        db.session.execute(insert_ignore(cls.__table__).values(
+            user_following_id=follower_id,
+            user_being_followed_id=followed_id,
+        ))
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Make `follower_id` stop following `followed_id` (no-op if not)."""
+
+        db.session.execute(db.delete(cls).where(
+            cls.user_following_id == follower_id,
+            cls.user_being_followed_id == followed_id,
+        ))
+
+    @classmethod
+    def followed_ids(cls, follower_id):
+        """Ids of the users `follower_id` follows, without loading them."""
+
+        return (db.session
+                .execute(db.select(cls.user_being_followed_id)
+                         .where(cls.user_following_id == follower_id))
+                .scalars()
+                .all())
+
+    @classmethod
+    def follower_ids(cls, followed_id):
+        """Ids of the users following `followed_id`, without loading them."""
+
+        return (db.session
+                .execute(db.select(cls.user_following_id)
+                         .where(cls.user_being_followed_id == followed_id))
+                .scalars()
+                .all())
+
+    @classmethod
+    def follower_count(cls, user_id):
+        """How many (not deleted) users follow `user_id`."""
+
+        return db.session.scalar(
+            db.select(db.func.count())
+            .select_from(cls)
+            .join(User, User.id == cls.user_following_id)
+            .where(cls.user_being_followed_id == user_id,
+                   User.deleted_at.is_(None)))
+
+    @classmethod
+    def following_count(cls, user_id):
+        """How many (not deleted) users `user_id` follows."""
+
+        return db.session.scalar(
+            db.select(db.func.count())
+            .select_from(cls)
+            .join(User, User.id == cls.user_being_followed_id)
+            .where(cls.user_following_id == user_id,
+                   User.deleted_at.is_(None)))
+
+
+class Mutes(db.Model):
+    """A user hiding another's warbles from their timelines."""
+
+    __tablename__ = 'mutes'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    muted_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    @classmethod
+    def add(cls, user_id, other_id):
+        """Make `user_id` mute `other_id` (no-op if already)."""
+
+        db.session.execute(insert_ignore(cls.__table__).values(
+            user_id=user_id,
+            muted_user_id=other_id,
+        ))
+
+    @classmethod
+    def remove(cls, user_id, other_id):
+        """Make `user_id` unmute `other_id` (no-op if not muted)."""
+
+        db.session.execute(db.delete(cls).where(
+            cls.user_id == user_id,
+            cls.muted_user_id == other_id,
+        ))
+
+
+class Blocks(db.Model):
+    """A user cutting another off: neither sees or follows the other."""
+
+    __tablename__ = 'blocks'
+    __table_args__ = (
+        # Who has blocked a user, for their own filter.
+        db.Index('ix_blocks_blocked_user_id', 'blocked_user_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    blocked_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    @classmethod
+    def add(cls, user_id, other_id):
+        """Make `user_id` block `other_id` (no-op if already)."""
+
+        db.session.execute(insert_ignore(cls.__table__).values(
+            user_id=user_id,
+            blocked_user_id=other_id,
+        ))
+
+    @classmethod
+    def remove(cls, user_id, other_id):
+        """Make `user_id` unblock `other_id` (no-op if not blocked)."""
+
+        db.session.execute(db.delete(cls).where(
+            cls.user_id == user_id,
+            cls.blocked_user_id == other_id,
+        ))
+
+
+class LikeSummary(namedtuple('LikeSummary', 'count liked_by')):
+    """How many people like a message, and one of them to name."""
+
+    @property
+    def text(self):
+        others = self.count - 1
+        if not others:
+            return f"Liked by {self.liked_by}"
+        return f"Liked by {self.liked_by} and {others} other{'s' if others > 1 else ''}"
+
+
+class KnownFollowers(namedtuple('KnownFollowers', 'count names')):
+    """How many people the viewer follows also follow someone, and a few
+    of them to name."""
+
+    @property
+    def text(self):
+        others = self.count - len(self.names)
+        named = ", ".join(self.names)
+        if not others:
+            named = " and ".join(named.rsplit(", ", 1))
+            return f"Followed by {named}"
+        return f"Followed by {named} and {others} other{'s' if others > 1 else ''} you follow"
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+        # A user's liked page, newest like first: holds the whole page key,
+        # so each page is one short index range however many likes there are.
+        db.Index('ix_likes_user_id_timestamp_message_id', 'user_id', 'timestamp', 'message_id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -49,15 +236,176 @@ class Likes(db.Model):
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete='cascade'),
-        primary_key=True
+        nullable=False,
     )
 
+    # Not a foreign key: likes outlive their message's move to the archive
+    # (see archive.py). The purge worker deletes them with the message.
     message_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade'),
-        primary_key=True
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
     )
 
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Record that `user_id` likes `message_id` (no-op if already)."""
+
+        db.session.execute(insert_ignore(cls.__table__).values(
+            user_id=user_id,
+            message_id=message_id,
+            timestamp=datetime.utcnow(),
+        ))
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Remove `user_id`'s like of `message_id` (no-op if none)."""
+
+        db.session.execute(db.delete(cls).where(
+            cls.user_id == user_id,
+            cls.message_id == message_id,
+        ))
+
+    @classmethod
+    def liked_ids(cls, user_id, message_ids):
+        """Which of `message_ids` does `user_id` like?"""
+
+        return set(db.session
+                   .execute(db.select(cls.message_id)
+                            .where(cls.user_id == user_id,
+                                   cls.message_id.in_(message_ids)))
+                   .scalars())
+
+    @classmethod
+    def summaries(cls, message_ids, known_ids=()):
+        """{message id: LikeSummary} for `message_ids`, in one query.
+
+        The liker named is preferably someone in `known_ids` (usually the
+        people the viewer follows), else the first liker alphabetically.
+        Messages nobody likes are left out.
+        """
+
+        if not message_ids:
+            return {}
+
+        known_name = db.func.min(db.case(
+            (cls.user_id.in_(list(known_ids)), User.username)))
+        rows = db.session.execute(
+            db.select(cls.message_id,
+                      db.func.count(),
+                      db.func.coalesce(known_name, db.func.min(User.username)))
+            .join(User, User.id == cls.user_id)
+            .where(cls.message_id.in_(message_ids), User.deleted_at.is_(None))
+            .group_by(cls.message_id))
+
+        return {message_id: LikeSummary(count, name)
+                for message_id, count, name in rows}
+
+
+class RewarbleSummary(namedtuple('RewarbleSummary', 'count names')):
+    """How many of the viewer's people re-warbled a message, and a few of
+    them to name."""
+
+    @property
+    def text(self):
+        others = self.count - len(self.names)
+        named = ", ".join(self.names)
+        if not others:
+            named = " and ".join(named.rsplit(", ", 1))
+            return f"Re-warbled by {named}"
+        return f"Re-warbled by {named} and {others} other{'s' if others > 1 else ''}"
+
+
+class Rewarbles(db.Model):
+    """A user re-posting a warble to their followers: just a pointer to
+    the message, never a copy of it."""
+
+    __tablename__ = 'rewarbles'
+    __table_args__ = (
+        # Timelines: the re-warbles of the people a user follows, newest first.
+        db.Index('ix_rewarbles_user_id_timestamp', 'user_id', 'timestamp'),
+        # Who re-warbled a message, for its summary.
+        db.Index('ix_rewarbles_message_id', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # Not a foreign key, like Likes.message_id.
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # How many re-warblers a summary names.
+    NAMED = 2
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Make `user_id` re-warble `message_id` (no-op if already)."""
+
+        db.session.execute(insert_ignore(cls.__table__).values(
+            user_id=user_id,
+            message_id=message_id,
+            timestamp=datetime.utcnow(),
+        ))
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Undo `user_id`'s re-warble of `message_id` (no-op if none)."""
+
+        db.session.execute(db.delete(cls).where(
+            cls.user_id == user_id,
+            cls.message_id == message_id,
+        ))
+
+    @classmethod
+    def rewarbled_ids(cls, user_id, message_ids):
+        """Which of `message_ids` has `user_id` re-warbled?"""
+
+        return set(db.session
+                   .execute(db.select(cls.message_id)
+                            .where(cls.user_id == user_id,
+                                   cls.message_id.in_(message_ids)))
+                   .scalars())
+
+    @classmethod
+    def summaries(cls, message_ids, user_ids):
+        """{message id: RewarbleSummary} of who among `user_ids` re-warbled
+        each of `message_ids`, latest first, in one query. Messages none of
+        them re-warbled are left out."""
+
+        if not message_ids:
+            return {}
+
+        found = {}
+        rows = db.session.execute(
+            db.select(cls.message_id, User.username)
+            .join(User, User.id == cls.user_id)
+            .where(cls.message_id.in_(message_ids),
+                   cls.user_id.in_(list(user_ids)),
+                   User.deleted_at.is_(None))
+            .order_by(cls.timestamp.desc()))
+        for message_id, username in rows:
+            found.setdefault(message_id, []).append(username)
+
+        return {message_id: RewarbleSummary(len(names), names[:cls.NAMED])
+                for message_id, names in found.items()}
+
 
 class User(db.Model):
     """User in the system."""
@@ -104,6 +452,12 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Set when the account is deleted; the rows are purged in the background
+    # (see deletion.py) and the user is hidden everywhere until then.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
 
     followers = db.relationship(
         "User",
@@ -132,12 +486,20 @@ class User(db.Model):
     likes = db.relationship(
         'Message',
         secondary="likes", 
+        primaryjoin="User.id == Likes.user_id",
+        secondaryjoin="Message.id == foreign(Likes.message_id)",
         backref='liked_by'
     )
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @classmethod
+    def active(cls):
+        """Query of users that haven't been deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
@@ -180,7 +542,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -194,6 +556,10 @@ class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        # Timelines and profiles: a user's messages, newest first.
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -208,7 +574,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -217,10 +583,341 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Set when the message is deleted; see User.deleted_at.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     user = db.relationship('User', back_populates='messages')
 
     def __repr__(self):
         return f"<Message #{self.id}: {self.text}, User #{self.user_id}>"
 
+    @classmethod
+    def count_for(cls, user_id):
+        """How many (not deleted) messages `user_id` has posted."""
+
+        return db.session.scalar(
+            db.select(db.func.count())
+            .select_from(cls)
+            .where(cls.user_id == user_id, cls.deleted_at.is_(None)))
+
+    @classmethod
+    def visible(cls):
+        """Query of messages that aren't deleted and whose author isn't."""
+
+        return (cls.query
+                .join(cls.user)
+                .filter(cls.deleted_at.is_(None), User.deleted_at.is_(None)))
+
+
+class MessageViews(db.Model):
+    """HyperLogLog registers of who has seen a message (see views.py)."""
+
+    __tablename__ = 'message_views'
+
+    # Not a foreign key, like Likes.message_id: with sharding on, the
+    # message isn't in this database (see sharding.py).
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    registers = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+
+class NotificationEvent(db.Model):
+    """Something that happened to a user: a like, a follow (append-only).
+
+    Old events are folded into NotificationGroup rows (see notifications.py).
+    """
+
+    __tablename__ = 'notification_events'
+    __table_args__ = (
+        db.Index('ix_notification_events_user_id_id', 'user_id', 'id'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Who is notified.
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # Who did it.
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # 'like', 'follow' or 'follow_back'
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # The message liked, for 'like'. Not a foreign key, like
+    # MessageViews.message_id.
+    message_id = db.Column(
+        db.Integer,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class NotificationGroup(db.Model):
+    """Compacted notification events of one kind, on one message, on one day."""
+
+    __tablename__ = 'notification_groups'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'key'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # "kind:message id:day", what the events are grouped by.
+    key = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Not a foreign key, like MessageViews.message_id.
+    message_id = db.Column(
+        db.Integer,
+    )
+
+    # How many events were folded in.
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # Comma-separated ids of the latest few actors, latest first.
+    actor_ids = db.Column(
+        db.Text,
+        nullable=False,
+        default='',
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class NotificationActor(db.Model):
+    """Someone counted in a notification group, so they're counted once."""
+
+    __tablename__ = 'notification_actors'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # The group's "kind:message id:day" key.
+    key = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # When they were counted (compared with NotificationCounter.read_at).
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
+
+class NotificationCounter(db.Model):
+    """A user's unread notification groups, kept as a running count."""
+
+    __tablename__ = 'notification_counters'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
 
+    unread = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # When the user last read their notifications.
+    read_at = db.Column(
+        db.DateTime,
+    )
 
+
+class DeletionJob(db.Model):
+    """A queued background purge of a deleted user or message."""
+
+    __tablename__ = 'deletion_jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # 'user' or 'message'
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    target_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # Which purge stage the job is on; 'done' once finished.
+    stage = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Rows deleted so far, for progress reporting.
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    # Failed steps in a row, and what the last failure was.
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    # A failing job isn't tried again before this (see deletion.py).
+    next_attempt_at = db.Column(
+        db.DateTime,
+    )
+
+    def __repr__(self):
+        return f"<DeletionJob #{self.id}: {self.kind} #{self.target_id}, {self.stage}>"
+
+
+class OutboxEvent(db.Model):
+    """A change to users, messages, likes or follows, written in the same
+    transaction as the change (see outbox.py)."""
+
+    __tablename__ = 'outbox_events'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # 'message.created', 'like.removed', 'user.deleted', ...
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Who made the change. Not a foreign key: events outlive the rows.
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # The message or user changed, if not `user_id` itself.
+    target_id = db.Column(
+        db.Integer,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    def __repr__(self):
+        return f"<OutboxEvent #{self.id}: {self.kind} by #{self.user_id} on #{self.target_id}>"
+
+
+class OutboxCheckpoint(db.Model):
+    """How far through the outbox a consumer has got."""
+
+    __tablename__ = 'outbox_checkpoints'
+
+    consumer = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # Id of the last event handled.
+    position = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # Ids below the position not yet seen, which an open transaction may
+    # still commit: JSON of {id: xmax} (see outbox.Gaps).
+    gaps = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
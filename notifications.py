@@ -0,0 +1,396 @@
+"""Notifications: "alice and 41 others liked your warble".
+
+Likes and follows are written to ``notification_events``, a row each, and
+never updated. Reading collapses the events of one kind, on one message,
+on one day into a single line. So that a popular account's page doesn't
+re-read thousands of rows, `compact` periodically folds events older than
+COMPACT_AFTER into ``notification_groups`` rows (a count plus the latest
+few actors) and deletes them; a page reads its groups plus whatever recent
+events are left, and collapses both together.
+
+Who has been counted in each group is kept in ``notification_actors``, so
+an actor counts once per group however often they like and unlike, and
+whether or not the group has been compacted since.
+
+Unread notifications are a running count per user
+(``notification_counters``) of the groups with something new since the
+user last read the notifications page, so the nav badge matches the lines
+on it and never counts rows.
+
+Routes don't write events themselves. `from_outbox` is an outbox consumer
+(see outbox.py): it reads the likes and follows the routes recorded there,
+works out follow-backs, drops repeats and inserts the events in the
+transaction that moves its checkpoint, so no notification is lost or
+written twice.
+
+Compaction runs in the app process unless NOTIFICATION_COMPACTION is 0,
+or by hand:
+
+    python notifications.py compact
+"""
+
+import sys
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+from threading import Event, Thread
+
+from sqlalchemy import bindparam, delete, or_, select, tuple_, update
+
+import sharding
+from models import (db, insert_ignore, Follows, NotificationActor,
+                    NotificationCounter, NotificationEvent, NotificationGroup, User)
+
+# Events older than this are folded into groups by `compact`.
+COMPACT_AFTER = timedelta(hours=1)
+COMPACT_INTERVAL = 600
+
+# How many actors a group remembers (to name one that isn't deleted).
+ACTORS_KEPT = 3
+
+# At most this many uncompacted events are collapsed for a page.
+RECENT_EVENTS = 1000
+
+# How long who has been counted in each group is kept, to drop repeats.
+ACTORS_KEPT_FOR = timedelta(days=2)
+
+VERBS = {
+    'like': 'liked your warble',
+    'follow': 'followed you',
+    'follow_back': 'followed you back',
+}
+
+
+class Notification(namedtuple('Notification', 'kind message count actor at')):
+    """A collapsed group of events, naming its latest actor."""
+
+    @property
+    def text(self):
+        others = self.count - 1
+        verb = VERBS[self.kind]
+        if not others:
+            return f"{self.actor} {verb}"
+        return f"{self.actor} and {others} other{'s' if others > 1 else ''} {verb}"
+
+
+_Group = namedtuple('_Group', 'kind message_id count actor_ids at')
+
+
+def group_key(kind, message_id, when):
+    """What events are grouped by: kind, message and day."""
+
+    return f"{kind}:{message_id or ''}:{when.date().isoformat()}"
+
+
+def _latest(actor_ids):
+    """The first ACTORS_KEPT distinct ids of `actor_ids`."""
+
+    return list(dict.fromkeys(actor_ids))[:ACTORS_KEPT]
+
+
+def _merged(newer, older):
+    # An actor is counted in one or the other (see `write`), so the counts add up.
+    return _Group(newer.kind, newer.message_id, newer.count + older.count,
+                  _latest(newer.actor_ids + older.actor_ids),
+                  max(newer.at, older.at))
+
+
+def collapse(events):
+    """{(user id, group key): _Group} of events.
+
+    `events` are (user id, actor id, kind, message id, created at) rows. A
+    group counts each actor once and keeps the latest ones, latest first.
+    """
+
+    actors = {}
+    found = {}
+    for user_id, actor_id, kind, message_id, created_at in sorted(
+            events, key=lambda event: event[4], reverse=True):
+        key = (user_id, group_key(kind, message_id, created_at))
+        if key not in found:
+            found[key] = (kind, message_id, created_at)
+            actors[key] = {}
+        actors[key][actor_id] = None
+
+    return {key: _Group(kind, message_id, len(actors[key]),
+                        _latest(actors[key]), created_at)
+            for key, (kind, message_id, created_at) in found.items()}
+
+
+def from_outbox(events):
+    """Outbox consumer: notify users of the likes and follows in `events`.
+
+    A like notifies the message's author, a follow the user followed.
+    """
+
+    authors = sharding.message_authors(
+        {event.target_id for event in events if event.kind == 'like.added'}, deleted=True)
+
+    batch = []
+    for event in events:
+        if event.kind == 'like.added' and event.target_id in authors:
+            batch.append((authors[event.target_id], event.user_id, 'like',
+                          event.target_id, event.created_at))
+        elif event.kind == 'follow.added':
+            batch.append((event.target_id, event.user_id, 'follow', None, event.created_at))
+    return write(batch)
+
+
+def write(batch):
+    """Insert (user id, actor id, kind, message id, created at) events;
+    returns how many were new. Caller commits.
+
+    A 'follow' is written as 'follow_back' if the user already follows the
+    actor by then. Each actor counts once in a group: a repeat (a
+    double-click, a re-like) is dropped, even once the group is compacted.
+    """
+
+    events = NotificationEvent.__table__
+    actors = NotificationActor.__table__
+    counters = NotificationCounter.__table__
+
+    batch = [e for e in batch if e[0] != e[1]]
+    if not batch:
+        return 0
+
+    # Skip events about accounts or messages deleted in the meantime.
+    live_users = set(db.session.execute(
+        select(User.id).where(User.id.in_({e[0] for e in batch} | {e[1] for e in batch}),
+                              User.deleted_at.is_(None))).scalars())
+    message_ids = {e[3] for e in batch if e[3] is not None}
+    live_messages = set(sharding.message_authors(message_ids))
+    batch = [e for e in batch
+             if e[0] in live_users and e[1] in live_users
+             and (e[3] is None or e[3] in live_messages)]
+
+    follows = {(e[0], e[1]) for e in batch if e[2] == 'follow'}
+    back = set()
+    if follows:
+        back = set(db.session.execute(
+            select(Follows.user_following_id, Follows.user_being_followed_id)
+            .where(tuple_(Follows.user_following_id,
+                          Follows.user_being_followed_id).in_(follows))).all())
+
+    # (user id, group key, actor id) -> (kind, message id, created at)
+    keyed = {}
+    for user_id, actor_id, kind, message_id, created_at in batch:
+        if kind == 'follow' and (user_id, actor_id) in back:
+            kind = 'follow_back'
+        keyed.setdefault((user_id, group_key(kind, message_id, created_at), actor_id),
+                         (kind, message_id, created_at))
+    if not keyed:
+        return 0
+
+    # Groups already unread: some actor was counted in them since the
+    # user last read their notifications.
+    groups = list({(user_id, key) for user_id, key, _ in keyed})
+    unread = set(db.session.execute(
+        select(actors.c.user_id, actors.c.key)
+        .distinct()
+        .select_from(actors.outerjoin(counters, counters.c.user_id == actors.c.user_id))
+        .where(tuple_(actors.c.user_id, actors.c.key).in_(groups),
+               or_(counters.c.read_at.is_(None),
+                   actors.c.created_at > counters.c.read_at))).all())
+
+    now = datetime.utcnow()
+    new = db.session.execute(
+        insert_ignore(actors).returning(actors.c.user_id, actors.c.key, actors.c.actor_id),
+        [{'user_id': user_id, 'key': key, 'actor_id': actor_id, 'created_at': now}
+         for user_id, key, actor_id in sorted(keyed)]).all()
+    if not new:
+        return 0
+
+    rows = []
+    for user_id, key, actor_id in new:
+        kind, message_id, created_at = keyed[(user_id, key, actor_id)]
+        rows.append({'user_id': user_id, 'actor_id': actor_id, 'kind': kind,
+                     'message_id': message_id, 'created_at': created_at})
+    db.session.execute(events.insert(), rows)
+
+    newly_unread = {(user_id, key) for user_id, key, _ in new} - unread
+    if newly_unread:
+        _bump_unread(Counter(user_id for user_id, _ in newly_unread))
+    return len(rows)
+
+
+def _bump_unread(counts):
+    """Add {user id: n} to the users' unread counters."""
+
+    counters = NotificationCounter.__table__
+    db.session.execute(insert_ignore(counters), [
+        {'user_id': user_id, 'unread': 0} for user_id in counts
+    ])
+    # Update in id order, so concurrent batches can't deadlock.
+    db.session.execute(
+        update(counters)
+        .where(counters.c.user_id == bindparam('uid'))
+        .values(unread=counters.c.unread + bindparam('n')),
+        [{'uid': user_id, 'n': counts[user_id]} for user_id in sorted(counts)])
+
+
+def unread_count(user_id):
+    """How many notifications (collapsed groups) `user_id` hasn't seen."""
+
+    return db.session.scalar(
+        select(NotificationCounter.unread)
+        .where(NotificationCounter.user_id == user_id)) or 0
+
+
+def mark_read(user_id):
+    """Zero `user_id`'s unread count. Caller commits."""
+
+    db.session.execute(
+        update(NotificationCounter)
+        .where(NotificationCounter.user_id == user_id)
+        .values(unread=0, read_at=datetime.utcnow()))
+
+
+def notifications_for(user_id, limit=50):
+    """[Notification] for `user_id`, latest first.
+
+    Groups whose message was deleted, or whose remembered actors all were,
+    are left out.
+    """
+
+    events = NotificationEvent.__table__
+    groups = NotificationGroup.__table__
+
+    recent = db.session.execute(
+        select(events.c.user_id, events.c.actor_id, events.c.kind,
+               events.c.message_id, events.c.created_at)
+        .where(events.c.user_id == user_id)
+        .order_by(events.c.id.desc())
+        .limit(RECENT_EVENTS)).all()
+    found = {key: group for (_, key), group in collapse(recent).items()}
+
+    stored = db.session.execute(
+        select(groups.c.key, groups.c.kind, groups.c.message_id, groups.c.count,
+               groups.c.actor_ids, groups.c.updated_at)
+        .where(groups.c.user_id == user_id)
+        .order_by(groups.c.updated_at.desc())
+        .limit(limit)).all()
+    for key, kind, message_id, count, actor_ids, updated_at in stored:
+        older = _Group(kind, message_id, count,
+                       [int(a) for a in actor_ids.split(',') if a], updated_at)
+        found[key] = _merged(found[key], older) if key in found else older
+
+    latest = sorted(found.values(), key=lambda group: group.at, reverse=True)[:limit]
+
+    actor_ids = {actor_id for group in latest for actor_id in group.actor_ids}
+    names = dict(db.session.execute(
+        select(User.id, User.username)
+        .where(User.id.in_(actor_ids), User.deleted_at.is_(None))).all()
+        if actor_ids else ())
+    message_ids = {group.message_id for group in latest if group.message_id is not None}
+    messages = sharding.visible_messages(message_ids)
+
+    result = []
+    for group in latest:
+        actor = next((names[a] for a in group.actor_ids if a in names), None)
+        if actor is None or (group.message_id is not None
+                             and group.message_id not in messages):
+            continue
+        result.append(Notification(group.kind, messages.get(group.message_id),
+                                   group.count, actor, group.at))
+    return result
+
+
+def _compact_some(cutoff, chunk):
+    events = NotificationEvent.__table__
+    groups = NotificationGroup.__table__
+
+    rows = db.session.execute(
+        select(events.c.id, events.c.user_id, events.c.actor_id, events.c.kind,
+               events.c.message_id, events.c.created_at)
+        .where(events.c.created_at < cutoff)
+        .order_by(events.c.id)
+        .limit(chunk)
+        .with_for_update(skip_locked=True)).all()
+    if not rows:
+        db.session.commit()
+        return 0
+
+    collapsed = collapse(row[1:] for row in rows)
+    db.session.execute(insert_ignore(groups), [
+        {'user_id': user_id, 'key': key, 'kind': group.kind,
+         'message_id': group.message_id, 'count': 0, 'actor_ids': '',
+         'updated_at': group.at}
+        for (user_id, key), group in collapsed.items()
+    ])
+    stored = db.session.execute(
+        select(groups.c.id, groups.c.user_id, groups.c.key, groups.c.count,
+               groups.c.actor_ids, groups.c.updated_at)
+        .where(tuple_(groups.c.user_id, groups.c.key).in_(list(collapsed)))
+        .order_by(groups.c.id)
+        .with_for_update()).all()
+
+    updates = []
+    for group_id, user_id, key, count, actor_ids, updated_at in stored:
+        newer = collapsed[(user_id, key)]
+        older = _Group(newer.kind, newer.message_id, count,
+                       [int(a) for a in actor_ids.split(',') if a], updated_at)
+        group = _merged(newer, older)
+        updates.append({'gid': group_id, 'n': group.count,
+                        'actors': ','.join(map(str, group.actor_ids)),
+                        'at': group.at})
+    db.session.execute(
+        update(groups)
+        .where(groups.c.id == bindparam('gid'))
+        .values(count=bindparam('n'), actor_ids=bindparam('actors'),
+                updated_at=bindparam('at')),
+        updates)
+    db.session.execute(delete(events).where(events.c.id.in_([row.id for row in rows])))
+    db.session.commit()
+    return len(rows)
+
+
+def compact(older_than=COMPACT_AFTER, chunk=1000, now=None):
+    """Fold events older than `older_than` into groups (in app context).
+
+    Each chunk is folded and deleted in its own transaction; events are
+    claimed with SKIP LOCKED, so compactions can overlap. Returns how many
+    events were folded.
+    """
+
+    now = now or datetime.utcnow()
+    cutoff = now - older_than
+    folded = 0
+    while True:
+        count = _compact_some(cutoff, chunk)
+        if not count:
+            break
+        folded += count
+
+    # A group takes events of one day, so who's in it stops mattering soon
+    # after (unless the outbox runner was down longer than ACTORS_KEPT_FOR).
+    actors = NotificationActor.__table__
+    db.session.execute(delete(actors).where(actors.c.created_at < now - ACTORS_KEPT_FOR))
+    db.session.commit()
+    return folded
+
+
+def start_compactor(app, interval=COMPACT_INTERVAL):
+    """Run `compact` every `interval` secs in a background thread; returns
+    its stop Event."""
+
+    stop = Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                with app.app_context():
+                    compact()
+            except Exception as exc:
+                app.logger.exception("Notification compaction failed: %s", exc)
+
+    Thread(target=run, daemon=True).start()
+    return stop
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['compact']:
+        sys.exit(__doc__)
+
+    from app import app
+
+    with app.app_context():
+        print(f"Folded {compact()} notification events.")
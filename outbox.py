@@ -0,0 +1,335 @@
+"""Transactional outbox: a log of every change, for work off the request path.
+
+Each write (``messages_add``, ``messages_destroy``, likes, re-warbles,
+follows, mutes, blocks, ``edit_profile``, ``delete_user``) also inserts a
+small ``outbox_events`` row, in the same transaction as the change. So an
+event exists exactly when its change was committed, and nothing has to be
+sent while the request waits.
+
+Consumers are functions taking a list of events, registered by name (see
+``OUTBOX_CONSUMERS`` in app.py). The runner tails the outbox for each one
+in id order and batches, and moves the consumer's checkpoint past a batch
+in the transaction the batch was handled in. Delivery is at-least-once: a
+consumer that raises, or a runner that dies before committing, gets the
+same batch again. Database writes a consumer makes commit along with its
+checkpoint, so they happen once; anything else it does should be safe to
+repeat.
+
+Ids are handed out as rows are inserted, not as they commit, so a gap in
+ids may be a transaction that is still going. The runner reads past it,
+and keeps the missing ids with the checkpoint (see `Gaps`): each is looked
+for again on every read until the transactions that could hold it have
+all finished, however long they ran. An event that turns up late is
+delivered then, out of id order.
+
+Consumers run on a runner, so a request doesn't see its own change in
+what they keep (e.g. the cache) straight away. `handled` says whether a
+consumer has got to an event yet; app.py uses it to serve a user fresh
+data until their own last change has been handled.
+
+The runner also prunes events every consumer is done with, every
+PRUNE_EVERY. Run the consumers, or prune, from the command line like:
+
+    python outbox.py run
+    python outbox.py prune
+"""
+
+import json
+import sys
+from datetime import datetime, timedelta
+from threading import Event, Thread
+
+from sqlalchemy import delete, func, insert, or_, select, text
+
+from models import db, insert_ignore, OutboxCheckpoint, OutboxEvent
+
+BATCH_SIZE = 500
+
+# How long handled events are kept (for new consumers, and replays), and
+# how often the runner deletes older ones.
+KEEP = timedelta(days=7)
+PRUNE_EVERY = timedelta(hours=1)
+
+KINDS = (
+    'message.created', 'message.deleted',
+    'like.added', 'like.removed',
+    'rewarble.added', 'rewarble.removed',
+    'follow.added', 'follow.removed',
+    'mute.added', 'mute.removed',
+    'block.added', 'block.removed',
+    'user.updated', 'user.deleted',
+)
+
+
+def record_many(events):
+    """Add (kind, user_id, target_id) events to the outbox. Caller commits,
+    along with the changes they describe.
+
+    The newest id recorded is kept in the session's ``info`` as
+    'outbox_newest' (see `handled`)."""
+
+    rows = [dict(kind=kind, user_id=user_id, target_id=target_id)
+            for kind, user_id, target_id in events]
+    if rows:
+        ids = db.session.execute(insert(OutboxEvent).returning(OutboxEvent.id), rows).scalars()
+        db.session.info['outbox_newest'] = max(ids)
+
+
+def record(kind, user_id, target_id=None):
+    """Add one `kind` event to the outbox. Caller commits."""
+
+    record_many([(kind, user_id, target_id)])
+
+
+def handled(name, event_id):
+    """Has consumer `name` been handed event `event_id`?"""
+
+    checkpoint = db.session.execute(
+        select(OutboxCheckpoint.position, OutboxCheckpoint.gaps)
+        .where(OutboxCheckpoint.consumer == name)).first()
+    return (checkpoint is not None and checkpoint.position >= event_id
+            and event_id not in Gaps.loads(checkpoint.gaps))
+
+
+def horizon():
+    """(xmin, xmax) of a fresh snapshot: every transaction below xmin has
+    finished, and every one still running is below xmax."""
+
+    return tuple(db.session.execute(text(
+        "SELECT pg_snapshot_xmin(s)::text::bigint, pg_snapshot_xmax(s)::text::bigint "
+        "FROM pg_current_snapshot() AS s")).one())
+
+
+class Gaps:
+    """Ids skipped over while reading a table forward by id.
+
+    A missing id below the newest one read may belong to a transaction
+    that hasn't committed yet. Each is kept with the xmax of a snapshot
+    taken just after it was seen missing, and looked for again on every
+    read until ``horizon()``'s xmin passes that: by then the transaction
+    that took it has finished, however long it ran, and its row was either
+    read or rolled back.
+    """
+
+    def __init__(self, pending=None):
+        # id -> xmax when it was seen missing
+        self.pending = dict(pending or {})
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __contains__(self, event_id):
+        return event_id in self.pending
+
+    def ids(self):
+        return list(self.pending)
+
+    def dumps(self):
+        return json.dumps(self.pending)
+
+    @classmethod
+    def loads(cls, dumped):
+        return cls({int(missing): xmax for missing, xmax in json.loads(dumped or '{}').items()})
+
+    def note(self, position, ids, xmax):
+        """Record the ids missing between `position` and each of `ids`
+        (sorted, all above it)."""
+
+        expected = position + 1
+        for found in ids:
+            for missing in range(expected, found):
+                self.pending[missing] = xmax
+            expected = found + 1
+
+    def found(self, ids):
+        for found in ids:
+            self.pending.pop(found, None)
+
+    def settle(self, xmin):
+        """Forget the ids whose transactions have all finished by `xmin`."""
+
+        self.pending = {missing: xmax for missing, xmax in self.pending.items() if xmax > xmin}
+
+
+class Tail:
+    """Read the outbox forward from a position kept in memory.
+
+    For consumers whose state lives in one process (so every process needs
+    every event), instead of a shared checkpoint. Gaps are tracked by id
+    (see `Gaps`), so late commits are still read, once.
+    """
+
+    def __init__(self, position=0):
+        self.position = position
+        self.gaps = Gaps()
+
+    def start(self, lookback=BATCH_SIZE):
+        """Begin at the newest event (inside an app context), minding the
+        gaps among the last `lookback` ids."""
+
+        position = db.session.scalar(select(func.max(OutboxEvent.id))) or 0
+        floor = max(position - lookback, 0)
+        ids = db.session.execute(
+            select(OutboxEvent.id)
+            .where(OutboxEvent.id > floor)
+            .order_by(OutboxEvent.id)).scalars().all()
+        self.gaps.note(floor, ids, horizon()[1])
+        self.position = position
+
+    def read(self, batch_size=BATCH_SIZE):
+        """Events past the position, and any that have filled a gap, in id
+        order (inside an app context)."""
+
+        events, self.position = _read(self.position, self.gaps, batch_size)
+        return events
+
+
+def _read(position, gaps, batch_size):
+    """Up to `batch_size` events past `position`, and any that have filled
+    one of `gaps` (which is updated), in id order; and the new position."""
+
+    xmin, _ = horizon()
+    where = OutboxEvent.id > position
+    if len(gaps):
+        where = or_(where, OutboxEvent.id.in_(gaps.ids()))
+    events = (db.session
+              .execute(select(OutboxEvent).where(where).order_by(OutboxEvent.id)
+                       .limit(batch_size))
+              .scalars()
+              .all())
+    new = [event.id for event in events if event.id > position]
+    gaps.found(event.id for event in events if event.id <= position)
+    if new:
+        gaps.note(position, new, horizon()[1])
+        position = new[-1]
+    gaps.settle(xmin)
+    return events, position
+
+
+def _checkpoint(name):
+    """Lock `name`'s checkpoint row, creating it the first time; None if
+    another runner has it."""
+
+    db.session.execute(insert_ignore(OutboxCheckpoint.__table__).values(
+        consumer=name, position=0, gaps='{}', updated_at=datetime.utcnow()))
+    return (OutboxCheckpoint
+            .query
+            .filter_by(consumer=name)
+            .with_for_update(skip_locked=True)
+            .first())
+
+
+def deliver(name, handle, batch_size=BATCH_SIZE):
+    """Hand consumer `name` its next batch of events; returns how many.
+
+    The checkpoint is locked (SKIP LOCKED) while `handle` runs, so several
+    runners can share the consumers without handing out a batch twice.
+    """
+
+    checkpoint = _checkpoint(name)
+    if checkpoint is None:
+        db.session.commit()
+        return 0
+
+    gaps = Gaps.loads(checkpoint.gaps)
+    events, position = _read(checkpoint.position, gaps, batch_size)
+    if events:
+        try:
+            handle(events)
+        except Exception:
+            db.session.rollback()
+            raise
+    checkpoint.position = position
+    checkpoint.gaps = gaps.dumps()
+    checkpoint.updated_at = datetime.utcnow()
+    db.session.commit()
+    return len(events)
+
+
+def run_pending(consumers, batch_size=BATCH_SIZE):
+    """Deliver to every one of {name: handle} `consumers` until they're
+    caught up; returns how many events were delivered in all."""
+
+    delivered = 0
+    for name, handle in consumers.items():
+        while True:
+            count = deliver(name, handle, batch_size)
+            delivered += count
+            if not count:
+                break
+    return delivered
+
+
+def prune(consumers, keep=KEEP, now=None, chunk=10000):
+    """Delete events older than `keep` that every consumer has handled;
+    returns how many."""
+
+    names = list(consumers)
+    done = db.session.scalar(
+        select(func.min(OutboxCheckpoint.position))
+        .where(OutboxCheckpoint.consumer.in_(names)))
+    started = db.session.scalar(
+        select(func.count())
+        .select_from(OutboxCheckpoint)
+        .where(OutboxCheckpoint.consumer.in_(names)))
+    if done is None or started < len(names):
+        return 0
+
+    cutoff = (now or datetime.utcnow()) - keep
+    events = OutboxEvent.__table__
+    removed = 0
+    while True:
+        picked = (select(events.c.id)
+                  .where(events.c.id <= done, events.c.created_at < cutoff)
+                  .limit(chunk))
+        count = db.session.execute(delete(events).where(events.c.id.in_(picked))).rowcount
+        db.session.commit()
+        removed += count
+        if count < chunk:
+            return removed
+
+
+def work(app, consumers, stop, batch_size=BATCH_SIZE, idle=0.5):
+    """Keep delivering until `stop` is set, sleeping `idle` secs when
+    there's nothing new, or after a consumer fails; and prune every
+    PRUNE_EVERY."""
+
+    pruned_at = None
+    while not stop.is_set():
+        try:
+            with app.app_context():
+                delivered = run_pending(consumers, batch_size)
+                if pruned_at is None or datetime.utcnow() - pruned_at >= PRUNE_EVERY:
+                    pruned_at = datetime.utcnow()
+                    prune(consumers)
+        except Exception as exc:
+            # The batch stays where it was, and is delivered again.
+            app.logger.exception("Outbox consumer failed: %s", exc)
+            delivered = 0
+        if not delivered:
+            stop.wait(idle)
+
+
+def start_runner(app, consumers, batch_size=BATCH_SIZE):
+    """Run the consumers in a background thread; returns its stop Event."""
+
+    stop = Event()
+    Thread(target=work, args=(app, consumers, stop, batch_size), daemon=True).start()
+    return stop
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] not in (['run'], ['prune']):
+        sys.exit(__doc__)
+
+    from app import app, OUTBOX_CONSUMERS
+
+    if sys.argv[1] == 'prune':
+        with app.app_context():
+            print(f"Pruned {prune(OUTBOX_CONSUMERS)} outbox events.")
+    else:
+        print(f"Running outbox consumers {', '.join(OUTBOX_CONSUMERS)}; Ctrl-C to stop.")
+        try:
+            work(app, OUTBOX_CONSUMERS, Event())
+        except KeyboardInterrupt:
+            pass
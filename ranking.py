@@ -0,0 +1,153 @@
+"""Ranked "top warbles" feed.
+
+Instead of the newest 100, the ranked homepage takes up to CANDIDATES
+recent warbles from the viewer's network and orders them by a score of:
+
+- recency: halves every HALF_LIFE_HOURS.
+- like velocity: likes per hour of age, dampened with log1p so one viral
+  warble doesn't drown out everything else.
+- author affinity: the share of the viewer's likes (on candidate authors)
+  that went to this author.
+- follow-graph distance: the viewer's own warbles and those of people they
+  follow count in full; second-degree accounts (followed by the people
+  they follow) are mixed in at a discount.
+
+The candidates are fetched as plain columns and scored as whole NumPy
+arrays, with no Python loop per warble; only the final page is loaded as
+Message objects. With sharding on, the candidates and their likes are read
+from the shards instead (see sharding.py).
+"""
+
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func, select
+
+import sharding
+from models import db, Likes, Message, User
+
+CANDIDATES = 5000
+MAX_AGE = timedelta(days=3)
+HALF_LIFE_HOURS = 12.0
+
+# How many second-degree accounts (by mutual follows) to draw from.
+SECOND_DEGREE_AUTHORS = 20
+
+LIKE_WEIGHT = 0.5
+AFFINITY_WEIGHT = 2.0
+# Score multiplier by follow-graph distance: self, followed, second degree.
+DISTANCE_WEIGHTS = np.array([1.0, 1.0, 0.4])
+
+
+def score(age_hours, like_counts, affinity, distance):
+    """Scores for columnar candidates (all arrays of the same length)."""
+
+    recency = np.exp2(-age_hours / HALF_LIFE_HOURS)
+    velocity = like_counts / (age_hours + 2.0)
+    return (recency
+            * (1.0 + LIKE_WEIGHT * np.log1p(velocity))
+            * (1.0 + AFFINITY_WEIGHT * affinity)
+            * DISTANCE_WEIGHTS[distance])
+
+
+def top_indices(scores, limit):
+    """Indices of the `limit` best `scores`, best first."""
+
+    if len(scores) > limit:
+        best = np.argpartition(-scores, limit - 1)[:limit]
+    else:
+        best = np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+def _candidates(author_ids, since):
+    """Columns (ids, authors, timestamps, like counts) of recent candidates."""
+
+    router = sharding.current_router()
+    if router:
+        return _shard_candidates(router, author_ids, since)
+
+    recent = (select(Message.id, Message.user_id, Message.timestamp)
+              .join(User, User.id == Message.user_id)
+              .where(Message.user_id.in_(author_ids),
+                     Message.timestamp > since,
+                     Message.deleted_at.is_(None),
+                     User.deleted_at.is_(None))
+              .order_by(Message.timestamp.desc())
+              .limit(CANDIDATES)
+              .cte('recent'))
+    rows = db.session.execute(
+        select(recent.c.id, recent.c.user_id, recent.c.timestamp, func.count(Likes.id))
+        .outerjoin(Likes, Likes.message_id == recent.c.id)
+        .group_by(recent.c.id, recent.c.user_id, recent.c.timestamp)).all()
+
+    if not rows:
+        return None
+    ids, authors, timestamps, likes = zip(*rows)
+    return (np.array(ids, dtype=np.int64),
+            np.array(authors, dtype=np.int64),
+            np.array(timestamps, dtype='datetime64[us]'),
+            np.array(likes, dtype=np.float64))
+
+
+def _shard_candidates(router, author_ids, since):
+    """_candidates, merged from the shards."""
+
+    excluded = sharding.deleted_user_ids()
+    recent = [row for row in router.timeline(author_ids, CANDIDATES)
+              if row.timestamp > since and row.user_id not in excluded]
+    if not recent:
+        return None
+    likes = router.like_counts([row.id for row in recent], excluded=excluded)
+    return (np.array([row.id for row in recent], dtype=np.int64),
+            np.array([row.user_id for row in recent], dtype=np.int64),
+            np.array([row.timestamp for row in recent], dtype='datetime64[us]'),
+            np.array([likes.get(row.id, 0) for row in recent], dtype=np.float64))
+
+
+def _affinity(viewer_id, author_ids):
+    """{author id: share of the viewer's likes on `author_ids` that are theirs}."""
+
+    router = sharding.current_router()
+    if router:
+        counts = router.liked_authors(viewer_id, author_ids)
+    else:
+        counts = dict(db.session.execute(
+            select(Message.user_id, func.count())
+            .select_from(Likes)
+            .join(Message, Message.id == Likes.message_id)
+            .where(Likes.user_id == viewer_id, Message.user_id.in_(author_ids))
+            .group_by(Message.user_id)).all())
+    total = sum(counts.values())
+    return {author_id: count / total for author_id, count in counts.items()}
+
+
+def ranked_feed(viewer_id, following_ids, second_degree_ids=(), limit=100, now=None):
+    """The `limit` best-scoring visible messages for `viewer_id`, with authors."""
+
+    now = now or datetime.utcnow()
+    following_ids = set(following_ids) - {viewer_id}
+    second_degree_ids = set(second_degree_ids) - following_ids - {viewer_id}
+    author_ids = [viewer_id, *following_ids, *second_degree_ids]
+
+    columns = _candidates(author_ids, now - MAX_AGE)
+    if columns is None:
+        return []
+    ids, authors, timestamps, likes = columns
+
+    age_hours = (np.datetime64(now, 'us') - timestamps) / np.timedelta64(1, 'h')
+    age_hours = np.maximum(age_hours, 0.0)
+
+    # Map authors to affinity and distance through small lookup arrays.
+    lookup_ids = np.array(author_ids, dtype=np.int64)
+    order = np.argsort(lookup_ids)
+    positions = order[np.searchsorted(lookup_ids, authors, sorter=order)]
+
+    shares = _affinity(viewer_id, author_ids)
+    affinity = np.array([shares.get(author_id, 0.0) for author_id in author_ids])[positions]
+    distance = np.array([0] + [1] * len(following_ids) + [2] * len(second_degree_ids))[positions]
+
+    best = ids[top_indices(score(age_hours, likes, affinity, distance), limit)].tolist()
+
+    messages = sharding.visible_messages(best)
+    return [messages[message_id] for message_id in best if message_id in messages]
@@ -0,0 +1,876 @@
+"""Horizontal sharding of messages and likes by author.
+
+Every author (``user_id``) lives on exactly one shard. A warble and all of
+its likes are stored on the author's shard, so deleting or counting the likes
+of a message never leaves that shard. Users are placed with ``user_id % N``
+unless the directory says otherwise; the directory is how the resharding tool
+moves a user to another shard without taking the site down.
+
+With SHARD_DATABASE_URLS set, the shards are the only copy of messages and
+likes: the main database's ``messages`` and ``likes`` tables stay empty.
+Everything else (users, follows, re-warbles, notifications, the outbox)
+stays on the main database, and pages that used to join messages to those
+tables read the ids from one side and look them up on the other (see
+``visible_messages``, ``liked_ids`` and ``like_summaries`` below, which
+work either way). Message ids come from the directory's sequence, so they
+are unique across shards; a lookup by id alone asks every shard at once.
+
+A new warble is written to its author's shard before the request commits
+its outbox event, and taken off again if that commit fails. Likes are
+written to the shards by ``write_edges`` (see writebehind.py), from the
+request or from the write-behind buffer's flush, and each write is
+idempotent, so a flush that fails is simply repeated. Deleting a message
+tombstones it on its shard (``deleted_at``); the purge worker removes it.
+Archiving moves it to the archive, and leaves its likes on the shard.
+
+Run the resharding tool like:
+
+    python sharding.py init
+    python sharding.py move <user_id> <shard>
+"""
+
+import heapq
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import (MetaData, Table, Column, Integer, String, DateTime,
+                        Index, case, create_engine, select, update,
+                        delete, insert, func, tuple_)
+from sqlalchemy.orm import contains_eager
+
+from models import db, insert_ignore, LikeSummary, Likes, Message, User
+
+# Tables that live on every shard.
+shard_metadata = MetaData()
+
+shard_messages = Table(
+    'messages', shard_metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('text', String(140), nullable=False),
+    Column('timestamp', DateTime, nullable=False),
+    Column('user_id', Integer, nullable=False),
+    Column('deleted_at', DateTime),
+    Index('ix_shard_messages_user_timestamp', 'user_id', 'timestamp'),
+)
+
+# message_id isn't a foreign key: likes stay when their message is moved
+# to the archive (see archive.py).
+shard_likes = Table(
+    'likes', shard_metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('message_id', Integer, primary_key=True),
+    Column('timestamp', DateTime, nullable=False, default=datetime.utcnow),
+    # A user's liked page, newest like first, on each shard.
+    Index('ix_shard_likes_user_timestamp', 'user_id', 'timestamp', 'message_id'),
+)
+
+# Tables that live next to ``users`` on the main database.
+directory_metadata = MetaData()
+
+shard_directory = Table(
+    'shard_directory', directory_metadata,
+    Column('user_id', Integer, primary_key=True, autoincrement=False),
+    Column('shard', Integer, nullable=False),
+    Column('moving_to', Integer),
+)
+
+shard_sequences = Table(
+    'shard_sequences', directory_metadata,
+    Column('name', String(40), primary_key=True),
+    Column('next_id', Integer, nullable=False),
+)
+
+
+class ShardMessage(namedtuple('ShardMessage', 'id text timestamp user_id user',
+                               defaults=(None,))):
+    """A message read from a shard, with its author (see `with_authors`)."""
+
+    archived = False
+
+
+class ShardRouter:
+    """Route message and like reads/writes to the author's shard."""
+
+    def __init__(self, engines, directory_engine, id_block=1000):
+        self.engines = list(engines)
+        self.directory_engine = directory_engine
+        self.id_block = id_block
+        self._ids = iter(())
+        self._ids_lock = Lock()
+        self._pool = ThreadPoolExecutor(max_workers=len(self.engines))
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a router from app config, or None if sharding is off."""
+
+        uris = config.get('SHARD_DATABASE_URIS')
+        if not uris:
+            return None
+
+        return cls([create_engine(uri) for uri in uris],
+                   create_engine(config['SQLALCHEMY_DATABASE_URI']))
+
+    def create_all(self):
+        """Create shard tables on every shard and the directory tables."""
+
+        for engine in self.engines:
+            shard_metadata.create_all(engine)
+            if engine.dialect.name == 'postgresql':
+                # Shards made before likes outlived archived messages, and
+                # before likes kept their time.
+                with engine.begin() as conn:
+                    conn.exec_driver_sql(
+                        "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey")
+                    conn.exec_driver_sql(
+                        "ALTER TABLE likes ADD COLUMN IF NOT EXISTS timestamp "
+                        "TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()")
+                    conn.exec_driver_sql(
+                        "CREATE INDEX IF NOT EXISTS ix_shard_likes_user_timestamp "
+                        "ON likes (user_id, timestamp, message_id)")
+        directory_metadata.create_all(self.directory_engine)
+
+    ##########################################################################
+    # Placement
+
+    def _assignments(self, user_ids):
+        """Map each user id to its directory row (shard, moving_to)."""
+
+        found = {}
+        with self.directory_engine.connect() as conn:
+            rows = conn.execute(
+                select(shard_directory)
+                .where(shard_directory.c.user_id.in_(list(user_ids))))
+            for row in rows:
+                found[row.user_id] = (row.shard, row.moving_to)
+
+        return {uid: found.get(uid, (uid % len(self.engines), None))
+                for uid in user_ids}
+
+    def shard_for(self, user_id):
+        """Which shard holds `user_id`'s messages and likes?"""
+
+        return self._assignments([user_id])[user_id][0]
+
+    def shards_for(self, user_ids):
+        """Group `user_ids` by the shard that holds them."""
+
+        groups = {}
+        for uid, (shard, _) in self._assignments(set(user_ids)).items():
+            groups.setdefault(shard, []).append(uid)
+        return groups
+
+    def next_message_id(self):
+        """Hand out a message id that is unique across all shards.
+
+        Ids are reserved from the directory database in blocks so that only
+        one write in `id_block` pays for a round-trip.
+        """
+
+        with self._ids_lock:
+            next_id = next(self._ids, None)
+            if next_id is None:
+                with self.directory_engine.begin() as conn:
+                    updated = conn.execute(
+                        update(shard_sequences)
+                        .where(shard_sequences.c.name == 'messages')
+                        .values(next_id=shard_sequences.c.next_id
+                                + self.id_block))
+                    if not updated.rowcount:
+                        conn.execute(insert(shard_sequences).values(
+                            name='messages', next_id=1 + self.id_block))
+                    end = conn.execute(
+                        select(shard_sequences.c.next_id)
+                        .where(shard_sequences.c.name == 'messages')
+                    ).scalar_one()
+                self._ids = iter(range(end - self.id_block, end))
+                next_id = next(self._ids)
+            return next_id
+
+    ##########################################################################
+    # Writes
+
+    def _on_shard(self, user_id, write):
+        """Run `write(conn)` in a transaction on `user_id`'s shard.
+
+        A move may flip the user to another shard between looking up the
+        shard and committing, after the move's catch-up copy has run; the
+        write would then be lost when the old shard is purged. So the
+        directory is read again after committing, and the write is replayed
+        on the new shard if it changed. Every write is idempotent.
+        """
+
+        shard = self.shard_for(user_id)
+        while True:
+            engine = self.engines[shard]
+            with engine.begin() as conn:
+                result = write(conn)
+            moved_to = self.shard_for(user_id)
+            if moved_to == shard:
+                return result
+            shard = moved_to
+
+    def add_message(self, user_id, text, timestamp=None, message_id=None):
+        """Store a new warble on its author's shard and return its id.
+
+        Its id is `message_id` if given, else one handed out by
+        `next_message_id`.
+        """
+
+        row = dict(
+            id=message_id or self.next_message_id(),
+            text=text,
+            timestamp=timestamp or datetime.utcnow(),
+            user_id=user_id,
+        )
+        self._on_shard(user_id, lambda conn: conn.execute(
+            insert_ignore(shard_messages, conn.dialect.name).values(**row)))
+        return row['id']
+
+    def tombstone_message(self, author_id, message_id, deleted_at=None):
+        """Hide a warble from reads until it's deleted for good."""
+
+        self._on_shard(author_id, lambda conn: conn.execute(
+            update(shard_messages)
+            .where(shard_messages.c.id == message_id)
+            .values(deleted_at=deleted_at or datetime.utcnow())))
+
+    def delete_message(self, author_id, message_id):
+        """Delete a warble (and its likes) from its author's shard.
+        Returns whether it was there."""
+
+        def write(conn):
+            conn.execute(delete(shard_likes)
+                         .where(shard_likes.c.message_id == message_id))
+            return conn.execute(delete(shard_messages)
+                                .where(shard_messages.c.id == message_id)).rowcount
+
+        return self._on_shard(author_id, write)
+
+    def add_like(self, user_id, author_id, message_id, timestamp=None):
+        """Record that `user_id` likes `author_id`'s warble (no-op if they
+        already do)."""
+
+        self._on_shard(author_id, lambda conn: conn.execute(
+            insert_ignore(shard_likes, conn.dialect.name).values(
+                user_id=user_id, message_id=message_id,
+                timestamp=timestamp or datetime.utcnow())))
+
+    def remove_like(self, user_id, author_id, message_id):
+        """Remove `user_id`'s like of `author_id`'s warble, if any."""
+
+        self._on_shard(author_id, lambda conn: conn.execute(
+            delete(shard_likes).where(
+                shard_likes.c.user_id == user_id,
+                shard_likes.c.message_id == message_id)))
+
+    def save_likes(self, added, removed):
+        """Write likes in bulk, a transaction per author: `added` are
+        (user_id, author_id, message_id, timestamp) rows, `removed` are
+        (user_id, author_id, message_id) ones, with author_id None when it
+        isn't known (the like is then removed from every shard)."""
+
+        by_author = {}
+        for user_id, author_id, message_id, timestamp in added:
+            by_author.setdefault(author_id, ([], []))[0].append(
+                dict(user_id=user_id, message_id=message_id, timestamp=timestamp))
+        unplaced = []
+        for user_id, author_id, message_id in removed:
+            if author_id is None:
+                unplaced.append((user_id, message_id))
+            else:
+                by_author.setdefault(author_id, ([], []))[1].append((user_id, message_id))
+
+        def unlike(conn, pairs):
+            conn.execute(delete(shard_likes).where(
+                tuple_(shard_likes.c.user_id, shard_likes.c.message_id).in_(pairs)))
+
+        for author_id, (adds, removes) in by_author.items():
+            def write(conn, adds=adds, removes=removes):
+                if adds:
+                    conn.execute(insert_ignore(shard_likes, conn.dialect.name), adds)
+                if removes:
+                    unlike(conn, removes)
+
+            self._on_shard(author_id, write)
+        if unplaced:
+            for engine in self.engines:
+                with engine.begin() as conn:
+                    unlike(conn, unplaced)
+
+    def drop_archived(self, message_ids):
+        """Delete {author_id: [message_id]} from their authors' shards (and
+        the ones they're moving to), once they're in the archive. Their
+        likes are kept."""
+
+        by_shard = {}
+        for author_id, (shard, moving_to) in self._assignments(set(message_ids)).items():
+            for target in {shard, moving_to} - {None}:
+                by_shard.setdefault(target, []).extend(message_ids[author_id])
+        for shard, ids in by_shard.items():
+            with self.engines[shard].begin() as conn:
+                conn.execute(delete(shard_messages).where(shard_messages.c.id.in_(ids)))
+
+    def purge_messages(self, author_id, message_ids):
+        """Delete `author_id`'s `message_ids`, and their likes, from their
+        shard; returns how many messages went."""
+
+        def write(conn):
+            conn.execute(delete(shard_likes).where(shard_likes.c.message_id.in_(message_ids)))
+            return conn.execute(delete(shard_messages)
+                                .where(shard_messages.c.id.in_(message_ids))).rowcount
+
+        return self._on_shard(author_id, write)
+
+    def purge_likes(self, author_id, message_ids):
+        """Delete the likes of `author_id`'s `message_ids` from their shard;
+        returns how many went."""
+
+        return self._on_shard(author_id, lambda conn: conn.execute(
+            delete(shard_likes).where(shard_likes.c.message_id.in_(message_ids))).rowcount)
+
+    def purge_user(self, user_id, chunk):
+        """Delete a chunk of `user_id`'s messages (with their likes) from
+        their shard, and of their likes on every shard. Returns how many
+        rows went; 0 once there's nothing left."""
+
+        removed = self._purge_some(user_id, self.engines[self.shard_for(user_id)], chunk)
+        for engine in self.engines:
+            if removed:
+                break
+            with engine.begin() as conn:
+                picked = (select(shard_likes.c.message_id)
+                          .where(shard_likes.c.user_id == user_id)
+                          .limit(chunk))
+                removed = conn.execute(delete(shard_likes).where(
+                    shard_likes.c.user_id == user_id,
+                    shard_likes.c.message_id.in_(picked))).rowcount
+        return removed
+
+    ##########################################################################
+    # Reads
+
+    def _scatter(self, fn, groups):
+        """Run `fn(engine, user_ids)` on every shard in `groups` at once."""
+
+        futures = [self._pool.submit(fn, self.engines[shard], user_ids)
+                   for shard, user_ids in groups.items()]
+        return [future.result() for future in futures]
+
+    def _everywhere(self, fn):
+        """Run `fn(engine)` on every shard at once."""
+
+        return self._scatter(lambda engine, _: fn(engine),
+                             dict.fromkeys(range(len(self.engines))))
+
+    def _stream(self, engine, where, order, chunk):
+        """Messages on `engine` matching `where`, in (ascending) `order`,
+        read a chunk at a time."""
+
+        key = tuple_(*order)
+        last = None
+        while True:
+            stmt = select(shard_messages).where(*where)
+            if last is not None:
+                stmt = stmt.where(key > tuple_(*last))
+            with engine.connect() as conn:
+                rows = conn.execute(stmt.order_by(*order).limit(chunk)).all()
+            yield from rows
+            if len(rows) < chunk:
+                return
+            last = [rows[-1]._mapping[column] for column in order]
+
+    def messages(self, message_ids, deleted=False):
+        """{id: row} of the messages among `message_ids`, tombstoned ones
+        too if `deleted`. Asks every shard, since an id doesn't say which
+        holds it."""
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+        where = [shard_messages.c.id.in_(message_ids)]
+        if not deleted:
+            where.append(shard_messages.c.deleted_at.is_(None))
+
+        def found(engine):
+            with engine.connect() as conn:
+                return conn.execute(select(shard_messages).where(*where)).all()
+
+        return {row.id: row for rows in self._everywhere(found) for row in rows}
+
+    def count_messages(self, user_id):
+        """How many (not deleted) messages `user_id` has posted."""
+
+        with self.engines[self.shard_for(user_id)].connect() as conn:
+            return conn.execute(
+                select(func.count())
+                .select_from(shard_messages)
+                .where(shard_messages.c.user_id == user_id,
+                       shard_messages.c.deleted_at.is_(None))).scalar()
+
+    def message_ids(self, user_id, limit):
+        """Ids of up to `limit` of `user_id`'s messages, tombstoned or not."""
+
+        with self.engines[self.shard_for(user_id)].connect() as conn:
+            return conn.execute(
+                select(shard_messages.c.id)
+                .where(shard_messages.c.user_id == user_id)
+                .limit(limit)).scalars().all()
+
+    def iter_user(self, user_id, chunk=1000):
+        """Every (not deleted) message of `user_id`, in id order."""
+
+        return self._stream(self.engines[self.shard_for(user_id)],
+                            [shard_messages.c.user_id == user_id,
+                             shard_messages.c.deleted_at.is_(None)],
+                            [shard_messages.c.id], chunk)
+
+    def messages_since(self, since, chunk=1000, excluded=()):
+        """Every (not deleted) message posted after `since` by anyone but
+        `excluded`, oldest first, merged from every shard."""
+
+        where = [shard_messages.c.timestamp > since, shard_messages.c.deleted_at.is_(None)]
+        if excluded:
+            where.append(shard_messages.c.user_id.not_in(list(excluded)))
+        order = [shard_messages.c.timestamp, shard_messages.c.id]
+        return heapq.merge(*(self._stream(engine, where, order, chunk) for engine in self.engines),
+                           key=lambda row: (row.timestamp, row.id))
+
+    def oldest_before(self, cutoff, excluded=()):
+        """When the oldest (not deleted) message from before `cutoff` by
+        anyone but `excluded` was posted, or None."""
+
+        where = [shard_messages.c.timestamp < cutoff, shard_messages.c.deleted_at.is_(None)]
+        if excluded:
+            where.append(shard_messages.c.user_id.not_in(list(excluded)))
+
+        def oldest(engine):
+            with engine.connect() as conn:
+                return conn.execute(select(func.min(shard_messages.c.timestamp))
+                                    .where(*where)).scalar()
+
+        found = [timestamp for timestamp in self._everywhere(oldest) if timestamp]
+        return min(found) if found else None
+
+    def messages_between(self, start, end, limit, excluded=()):
+        """The `limit` lowest-id (not deleted) messages posted from `start`
+        until `end` by anyone but `excluded`, from every shard."""
+
+        where = [shard_messages.c.timestamp >= start, shard_messages.c.timestamp < end,
+                 shard_messages.c.deleted_at.is_(None)]
+        if excluded:
+            where.append(shard_messages.c.user_id.not_in(list(excluded)))
+
+        def lowest(engine):
+            with engine.connect() as conn:
+                return conn.execute(select(shard_messages).where(*where)
+                                    .order_by(shard_messages.c.id).limit(limit)).all()
+
+        return list(islice(heapq.merge(*self._everywhere(lowest), key=lambda row: row.id),
+                           limit))
+
+    def user_messages(self, user_id, limit=100):
+        """Most recent messages of one user, newest first."""
+
+        return self.timeline([user_id], limit)
+
+    def timeline(self, user_ids, limit=100, before=None, after=None):
+        """Most recent `limit` messages written by any of `user_ids`.
+
+        Each shard returns its own newest `limit` rows (already sorted by the
+        (user_id, timestamp) index); the per-shard lists are then merged and
+        cut to the overall top `limit`. Only messages older than the
+        (timestamp, id) key `before` are returned if it's given; with
+        `after`, the oldest `limit` newer than that key, oldest first.
+        """
+
+        key = tuple_(shard_messages.c.timestamp, shard_messages.c.id)
+        where = [shard_messages.c.deleted_at.is_(None)]
+        if after:
+            where.append(key > tuple_(*after))
+            order = (shard_messages.c.timestamp, shard_messages.c.id)
+        else:
+            if before:
+                where.append(key < tuple_(*before))
+            order = (shard_messages.c.timestamp.desc(), shard_messages.c.id.desc())
+
+        def newest(engine, ids):
+            with engine.connect() as conn:
+                return conn.execute(
+                    select(shard_messages)
+                    .where(shard_messages.c.user_id.in_(ids), *where)
+                    .order_by(*order)
+                    .limit(limit)).all()
+
+        per_shard = self._scatter(newest, self.shards_for(user_ids))
+        merged = heapq.merge(*per_shard,
+                             key=lambda row: (row.timestamp, row.id),
+                             reverse=not after)
+        return list(islice(merged, limit))
+
+    def liked_ids(self, user_id, message_ids):
+        """Which of `message_ids` does `user_id` like?"""
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        def liked(engine):
+            with engine.connect() as conn:
+                return conn.execute(
+                    select(shard_likes.c.message_id)
+                    .where(shard_likes.c.user_id == user_id,
+                           shard_likes.c.message_id.in_(message_ids))).scalars().all()
+
+        return {mid for ids in self._everywhere(liked) for mid in ids}
+
+    def like_summaries(self, message_ids, known_ids=(), excluded=()):
+        """{message id: (count, liker id)} for those of `message_ids` with
+        likes by anyone but `excluded`. The liker is the lowest id in
+        `known_ids` who likes it, else the lowest id who does."""
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+        known = func.min(case((shard_likes.c.user_id.in_(list(known_ids)),
+                               shard_likes.c.user_id)))
+        where = [shard_likes.c.message_id.in_(message_ids)]
+        if excluded:
+            where.append(shard_likes.c.user_id.not_in(list(excluded)))
+
+        def summed(engine):
+            with engine.connect() as conn:
+                return conn.execute(
+                    select(shard_likes.c.message_id, func.count(),
+                           func.coalesce(known, func.min(shard_likes.c.user_id)))
+                    .where(*where)
+                    .group_by(shard_likes.c.message_id)).all()
+
+        # A message's likes are all on its author's shard.
+        return {message_id: (count, liker_id)
+                for rows in self._everywhere(summed)
+                for message_id, count, liker_id in rows}
+
+    def like_counts(self, message_ids, excluded=()):
+        """{message id: how many (but `excluded`) like it} for `message_ids`."""
+
+        return {message_id: count for message_id, (count, _)
+                in self.like_summaries(message_ids, excluded=excluded).items()}
+
+    def liked_authors(self, user_id, author_ids):
+        """{author id: how many of their messages `user_id` likes}, for
+        `author_ids`."""
+
+        def liked(engine, ids):
+            with engine.connect() as conn:
+                return conn.execute(
+                    select(shard_messages.c.user_id, func.count())
+                    .select_from(shard_likes)
+                    .join(shard_messages, shard_messages.c.id == shard_likes.c.message_id)
+                    .where(shard_likes.c.user_id == user_id,
+                           shard_messages.c.user_id.in_(ids))
+                    .group_by(shard_messages.c.user_id)).all()
+
+        return {author_id: count
+                for rows in self._scatter(liked, self.shards_for(author_ids))
+                for author_id, count in rows}
+
+    def liked_page(self, user_id, limit, before=None):
+        """`user_id`'s newest `limit` likes, as (message_id, timestamp)
+        rows merged from every shard; only those older than the (timestamp,
+        message_id) key `before` if it's given."""
+
+        where = [shard_likes.c.user_id == user_id]
+        if before:
+            where.append(tuple_(shard_likes.c.timestamp, shard_likes.c.message_id)
+                         < tuple_(*before))
+
+        def newest(engine):
+            with engine.connect() as conn:
+                return conn.execute(
+                    select(shard_likes.c.message_id, shard_likes.c.timestamp)
+                    .where(*where)
+                    .order_by(shard_likes.c.timestamp.desc(), shard_likes.c.message_id.desc())
+                    .limit(limit)).all()
+
+        merged = heapq.merge(*self._everywhere(newest),
+                             key=lambda row: (row.timestamp, row.message_id), reverse=True)
+        return list(islice(merged, limit))
+
+    def iter_likes(self, user_id, chunk=1000):
+        """Every (message_id, timestamp) like of `user_id`, by message id,
+        merged from every shard."""
+
+        def likes(engine):
+            last = 0
+            while True:
+                with engine.connect() as conn:
+                    rows = conn.execute(
+                        select(shard_likes.c.message_id, shard_likes.c.timestamp)
+                        .where(shard_likes.c.user_id == user_id,
+                               shard_likes.c.message_id > last)
+                        .order_by(shard_likes.c.message_id)
+                        .limit(chunk)).all()
+                yield from rows
+                if len(rows) < chunk:
+                    return
+                last = rows[-1].message_id
+
+        return heapq.merge(*(likes(engine) for engine in self.engines),
+                           key=lambda row: row.message_id)
+
+    def liked_message_ids(self, user_id):
+        """Ids of every message `user_id` likes, across all shards."""
+
+        def liked(engine, ids):
+            with engine.connect() as conn:
+                return conn.execute(
+                    select(shard_likes.c.message_id)
+                    .outerjoin(shard_messages, shard_messages.c.id == shard_likes.c.message_id)
+                    .where(shard_likes.c.user_id.in_(ids),
+                           shard_messages.c.deleted_at.is_(None))).scalars().all()
+
+        groups = {shard: [user_id] for shard in range(len(self.engines))}
+        return {mid for ids in self._scatter(liked, groups) for mid in ids}
+
+    def count_likes(self, user_id):
+        """How many visible (or archived) messages `user_id` likes: a COUNT
+        on every shard, added up."""
+
+        def count(engine, ids):
+            with engine.connect() as conn:
+                return conn.execute(
+                    select(func.count())
+                    .select_from(shard_likes)
+                    .outerjoin(shard_messages, shard_messages.c.id == shard_likes.c.message_id)
+                    .where(shard_likes.c.user_id.in_(ids),
+                           shard_messages.c.deleted_at.is_(None))).scalar()
+
+        groups = {shard: [user_id] for shard in range(len(self.engines))}
+        return sum(self._scatter(count, groups))
+
+    ##########################################################################
+    # Resharding
+
+    def _copy_user(self, user_id, source, dest, chunk):
+        """Copy `user_id`'s messages, then their likes, from source to dest.
+        Returns the ids of the messages copied."""
+
+        copied = set()
+        last_id = 0
+        while True:
+            with source.connect() as conn:
+                rows = conn.execute(
+                    select(shard_messages)
+                    .where(shard_messages.c.user_id == user_id,
+                           shard_messages.c.id > last_id)
+                    .order_by(shard_messages.c.id)
+                    .limit(chunk)).mappings().all()
+                likes = conn.execute(
+                    select(shard_likes).where(shard_likes.c.message_id.in_(
+                        [row['id'] for row in rows]))).mappings().all()
+            if not rows:
+                return copied
+
+            with dest.begin() as conn:
+                conn.execute(insert_ignore(shard_messages, dest.dialect.name),
+                             [dict(row) for row in rows])
+                # Rows copied by an earlier pass may have been tombstoned since.
+                for row in rows:
+                    if row['deleted_at']:
+                        conn.execute(update(shard_messages)
+                                     .where(shard_messages.c.id == row['id'])
+                                     .values(deleted_at=row['deleted_at']))
+                if likes:
+                    conn.execute(insert_ignore(shard_likes, dest.dialect.name),
+                                 [dict(like) for like in likes])
+            copied.update(row['id'] for row in rows)
+            last_id = rows[-1]['id']
+
+    def _purge_some(self, user_id, engine, chunk):
+        """Delete up to `chunk` of `user_id`'s messages, and their likes,
+        from `engine`. Returns how many messages went."""
+
+        with engine.begin() as conn:
+            ids = conn.execute(
+                select(shard_messages.c.id)
+                .where(shard_messages.c.user_id == user_id)
+                .limit(chunk)).scalars().all()
+            if not ids:
+                return 0
+            conn.execute(delete(shard_likes)
+                         .where(shard_likes.c.message_id.in_(ids)))
+            return conn.execute(delete(shard_messages)
+                                .where(shard_messages.c.id.in_(ids))).rowcount
+
+    def _purge_user(self, user_id, engine, chunk):
+        """Delete `user_id`'s messages and their likes from `engine`."""
+
+        while self._purge_some(user_id, engine, chunk):
+            pass
+
+    def move_user(self, user_id, dest_shard, chunk=500):
+        """Move a user's messages and likes to `dest_shard` while online.
+
+        1. Mark the user as moving; reads and writes keep using the source.
+        2. Copy messages and likes to the destination in chunks.
+        3. Flip the directory so new reads and writes go to the destination.
+        4. Copy again to catch anything written during the first pass, and
+           drop the messages copied in step 2 that have since been deleted
+           from the source. Nothing else is dropped from the destination:
+           from step 3 on, new warbles are written there, not the source.
+        5. Purge the user's rows from the source in chunks.
+
+        Safe to re-run if interrupted: every step is idempotent. A write
+        that looked up the source before step 3 but committed after step 4
+        is replayed on the destination by the writer (see `_on_shard`).
+        """
+
+        src_shard, moving_to = self._assignments([user_id])[user_id]
+        if moving_to is not None:
+            dest_shard = moving_to
+        if src_shard == dest_shard:
+            return
+
+        source = self.engines[src_shard]
+        dest = self.engines[dest_shard]
+
+        with self.directory_engine.begin() as conn:
+            conn.execute(delete(shard_directory)
+                         .where(shard_directory.c.user_id == user_id))
+            conn.execute(insert(shard_directory).values(
+                user_id=user_id, shard=src_shard, moving_to=dest_shard))
+
+        copied = self._copy_user(user_id, source, dest, chunk)
+
+        with self.directory_engine.begin() as conn:
+            conn.execute(update(shard_directory)
+                         .where(shard_directory.c.user_id == user_id)
+                         .values(shard=dest_shard, moving_to=None))
+
+        self._copy_user(user_id, source, dest, chunk)
+        # The source only loses rows now (writes racing the flip are
+        # replayed on the destination), so what it lacks was deleted.
+        with source.connect() as conn:
+            kept = set(conn.execute(
+                select(shard_messages.c.id)
+                .where(shard_messages.c.user_id == user_id)).scalars())
+        gone = sorted(copied - kept)
+        with dest.begin() as conn:
+            if gone:
+                conn.execute(delete(shard_likes)
+                             .where(shard_likes.c.message_id.in_(gone)))
+                conn.execute(delete(shard_messages)
+                             .where(shard_messages.c.id.in_(gone)))
+
+        self._purge_user(user_id, source, chunk)
+
+
+##############################################################################
+# Reads that work with or without sharding (in app context)
+
+
+def current_router():
+    """The app's ShardRouter, or None when sharding is off."""
+
+    return current_app.extensions.get('shard_router')
+
+
+def deleted_user_ids():
+    """Ids of the deleted accounts whose rows haven't been purged yet; the
+    shards don't know about them, so reads leave them out by hand."""
+
+    return set(db.session.execute(
+        select(User.id).where(User.deleted_at.is_not(None))).scalars())
+
+
+def message_authors(message_ids, deleted=False):
+    """{id: author id} of the messages among `message_ids`, tombstoned
+    ones too if `deleted`."""
+
+    message_ids = list(message_ids)
+    if not message_ids:
+        return {}
+    router = current_router()
+    if router:
+        return {message_id: row.user_id
+                for message_id, row in router.messages(message_ids, deleted).items()}
+    where = [Message.id.in_(message_ids)]
+    if not deleted:
+        where.append(Message.deleted_at.is_(None))
+    return dict(db.session.execute(select(Message.id, Message.user_id).where(*where)).all())
+
+
+def with_authors(rows):
+    """ShardMessages for shard message `rows`, with their authors; those of
+    deleted accounts are left out."""
+
+    rows = list(rows)
+    authors = ({user.id: user for user in User.active().filter(
+        User.id.in_({row.user_id for row in rows}))} if rows else {})
+    return [ShardMessage(row.id, row.text, row.timestamp, row.user_id, authors[row.user_id])
+            for row in rows if row.user_id in authors]
+
+
+def visible_messages(message_ids):
+    """{id: message, with its author} for the visible ones among
+    `message_ids`."""
+
+    message_ids = list(message_ids)
+    if not message_ids:
+        return {}
+    router = current_router()
+    if router:
+        return {msg.id: msg for msg in with_authors(router.messages(message_ids).values())}
+    return {msg.id: msg for msg in (Message
+                                    .visible()
+                                    .options(contains_eager(Message.user))
+                                    .filter(Message.id.in_(message_ids)))}
+
+
+def liked_ids(user_id, message_ids):
+    """Which of `message_ids` does `user_id` like?"""
+
+    router = current_router()
+    if router:
+        return router.liked_ids(user_id, message_ids)
+    return Likes.liked_ids(user_id, message_ids)
+
+
+def like_summaries(message_ids, known_ids=()):
+    """{message id: LikeSummary} for `message_ids` (see Likes.summaries).
+
+    From the shards the liker named is the lowest id among `known_ids`,
+    else the lowest id.
+    """
+
+    router = current_router()
+    if not router:
+        return Likes.summaries(message_ids, known_ids)
+    summaries = router.like_summaries(message_ids, known_ids, excluded=deleted_user_ids())
+    names = dict(db.session.execute(
+        select(User.id, User.username)
+        .where(User.id.in_({liker_id for _, liker_id in summaries.values()}))).all()
+        if summaries else ())
+    return {message_id: LikeSummary(count, names[liker_id])
+            for message_id, (count, liker_id) in summaries.items() if liker_id in names}
+
+
+if __name__ == '__main__':
+    from app import app
+
+    router = ShardRouter.from_config(app.config)
+    if router is None:
+        sys.exit("Sharding is off; set SHARD_DATABASE_URLS first.")
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'init':
+        router.create_all()
+    elif command == 'move' and len(sys.argv) == 4:
+        router.move_user(int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        sys.exit(__doc__)
@@ -0,0 +1,190 @@
+"""Admission control tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_admission.py
+
+import os
+import time
+import unittest
+from threading import Thread
+
+from models import db, User, Message, Likes, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+import admission
+from admission import Gate, TokenBuckets
+
+
+class GateTestCase(unittest.TestCase):
+    """Test queuing and shedding at a gate."""
+
+    def test_sheds_early(self):
+        """Is a request turned away at once if it would miss its deadline?"""
+        gate = Gate('test', limit=1, deadline=0.5)
+        self.assertTrue(gate.admit())
+        gate.service_time = 2.0
+
+        start = time.monotonic()
+        self.assertFalse(gate.admit())
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(gate.shed, 1)
+        self.assertEqual(gate.retry_after(), 2)
+
+    def test_queues_within_deadline(self):
+        """Does a queued request get the slot once it's released?"""
+        gate = Gate('test', limit=1, deadline=1.0)
+        self.assertTrue(gate.admit())
+        gate.service_time = 0.05
+
+        results = []
+        waiter = Thread(target=lambda: results.append(gate.admit()))
+        waiter.start()
+        time.sleep(0.05)
+        gate.release(0.05)
+        waiter.join()
+        self.assertEqual(results, [True])
+
+    def test_token_bucket(self):
+        """Are bursts allowed, then refilled at the rate?"""
+        buckets = TokenBuckets(rate=1.0, burst=2)
+        self.assertEqual([buckets.take('u', now=0) for _ in range(3)], [0, 0, 1.0])
+        self.assertEqual(buckets.take('other', now=0), 0)
+        self.assertEqual(buckets.take('u', now=1.0), 0)
+
+    def test_token_buckets_bounded(self):
+        """Are idle buckets dropped past `maxsize`?"""
+        buckets = TokenBuckets(rate=1.0, burst=1, maxsize=2)
+        for key in 'abc':
+            buckets.take(key, now=0)
+        self.assertEqual(buckets.take('a', now=0), 0)
+
+
+class AdmissionViewsTestCase(unittest.TestCase):
+    """Test shedding, degraded mode and write limits on the routes."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+        app_module.follow_graph = None
+        app_module.gates.update(admission.make_gates(app.config))
+
+        db.create_all()
+
+        self.reader = User.signup(username="reader", email="reader@test.com",
+                                  password="password", image_url=None)
+        self.author = User.signup(username="author", email="author@test.com",
+                                  password="password", image_url=None)
+        db.session.commit()
+        self.reader_id = self.reader.id
+        self.author_id = self.author.id
+        Follows.add(self.reader_id, self.author_id)
+        db.session.add(Message(text="first warble", user_id=self.author_id))
+        db.session.commit()
+
+    def tearDown(self):
+        app_module.gates.update(admission.make_gates(app.config))
+        app_module.write_limits = TokenBuckets(app.config['WRITE_RATE'] / 60,
+                                               app.config['WRITE_BURST'])
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def fill(self, name):
+        gate = app_module.gates[name]
+        for _ in range(gate.limit):
+            gate.try_admit()
+        gate.service_time = 60.0
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def test_overloaded_login_shed(self):
+        """Is a login past the auth gate's budget a 503 with Retry-After?"""
+        self.fill('auth')
+        resp = self.client.post("/login", data={"username": "reader",
+                                                "password": "password"})
+        self.assertEqual(resp.status_code, 503)
+        self.assertGreater(int(resp.headers['Retry-After']), 0)
+
+        # Cheap routes have their own gate.
+        self.assertEqual(self.client.get(f"/users/{self.author_id}").status_code, 200)
+
+    def test_overloaded_api_shed_as_json(self):
+        """Does the API shed with a JSON error?"""
+        self.fill('feed')
+        self.login()
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('error', resp.json)
+
+    def test_degraded_homepage(self):
+        """Does a full feed gate serve the last timeline, without counters?"""
+        self.login()
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("first warble", html)
+        self.assertIn("Followers", html)
+
+        db.session.add(Message(text="second warble", user_id=self.author_id))
+        db.session.commit()
+        self.fill('feed')
+
+        resp = self.client.get("/")
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("first warble", html)
+        self.assertNotIn("second warble", html)
+        self.assertNotIn("Followers", html)
+        self.assertIn("Warbler is busy", html)
+
+    def test_degraded_homepage_gated(self):
+        """Once degraded homepages fill their own gate, are more shed?"""
+        self.login()
+        self.fill('feed')
+        self.fill('degraded')
+        resp = self.client.get("/")
+        self.assertEqual(resp.status_code, 503)
+        self.assertGreater(int(resp.headers['Retry-After']), 0)
+
+    def test_streamed_page_holds_slot(self):
+        """Does a streamed page keep its slot until its body is sent?"""
+        gate = app_module.gates['default']
+        self.login()
+        resp = self.client.get("/users")
+        self.assertEqual(gate._slots._value, gate.limit - 1)
+
+        self.assertIn("author", resp.get_data(as_text=True))
+        resp.close()
+        self.assertEqual(gate._slots._value, gate.limit)
+
+    def test_write_rate_limited(self):
+        """Are a user's likes past the burst turned away without writing?"""
+        app_module.write_limits = TokenBuckets(rate=0.001, burst=2)
+        msgs = [Message(text=f"warble {i}", user_id=self.author_id) for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        msg_ids = [msg.id for msg in msgs]
+
+        self.login()
+        for msg_id in msg_ids:
+            resp = self.client.post(f"/users/add_like/{msg_id}")
+        self.assertEqual(resp.status_code, 429)
+        # One token back at 0.001/sec is 1000 secs away.
+        self.assertEqual(int(resp.headers['Retry-After']), 1000)
+        self.assertIn("doing that too often", resp.get_data(as_text=True))
+        self.assertEqual(Likes.query.count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+import base64
+import json
+import os
+import unittest
+from datetime import datetime, timedelta
+
+from models import db, User, Message, Likes, Follows, Mutes, Blocks
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+
+
+class ApiTestCase(unittest.TestCase):
+    """Test the /api/v1 routes."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+        db.create_all()
+        app_module.cache.clear()
+
+        self.testuser1 = User.signup(username="testuser1",
+                                     email="test1@test.com",
+                                     password="test1password",
+                                     image_url=None)
+        self.testuser2 = User.signup(username="testuser2",
+                                     email="test2@test.com",
+                                     password="test2password",
+                                     image_url=None)
+        db.session.commit()
+        self.user1_id = self.testuser1.id
+        self.user2_id = self.testuser2.id
+
+        # Five messages sharing one timestamp, to exercise the id tie-break.
+        start = datetime(2024, 1, 1)
+        db.session.add_all(
+            [Message(text=f"old {i}", user_id=self.user2_id, timestamp=start) for i in range(5)]
+            + [Message(text=f"new {i}", user_id=self.user2_id,
+                       timestamp=start + timedelta(minutes=i + 1)) for i in range(3)])
+        Follows.add(self.user1_id, self.user2_id)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user1_id
+
+    def test_timeline_requires_login(self):
+        """Is the timeline refused without a login?"""
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.get_json(), {"error": "Login required."})
+
+    def test_timeline_cursor_pagination(self):
+        """Do cursors walk the whole timeline once, newest first?"""
+        with self.client as c:
+            self.login(c)
+
+            texts = []
+            cursor = None
+            while True:
+                url = "/api/v1/timeline?limit=3" + (f"&cursor={cursor}" if cursor else "")
+                data = c.get(url).get_json()
+                texts += [m["text"] for m in data["messages"]]
+                cursor = data["next"]
+                if not cursor:
+                    break
+
+            self.assertEqual(texts[:3], ["new 2", "new 1", "new 0"])
+            self.assertEqual(sorted(texts[3:]), [f"old {i}" for i in range(5)])
+            self.assertEqual(data["users"], {
+                str(self.user2_id): {"username": "testuser2",
+                                     "image_url": "/static/images/default-pic.png"}})
+
+    def test_timeline_after(self):
+        """Does ?after= return only the newer messages, oldest first?"""
+        with self.client as c:
+            self.login(c)
+
+            data = c.get("/api/v1/timeline?limit=2").get_json()
+            self.assertEqual([m["text"] for m in data["messages"]], ["new 2", "new 1"])
+
+            newer = c.get(f"/api/v1/timeline?after={data['next']}").get_json()
+            self.assertEqual([m["text"] for m in newer["messages"]], ["new 2"])
+
+            nothing = c.get(f"/api/v1/timeline?after={newer['next']}").get_json()
+            self.assertEqual(nothing["messages"], [])
+            self.assertEqual(nothing["next"], newer["next"])
+
+    def test_bad_cursor(self):
+        """Is a garbage cursor a 400, not a 500?"""
+        resp = self.client.get(f"/api/v1/users/{self.user2_id}/messages?cursor=nope")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_tampered_cursors(self):
+        """Are well-formed cursors holding the wrong shape or types a 400?"""
+        def token(value):
+            raw = json.dumps(value).encode()
+            return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+        message_keys = [1, "x", {"a": 1}, [1], [1, 2], ["x", 1],
+                        ["2024-01-01T00:00:00", "2"], ["2024-01-01T00:00:00", 2, 3],
+                        ["2024-01-01T00:00:00", True]]
+        follower_keys = [1, "x", {"a": 1}, [], ["2"], [1, 2], [None], [True]]
+
+        with self.client as c:
+            self.login(c)
+            for key in message_keys:
+                for url in ["/api/v1/timeline?cursor=", "/api/v1/timeline?after=",
+                            f"/api/v1/users/{self.user2_id}/messages?cursor="]:
+                    with self.subTest(url=url, key=key):
+                        self.assertEqual(c.get(url + token(key)).status_code, 400)
+            for key in follower_keys:
+                with self.subTest(key=key):
+                    resp = c.get(f"/api/v1/users/{self.user2_id}/followers?cursor={token(key)}")
+                    self.assertEqual(resp.status_code, 400)
+
+            # The cursors the API hands out still work.
+            self.assertEqual(c.get(f"/api/v1/users/{self.user2_id}/followers"
+                                   f"?cursor={token([0])}").status_code, 200)
+
+    def test_followers(self):
+        """Are a user's followers listed?"""
+        with self.client as c:
+            self.login(c)
+            data = c.get(f"/api/v1/users/{self.user2_id}/followers").get_json()
+            self.assertEqual([u["username"] for u in data["users"]], ["testuser1"])
+            self.assertIsNone(data["next"])
+
+            resp = c.get("/api/v1/users/999999/followers")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_message(self):
+        """Does a single message come with its like count?"""
+        msg = Message.query.filter_by(text="new 0").one()
+        Likes.add(self.user1_id, msg.id)
+        db.session.commit()
+
+        data = self.client.get(f"/api/v1/messages/{msg.id}").get_json()
+        self.assertEqual(data["messages"][0]["text"], "new 0")
+        self.assertEqual(data["likes"], 1)
+        self.assertEqual(data["liked_by"], "testuser1")
+
+        self.assertEqual(self.client.get("/api/v1/messages/999999").status_code, 404)
+
+    def test_hidden_accounts(self):
+        """Do mutes and blocks apply to the API as they do to the pages?"""
+        testuser3 = User.signup(username="testuser3", email="test3@test.com",
+                                password="test3password", image_url=None)
+        db.session.commit()
+        Follows.add(testuser3.id, self.user2_id)
+        Mutes.add(self.user1_id, testuser3.id)
+        db.session.commit()
+        msg = Message.query.filter_by(text="new 0").one()
+
+        with self.client as c:
+            self.login(c)
+            # A muted follower is left out; the muted user's warbles aren't.
+            data = c.get(f"/api/v1/users/{self.user2_id}/followers").get_json()
+            self.assertEqual([u["username"] for u in data["users"]], ["testuser1"])
+            data = c.get(f"/api/v1/users/{self.user2_id}/messages").get_json()
+            self.assertEqual(len(data["messages"]), 8)
+
+            Blocks.add(self.user2_id, self.user1_id)
+            db.session.commit()
+            app_module.cache.bump('filters', self.user1_id)
+
+            data = c.get(f"/api/v1/users/{self.user2_id}/messages").get_json()
+            self.assertEqual(data["messages"], [])
+            self.assertEqual(c.get(f"/api/v1/messages/{msg.id}").status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+"""Message archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from models import db, User, Message, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from archive import Archive, write_segment
+import deletion
+
+
+class SegmentTestCase(unittest.TestCase):
+    """Test the segment file format."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_trip(self):
+        """Does every row read back as written, by id and by author?"""
+        start = datetime(2024, 3, 1)
+        rows = [(i * 3 + 7, i % 5, start + timedelta(minutes=i), i % 4, f"warble {i} ✓")
+                for i in range(1000)]
+        write_segment(os.path.join(self.dir.name, '2024-03-7.wma'), rows)
+        archive = Archive(self.dir.name)
+
+        for message_id, user_id, timestamp, likes, text in rows[::97]:
+            row = archive.get(message_id)
+            self.assertEqual((row.user_id, row.timestamp, row.likes, row.text),
+                             (user_id, timestamp, likes, text))
+        self.assertIsNone(archive.get(8))
+
+        newest = archive.user_messages(2, limit=3)
+        self.assertEqual([row.id for row in newest], [2998, 2983, 2968])
+        older = archive.user_messages(2, before=(newest[-1].timestamp, newest[-1].id), limit=2)
+        self.assertEqual([row.id for row in older], [2953, 2938])
+
+    def test_compressed(self):
+        """Is a segment smaller than its text alone?"""
+        rows = [(i, 1, datetime(2024, 3, 1) + timedelta(seconds=i), 0,
+                 "Lorem ipsum dolor sit amet, consectetur adipiscing elit")
+                for i in range(1, 5001)]
+        path = os.path.join(self.dir.name, '2024-03-1.wma')
+        write_segment(path, rows)
+        self.assertLess(os.path.getsize(path), sum(len(row[4]) for row in rows) / 4)
+
+
+class ArchiveTestCase(unittest.TestCase):
+    """Test archiving old months and reading them back."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+        app_module.archive = Archive(self.dir.name)
+
+        db.create_all()
+
+        author = User(username="author", email="author@test.com", password="x")
+        fan = User(username="fan", email="fan@test.com", password="x")
+        db.session.add_all([author, fan])
+        db.session.commit()
+        self.author_id = author.id
+        self.fan_id = fan.id
+
+        now = datetime.utcnow()
+        old = [Message(text=f"old {i}", user_id=self.author_id,
+                       timestamp=now - timedelta(days=400 + 20 * i))
+               for i in range(4)]
+        self.new = Message(text="new", user_id=self.author_id, timestamp=now)
+        db.session.add_all(old + [self.new])
+        db.session.commit()
+        self.old_ids = [msg.id for msg in old]
+        Likes.add(self.fan_id, self.old_ids[0])
+        db.session.commit()
+
+    def tearDown(self):
+        app_module.archive = None
+        app.config['MESSAGE_ARCHIVE_DIR'] = None
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+        self.dir.cleanup()
+
+    def test_archive_old_months(self):
+        """Are old months moved out of the table, keeping their likes?"""
+        archive = app_module.archive
+        self.assertEqual(archive.archive_old(), 4)
+        self.assertEqual(archive.archive_old(), 0)
+
+        self.assertEqual([msg.id for msg in Message.query.all()], [self.new.id])
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertGreaterEqual(len(archive.segments()), 2)
+        self.assertEqual(archive.get(self.old_ids[0]).likes, 1)
+
+    def test_show_archived_message(self):
+        """Is an archived warble still shown, without a delete button?"""
+        app_module.archive.archive_old()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+            html = c.get(f"/messages/{self.old_ids[1]}").get_data(as_text=True)
+        self.assertIn("old 1", html)
+        self.assertNotIn("Delete", html)
+        self.assertEqual(self.client.get("/messages/999999").status_code, 404)
+
+    def test_api_pages_into_archive(self):
+        """Does a user's message history page on past the table?"""
+        app_module.archive.archive_old()
+        url = f"/api/v1/users/{self.author_id}/messages?limit=2"
+        seen = []
+        while url:
+            page = self.client.get(url).json
+            seen.extend(msg['text'] for msg in page['messages'])
+            url = (f"/api/v1/users/{self.author_id}/messages?limit=2&cursor={page['next']}"
+                   if page['next'] else None)
+        self.assertEqual(seen, ["new", "old 0", "old 1", "old 2", "old 3"])
+
+    def test_liked_page_reads_archive(self):
+        """Does a like of an archived warble still show on the liked page
+        and in the export?"""
+        Likes.add(self.fan_id, self.new.id)
+        db.session.commit()
+        app_module.archive.archive_old()
+
+        html = self.client.get(f"/users/{self.fan_id}/likes").get_data(as_text=True)
+        self.assertIn("old 0", html)
+        self.assertIn("new", html)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan_id
+            lines = c.get("/users/export").get_data(as_text=True)
+        self.assertIn(f'"message_id":{self.old_ids[0]}', lines)
+
+    def test_purged_account_leaves_archive(self):
+        """Does purging a deleted account remove its archived messages?"""
+        app_module.archive.archive_old()
+        app.config['MESSAGE_ARCHIVE_DIR'] = self.dir.name
+
+        author = db.session.get(User, self.author_id)
+        author.deleted_at = datetime.utcnow()
+        deletion.enqueue('user', self.author_id)
+        db.session.commit()
+        deletion.run_pending()
+
+        self.assertEqual(list(Archive(self.dir.name).iter_user(self.author_id)), [])
+        self.assertEqual(Likes.query.count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
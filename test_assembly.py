@@ -0,0 +1,109 @@
+"""Concurrent page assembly tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assembly.py
+
+import os
+import time
+import unittest
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from assembly import Section, gather
+
+
+def slow(seconds, value):
+    time.sleep(seconds)
+    return value
+
+
+def broken():
+    raise RuntimeError("section failed")
+
+
+class AssemblyTestCase(unittest.TestCase):
+    """Test gathering sections and degrading the homepage."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+
+        db.create_all()
+
+        self.testuser1 = User.signup(username="testuser1",
+                                     email="test1@test.com",
+                                     password="test1password",
+                                     image_url=None)
+        self.testuser2 = User.signup(username="testuser2",
+                                     email="test2@test.com",
+                                     password="test2password",
+                                     image_url=None)
+        db.session.commit()
+        self.user1_id = self.testuser1.id
+        self.user2_id = self.testuser2.id
+
+        Follows.add(self.user1_id, self.user2_id)
+        Follows.add(self.user2_id, self.user1_id)
+        db.session.add(Message(text="hello followers", user_id=self.user2_id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_sections_overlap(self):
+        """Do sections run concurrently rather than one after another?"""
+        start = time.monotonic()
+        results, failed = gather(app, {
+            name: Section(slow, [0.3, name]) for name in ("a", "b", "c")
+        })
+
+        self.assertLess(time.monotonic() - start, 0.8)
+        self.assertEqual(results, {"a": "a", "b": "b", "c": "c"})
+        self.assertEqual(failed, set())
+
+    def test_slow_or_broken_sections_fall_back(self):
+        """Are timed-out and failing sections replaced by their fallback?"""
+        results, failed = gather(app, {
+            "fast": Section(slow, [0, "ok"]),
+            "slow": Section(slow, [1, "late"], fallback="fallback", timeout=0.1),
+            "broken": Section(broken, fallback=0),
+        })
+
+        self.assertEqual(results, {"fast": "ok", "slow": "fallback", "broken": 0})
+        self.assertEqual(failed, {"slow", "broken"})
+
+    def test_homepage_hides_failed_counter(self):
+        """Does the homepage still render when a counter section fails?"""
+        count_for = Message.count_for
+        Message.count_for = classmethod(lambda cls, user_id: broken())
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user1_id
+                resp = c.get("/")
+        finally:
+            Message.count_for = count_for
+
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("hello followers", html)
+        self.assertNotIn('<p class="small">Messages</p>', html)
+        self.assertIn('<p class="small">Followers</p>', html)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""Username/email availability tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+import os
+import unittest
+from unittest import mock
+
+from models import db, bcrypt, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app
+from availability import Availability, BloomFilter
+
+
+class BloomFilterTestCase(unittest.TestCase):
+    """Test the filter's guarantees."""
+
+    def test_no_false_negatives(self):
+        """Is every added item reported present?"""
+        bloom = BloomFilter(5000)
+        bloom.add_many(f"user{i}" for i in range(5000))
+        self.assertTrue(all(f"user{i}" in bloom for i in range(5000)))
+
+    def test_false_positive_rate(self):
+        """Are about 1% of never-added items reported present?"""
+        bloom = BloomFilter(5000)
+        bloom.add_many(f"user{i}" for i in range(5000))
+        false_positives = sum(f"other{i}" in bloom for i in range(20000))
+        self.assertLess(false_positives / 20000, 0.02)
+
+
+class AvailabilityTestCase(unittest.TestCase):
+    """Test the availability checks and the routes using them."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.availability = Availability()
+
+        db.create_all()
+
+        User.signup(username="taken",
+                    email="taken@test.com",
+                    password="password",
+                    image_url=None)
+        db.session.commit()
+
+    def tearDown(self):
+        app_module.availability = Availability()
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def signup(self, username, email):
+        return self.client.post("/signup", data={"username": username,
+                                                 "email": email,
+                                                 "password": "password"},
+                                follow_redirects=True)
+
+    def test_taken_signup_skips_bcrypt(self):
+        """Is a taken username or email turned away without hashing?"""
+        with mock.patch.object(bcrypt, 'generate_password_hash',
+                               wraps=bcrypt.generate_password_hash) as hashing:
+            html = self.signup("taken", "new@test.com").get_data(as_text=True)
+            self.assertIn("Username already taken", html)
+            html = self.signup("newname", "taken@test.com").get_data(as_text=True)
+            self.assertIn("E-mail already in use", html)
+            self.assertEqual(hashing.call_count, 0)
+
+            self.signup("newname", "new@test.com")
+            self.assertEqual(hashing.call_count, 1)
+        self.assertEqual(app_module.availability.taken("newname"), {'username'})
+
+    def test_catches_up_on_other_workers(self):
+        """Are users signed up elsewhere since the filter was built seen?"""
+        checker = Availability()
+        self.assertEqual(checker.taken("elsewhere"), set())
+
+        db.session.add(User(username="elsewhere", email="elsewhere@test.com",
+                            password="x"))
+        db.session.commit()
+        self.assertEqual(checker.taken("elsewhere", "elsewhere@test.com", strict=True),
+                         {'username', 'email'})
+
+    def test_available_endpoint(self):
+        """Does the signup form's check report the username, and only that?"""
+        resp = self.client.get("/users/available?username=taken")
+        self.assertEqual(resp.json, {"username": False})
+        self.assertEqual(self.client.get("/users/available?username=free").json,
+                         {"username": True})
+
+        resp = self.client.get("/users/available?email=taken@test.com")
+        self.assertEqual(resp.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
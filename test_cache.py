@@ -0,0 +1,176 @@
+"""Tiered cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+import os
+import tempfile
+import time
+import unittest
+from threading import Thread
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from cache import Cache, FileTier, LocalTier
+
+
+class CacheTestCase(unittest.TestCase):
+    """Test tiers, versioned invalidation and single-flight."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'cache.db')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def workers(self, n=2, version_ttl=0.2):
+        """Caches of `n` workers on one host: each its own LRU, one file."""
+        return [Cache([LocalTier(), FileTier(self.path)], version_ttl=version_ttl)
+                for _ in range(n)]
+
+    def test_lru_evicts_oldest(self):
+        """Does the local tier drop the least recently used entry?"""
+        tier = LocalTier(maxsize=2)
+        tier.set('a', 1, 60)
+        tier.set('b', 2, 60)
+        tier.get_many(['a'])
+        tier.set('c', 3, 60)
+        self.assertEqual(tier.get_many(['a', 'b', 'c']), {'a': 1, 'c': 3})
+
+    def test_shared_between_workers(self):
+        """Does a value computed by one worker serve the other?"""
+        worker1, worker2 = self.workers()
+        calls = []
+        compute = lambda: calls.append(1) or 42
+
+        self.assertEqual(worker1.get_or_set('answer', [('user', 1)], compute), 42)
+        self.assertEqual(worker2.get_or_set('answer', [('user', 1)], compute), 42)
+        self.assertEqual(len(calls), 1)
+
+    def test_bump_invalidates_everywhere(self):
+        """Does one worker's bump invalidate every entry on the entity?"""
+        worker1, worker2 = self.workers()
+        worker2.get_or_set('count', [('messages', 1)], lambda: 1)
+        worker2.get_or_set('profile', [('user', 1), ('messages', 1)], lambda: 'old')
+        worker2.get_or_set('other', [('messages', 2)], lambda: 'kept')
+
+        worker1.bump('messages', 1)
+
+        # worker2 reuses the versions it read for version_ttl.
+        self.assertEqual(worker2.get_or_set('count', [('messages', 1)], lambda: 2), 1)
+        time.sleep(0.25)
+
+        self.assertEqual(worker2.get_or_set('count', [('messages', 1)], lambda: 2), 2)
+        self.assertEqual(worker2.get_or_set('profile', [('user', 1), ('messages', 1)],
+                                            lambda: 'new'), 'new')
+        self.assertEqual(worker2.get_or_set('other', [('messages', 2)], lambda: 'recomputed'),
+                         'kept')
+
+    def test_memory_stand_in(self):
+        """Can a LocalTier stand in for the networked tier?"""
+        network = LocalTier()
+        worker1 = Cache([LocalTier(), network], version_ttl=0)
+        worker2 = Cache([LocalTier(), network], version_ttl=0)
+        worker1.get_or_set('x', [('user', 1)], lambda: 'one')
+        worker2.bump('user', 1)
+        self.assertEqual(worker1.get_or_set('x', [('user', 1)], lambda: 'two'), 'two')
+
+    def test_own_bump_seen_at_once(self):
+        """Does a worker see its own bump without waiting out version_ttl?"""
+        worker, = self.workers(1, version_ttl=60)
+        worker.get_or_set('count', [('messages', 1)], lambda: 1)
+        worker.bump('messages', 1)
+        self.assertEqual(worker.get_or_set('count', [('messages', 1)], lambda: 2), 2)
+
+    def test_versions_read_once(self):
+        """Are versions read from the outermost tier once per version_ttl?"""
+        network = LocalTier()
+        reads = []
+        versions = network.versions
+        network.versions = lambda names: reads.append(names) or versions(names)
+        worker = Cache([LocalTier(), network], version_ttl=60)
+        for _ in range(3):
+            worker.get_or_set('x', [('user', 1)], lambda: 'one')
+        self.assertEqual(len(reads), 1)
+
+    def test_shared_by_default(self):
+        """Do the app's workers share a tier with nothing configured?"""
+        self.assertIsInstance(app_module.cache.tiers[-1], FileTier)
+        self.assertTrue(app_module.cache.tiers[-1].path.startswith(app.instance_path))
+
+    def test_single_flight(self):
+        """Is a hot key computed once, however many workers and threads miss it?"""
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'profile'
+
+        results = []
+        threads = [Thread(target=lambda cache=cache: results.append(
+                       cache.get_or_set('celebrity', [('user', 1)], slow)))
+                   for cache in self.workers(2) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['profile'] * 10)
+        self.assertEqual(len(calls), 1)
+
+
+class CachedViewsTestCase(unittest.TestCase):
+    """Test that the routes invalidate what they change."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+        app_module.follow_graph = None
+
+        db.create_all()
+
+        user = User.signup(username="poster",
+                           email="poster@test.com",
+                           password="password",
+                           image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_new_message_shows_on_cached_profile(self):
+        """Do posting and deleting a warble show on a cached profile?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.get(f"/users/{self.user_id}")
+            c.post("/messages/new", data={"text": "fresh warble"})
+            html = c.get(f"/users/{self.user_id}").get_data(as_text=True)
+            self.assertIn("fresh warble", html)
+
+            msg_id = Message.query.one().id
+            c.post(f"/messages/{msg_id}/delete")
+            html = c.get(f"/users/{self.user_id}").get_data(as_text=True)
+            self.assertNotIn("fresh warble", html)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+"""Background deletion pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_deletion.py
+
+import os
+import unittest
+from datetime import datetime
+from threading import Event
+from unittest.mock import patch
+
+from models import db, User, Message, Likes, Follows, DeletionJob
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+import deletion
+
+
+class DeletionTestCase(unittest.TestCase):
+    """Test tombstoning and chunked, resumable purging."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+        app_module.follow_graph = None
+
+        db.create_all()
+
+        self.heavy = User.signup(username="heavy",
+                                 email="heavy@test.com",
+                                 password="heavypassword",
+                                 image_url=None)
+        self.other = User.signup(username="other",
+                                 email="other@test.com",
+                                 password="otherpassword",
+                                 image_url=None)
+        db.session.commit()
+
+        self.heavy_id = self.heavy.id
+        self.other_id = self.other.id
+
+        messages = [Message(text=f"warble {i}", user_id=self.heavy_id) for i in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        Follows.add(self.heavy_id, self.other_id)
+        Follows.add(self.other_id, self.heavy_id)
+        for msg in messages:
+            Likes.add(self.other_id, msg.id)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def delete_heavy(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.heavy_id
+            return c.post("/users/delete")
+
+    def test_delete_user_tombstones(self):
+        """Is a deleted user hidden immediately, before any purge runs?"""
+        resp = self.delete_heavy()
+        self.assertEqual(resp.status_code, 302)
+
+        # Nothing purged yet...
+        self.assertEqual(Message.query.count(), 5)
+
+        # ...but the account is gone from every page.
+        self.assertEqual(self.client.get(f"/users/{self.heavy_id}").status_code, 404)
+        self.assertNotIn("heavy", self.client.get("/users").get_data(as_text=True))
+        self.assertFalse(User.authenticate("heavy", "heavypassword"))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.other_id
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn("warble 0", html)
+
+    def test_purge_in_chunks_and_resume(self):
+        """Is the purge done in bounded, resumable chunks?"""
+        self.delete_heavy()
+
+        # Work a few small chunks, then "crash" and resume.
+        deletion.run_pending(chunk=2, max_steps=3)
+        job = DeletionJob.query.one()
+        self.assertIsNone(job.finished_at)
+        self.assertGreater(job.rows_deleted, 0)
+
+        deletion.run_pending(chunk=2)
+
+        job = DeletionJob.query.one()
+        self.assertEqual(job.stage, "done")
+        # 2 follows + 5 likes + 5 messages + the user
+        self.assertEqual(job.rows_deleted, 13)
+        self.assertIsNone(db.session.get(User, self.heavy_id))
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+
+    def test_worker_survives_failed_chunk(self):
+        """Does the background worker roll back a failed chunk and carry on
+        purging?"""
+        self.delete_heavy()
+        stop = Event()
+        real_step = deletion.step
+        calls = []
+
+        def flaky(chunk):
+            calls.append(chunk)
+            if len(calls) == 1:
+                raise RuntimeError("database went away")
+            job = real_step(chunk)
+            if job is None:
+                stop.set()
+            return job
+
+        with patch.object(deletion, 'step', flaky):
+            deletion.work(app, stop, idle=0)
+
+        # The worker purged through its own session.
+        db.session.expire_all()
+        self.assertEqual(DeletionJob.query.one().stage, "done")
+        self.assertIsNone(db.session.get(User, self.heavy_id))
+
+    def test_failing_job_backs_off(self):
+        """Is a job whose step fails put off, with its error kept, while
+        the jobs behind it are purged?"""
+        self.delete_heavy()
+        msg = Message(text="doomed", user_id=self.other_id, deleted_at=datetime.utcnow())
+        db.session.add(msg)
+        db.session.commit()
+        deletion.enqueue('message', msg.id)
+        db.session.commit()
+
+        def broken(user_id, chunk):
+            Follows.remove(self.heavy_id, self.other_id)
+            raise RuntimeError("disk full")
+
+        stages = [('follows', broken)] + deletion.PURGE_STAGES['user'][1:]
+        with patch.dict(deletion.PURGE_STAGES, {'user': stages}):
+            deletion.run_pending()
+
+        jobs = {job.kind: job for job in DeletionJob.query}
+        self.assertEqual(jobs['message'].stage, "done")
+        self.assertEqual(jobs['user'].stage, "follows")
+        self.assertEqual(jobs['user'].attempts, 1)
+        self.assertIn("disk full", jobs['user'].last_error)
+        self.assertGreater(jobs['user'].next_attempt_at, datetime.utcnow())
+        # The failed step's deletes were rolled back.
+        self.assertEqual(Follows.query.count(), 2)
+
+        # Once it's due again, it carries on.
+        jobs['user'].next_attempt_at = datetime.utcnow()
+        db.session.commit()
+        deletion.run_pending()
+        job = db.session.get(DeletionJob, jobs['user'].id)
+        self.assertEqual(job.stage, "done")
+        self.assertEqual(job.attempts, 0)
+        self.assertIsNone(db.session.get(User, self.heavy_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+import gzip
+import json
+import os
+import unittest
+
+from models import db, User, Message, Likes, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+
+
+class ExportTestCase(unittest.TestCase):
+    """Test the streaming NDJSON export."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.follow_graph = None
+
+        db.create_all()
+
+        self.testuser1 = User.signup(username="testuser1",
+                                     email="test1@test.com",
+                                     password="test1password",
+                                     image_url=None)
+        self.testuser2 = User.signup(username="testuser2",
+                                     email="test2@test.com",
+                                     password="test2password",
+                                     image_url=None)
+        db.session.commit()
+        self.user1_id = self.testuser1.id
+        self.user2_id = self.testuser2.id
+
+        db.session.add_all([Message(text=f"mine {i}", user_id=self.user1_id) for i in range(3)])
+        theirs = Message(text="theirs", user_id=self.user2_id)
+        db.session.add(theirs)
+        db.session.commit()
+
+        Likes.add(self.user1_id, theirs.id)
+        Follows.add(self.user1_id, self.user2_id)
+        Follows.add(self.user2_id, self.user1_id)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def export(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            return c.get(url)
+
+    def test_export_ndjson(self):
+        """Does the export stream one record per line for every table?"""
+        resp = self.export("/users/export")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+
+        records = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([r["type"] for r in records],
+                         ["user", "message", "message", "message", "like", "following", "follower"])
+        self.assertEqual(records[0]["username"], "testuser1")
+        self.assertNotIn("password", records[0])
+
+    def test_export_gzip(self):
+        """Is ?gzip=1 the same export, gzip-compressed?"""
+        plain = self.export("/users/export").get_data()
+        compressed = self.export("/users/export?gzip=1")
+        self.assertEqual(compressed.mimetype, "application/gzip")
+        self.assertEqual(gzip.decompress(compressed.get_data()), plain)
+
+    def test_export_logged_out(self):
+        """Is a logged-out user turned away?"""
+        resp = self.client.get("/users/export", follow_redirects=True)
+        self.assertIn("Access unauthorized.", resp.get_data(as_text=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+"""Mute and block tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_filters.py
+
+import os
+import unittest
+
+import numpy as np
+
+from models import db, User, Message, Likes, Follows, Mutes, Blocks
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+import deletion
+import filters
+
+
+class FilterFunctionsTestCase(unittest.TestCase):
+    """Test the vectorized lookups."""
+
+    def test_visible_and_without(self):
+        """Are exactly the hidden ids dropped, in order?"""
+        hidden = np.array([3, 7, 20], dtype=np.int32)
+        self.assertEqual(filters.visible([1, 3, 21, 7], hidden).tolist(),
+                         [True, False, True, False])
+        self.assertEqual(filters.without([21, 7, 1, 20], hidden), [21, 1])
+        self.assertEqual(filters.without({5, 6}, filters.EMPTY), [5, 6])
+
+    def test_stream_hidden(self):
+        """Are hidden items dropped across chunks?"""
+        hidden = np.array([2, 4], dtype=np.int32)
+        kept = filters.stream_hidden(iter(range(7)), hidden, key=lambda n: n, chunk=3)
+        self.assertEqual(list(kept), [0, 1, 3, 5, 6])
+
+
+class FilterViewsTestCase(unittest.TestCase):
+    """Test muting and blocking through the routes."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+        app_module.follow_graph = None
+
+        db.create_all()
+
+        self.reader = User.signup(username="reader", email="reader@test.com",
+                                  password="password", image_url=None)
+        self.loud = User.signup(username="loud", email="loud@test.com",
+                                password="password", image_url=None)
+        self.quiet = User.signup(username="quiet", email="quiet@test.com",
+                                 password="password", image_url=None)
+        db.session.commit()
+        self.reader_id = self.reader.id
+        self.loud_id = self.loud.id
+        self.quiet_id = self.quiet.id
+
+        Follows.add(self.reader_id, self.loud_id)
+        Follows.add(self.reader_id, self.quiet_id)
+        Follows.add(self.loud_id, self.reader_id)
+        self.loud_msg = Message(text="loud warble", user_id=self.loud_id)
+        db.session.add_all([self.loud_msg, Message(text="quiet warble", user_id=self.quiet_id)])
+        db.session.commit()
+        self.loud_msg_id = self.loud_msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def page(self, url):
+        return self.client.get(url).get_data(as_text=True)
+
+    def test_mute_hides_from_timeline_only(self):
+        """Does a mute hide the author's warbles from the homepage but not
+        from their profile, and does unmuting bring them back?"""
+        self.login(self.reader_id)
+        self.assertIn("loud warble", self.page("/"))
+
+        resp = self.client.post(f"/users/mute/{self.loud_id}", follow_redirects=True)
+        self.assertIn("Muted @loud", resp.get_data(as_text=True))
+        self.assertIn("Unmute", resp.get_data(as_text=True))
+
+        html = self.page("/")
+        self.assertNotIn("loud warble", html)
+        self.assertIn("quiet warble", html)
+        self.assertNotIn("loud warble", self.page("/?feed=top"))
+        self.assertNotIn("loud warble", self.client.get("/api/v1/timeline").get_data(as_text=True))
+        self.assertIn("loud warble", self.page(f"/users/{self.loud_id}"))
+        # Muting doesn't unfollow.
+        self.assertEqual(Follows.query.filter_by(user_following_id=self.reader_id).count(), 2)
+
+        self.client.post(f"/users/unmute/{self.loud_id}")
+        self.assertIn("loud warble", self.page("/"))
+
+    def test_block_cuts_off_both_ways(self):
+        """Does a block unfollow both ways, hide each from the other, and
+        refuse follows and likes across it?"""
+        self.login(self.reader_id)
+        self.client.post(f"/users/block/{self.loud_id}")
+
+        self.assertEqual(Blocks.query.count(), 1)
+        self.assertFalse(Follows.query.filter_by(user_following_id=self.reader_id,
+                                                 user_being_followed_id=self.loud_id).count())
+        self.assertFalse(Follows.query.filter_by(user_following_id=self.loud_id).count())
+        self.assertNotIn("loud warble", self.page(f"/users/{self.loud_id}"))
+        self.assertNotIn("@loud", self.page("/users?q=loud"))
+
+        resp = self.client.post(f"/users/follow/{self.loud_id}", follow_redirects=True)
+        self.assertIn("You can&#39;t follow this user.", resp.get_data(as_text=True))
+        self.client.post(f"/users/add_like/{self.loud_msg_id}")
+        self.assertEqual(Likes.query.count(), 0)
+
+        # The blocked side is filtered too.
+        self.login(self.loud_id)
+        self.assertNotIn("@reader", self.page("/users?q=reader"))
+        self.assertNotIn("@reader", self.page(f"/users/{self.quiet_id}/followers"))
+        self.client.post(f"/users/follow/{self.reader_id}")
+        self.assertFalse(Follows.query.filter_by(user_following_id=self.loud_id).count())
+
+        self.login(self.reader_id)
+        self.client.post(f"/users/unblock/{self.loud_id}")
+        self.assertIn("loud warble", self.page(f"/users/{self.loud_id}"))
+
+    def test_deleted_user_filters_purged(self):
+        """Does purging a deleted account remove its mutes and blocks?"""
+        Mutes.add(self.reader_id, self.loud_id)
+        Blocks.add(self.quiet_id, self.reader_id)
+        db.session.commit()
+
+        self.login(self.reader_id)
+        self.client.post("/users/delete")
+        deletion.run_pending()
+
+        self.assertEqual(Mutes.query.count(), 0)
+        self.assertEqual(Blocks.query.count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,284 @@
+"""Follow graph and suggestion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_graph.py
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from models import db, User, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from graph import FollowGraph, intersect_sorted
+from writebehind import write_edges
+import outbox
+
+# 1 follows 2 and 3; 2 and 3 both follow 4; 3 also follows 5 and 1.
+EDGES = [(1, 2), (1, 3), (2, 4), (3, 4), (3, 5), (3, 1)]
+
+
+class FollowGraphTestCase(unittest.TestCase):
+    """Test the CSR graph on its own."""
+
+    def setUp(self):
+        followers, followed = zip(*EDGES)
+        self.graph = FollowGraph.from_edges(followers, followed)
+
+    def test_suggestions_ranked_by_mutuals(self):
+        """Are second-degree accounts ranked by mutual follows?"""
+        self.assertEqual(list(self.graph.following(3)), [1, 4, 5])
+        self.assertEqual(self.graph.suggestions(1), [(4, 2), (5, 1)])
+        self.assertEqual(self.graph.suggestions(99), [])
+
+    def test_incremental_updates(self):
+        """Are follows made after the build seen, before and after compacting?"""
+        self.graph.add(1, 4)
+        self.graph.remove(1, 3)
+        self.graph.add(7, 1)
+        self.assertEqual(self.graph.suggestions(1), [])
+        self.assertEqual(list(self.graph.following(1)), [2, 4])
+
+        self.graph.compact()
+        self.assertEqual(self.graph.pending, 0)
+        self.assertEqual(list(self.graph.following(1)), [2, 4])
+        self.assertEqual(list(self.graph.following(7)), [1])
+        self.assertEqual(self.graph.suggestions(7), [(2, 1), (4, 1)])
+
+    def test_follows_replayed_onto_replacement(self):
+        """Does a newer graph get the follows made since it was read, and
+        those made on the old one afterwards, but not older ones?"""
+        self.graph.add(1, 5)
+        followers, followed = zip(*EDGES)
+        newer = FollowGraph.from_edges(followers, followed)
+        self.graph.add(1, 4)
+
+        self.assertIs(self.graph.replaced_by(newer), newer)
+        self.assertEqual(list(newer.following(1)), [2, 3, 4])
+
+        self.graph.remove(1, 2)
+        self.assertEqual(list(newer.following(1)), [3, 4])
+        self.assertEqual(list(newer.followers(2)), [])
+
+    def test_intersect_sorted(self):
+        """Does the binary-search intersection match a set intersection?"""
+        a = np.array([1, 5, 9, 12, 40], dtype=np.int32)
+        b = np.arange(0, 1000, 3, dtype=np.int32)
+        self.assertEqual(list(intersect_sorted(a, b)), [9, 12])
+        self.assertEqual(list(intersect_sorted(b, a)), [9, 12])
+        self.assertEqual(list(intersect_sorted(a[:0], b)), [])
+        self.assertEqual(list(intersect_sorted(a, np.array([41], dtype=np.int32))), [])
+
+    def test_known_followers(self):
+        """Are followers known to the viewer found, and kept up to date?"""
+        self.assertEqual(list(self.graph.followers(4)), [2, 3])
+        self.assertEqual(list(self.graph.known_followers(1, 4)), [2, 3])
+
+        self.graph.remove(2, 4)
+        self.assertEqual(list(self.graph.known_followers(1, 4)), [3])
+        self.graph.add(2, 4)
+        self.assertEqual(list(self.graph.known_followers(1, 4)), [2, 3])
+
+    def test_mutual_follows(self):
+        """Are the accounts two users both follow found?"""
+        self.assertEqual(list(self.graph.mutual_follows(2, 3)), [4])
+        self.assertEqual(list(self.graph.mutual_follows(1, 3)), [])
+        self.graph.add(1, 5)
+        self.assertEqual(list(self.graph.mutual_follows(1, 3)), [5])
+
+    def test_snapshot_is_memory_mapped(self):
+        """Does a saved snapshot load back memory-mapped, and reload when rewritten?"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "graph.bin")
+            self.graph.save(path)
+
+            loaded = FollowGraph.load(path)
+            self.assertEqual(type(loaded.indices).__name__, "memmap")
+            self.assertEqual(loaded.suggestions(1), self.graph.suggestions(1))
+            self.assertIs(loaded.reload_if_changed(), loaded)
+
+            self.graph.add(1, 5)
+            self.graph.save(path)
+            os.utime(path, (0, loaded.mtime + 1))
+            self.assertEqual(loaded.reload_if_changed().suggestions(1), [(4, 2)])
+
+
+class SuggestionsViewTestCase(unittest.TestCase):
+    """Test the /users/suggestions route."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app_module.follow_graph = None
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+
+        db.create_all()
+
+        self.ids = []
+        for i in range(4):
+            user = User.signup(username=f"user{i}",
+                               email=f"user{i}@test.com",
+                               password="password",
+                               image_url=None)
+            db.session.commit()
+            self.ids.append(user.id)
+
+        me, friend, other, popular = self.ids
+        Follows.add(me, friend)
+        Follows.add(me, other)
+        Follows.add(friend, popular)
+        Follows.add(other, popular)
+        db.session.commit()
+
+    def tearDown(self):
+        app_module.follow_graph = None
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_suggestions(self):
+        """Are friends-of-friends suggested, and followed ones dropped?"""
+        me, friend, other, popular = self.ids
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+
+            html = c.get("/users/suggestions").get_data(as_text=True)
+            self.assertIn("@user3", html)
+            self.assertIn("Followed by 2 people you follow", html)
+            self.assertNotIn("@user1", html)
+
+            c.post(f"/users/follow/{popular}")
+            html = c.get("/users/suggestions").get_data(as_text=True)
+            self.assertNotIn("@user3", html)
+
+    def test_profile_shows_known_followers(self):
+        """Does a profile name the followers the viewer knows?"""
+        me, friend, other, popular = self.ids
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+
+            html = c.get(f"/users/{popular}").get_data(as_text=True)
+            self.assertIn("Followed by user1 and user2", html)
+
+            c.post(f"/users/stop-following/{other}")
+            html = c.get(f"/users/{popular}").get_data(as_text=True)
+            self.assertIn("Followed by user1<", html)
+
+    def test_counts_and_known_followers_skip_deleted(self):
+        """Do a deleted account's follows stop counting on profiles, even
+        though this worker's graph was built before it was deleted?"""
+        me, friend, other, popular = self.ids
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+            html = c.get(f"/users/{popular}").get_data(as_text=True)
+            self.assertIn(f'/users/{popular}/followers">2<', html)
+            self.assertIn("Followed by user1 and user2", html)
+
+        # friend deletes their account on another worker, whose outbox
+        # events then reach this one's cache; this worker's graph doesn't
+        # know.
+        other_worker = app.test_client()
+        with other_worker.session_transaction() as sess:
+            sess[CURR_USER_KEY] = friend
+        other_worker.post("/users/delete")
+        outbox.run_pending(app_module.OUTBOX_CONSUMERS)
+
+        with self.client as c:
+            html = c.get(f"/users/{popular}").get_data(as_text=True)
+            self.assertIn(f'/users/{popular}/followers">1<', html)
+            self.assertIn("Followed by user2<", html)
+            html = c.get(f"/users/{me}").get_data(as_text=True)
+            self.assertIn(f'/users/{me}/following">1<', html)
+
+    def test_profile_shows_mutual_follows(self):
+        """Does a profile say how many accounts the viewer and they both
+        follow?"""
+        me, friend, other, popular = self.ids
+        Follows.add(popular, friend)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+            html = c.get(f"/users/{popular}").get_data(as_text=True)
+            self.assertIn("You both follow 1 account<", html)
+            self.assertNotIn("You both follow", c.get(f"/users/{me}").get_data(as_text=True))
+
+    def test_other_workers_follows_synced(self):
+        """Does a worker's graph pick up follows made on other workers from
+        the outbox?"""
+        me, friend, other, popular = self.ids
+        graph = app_module.get_follow_graph()
+
+        write_edges({('follow', me, popular): 'add', ('follow', other, popular): 'remove'})
+        db.session.commit()
+        self.assertNotIn(popular, graph.following(me))
+
+        app_module.sync_follow_graph()
+        self.assertIn(popular, graph.following(me))
+        self.assertNotIn(popular, graph.following(other))
+
+    def test_graph_rebuilt_when_stale(self):
+        """Does a worker's graph pick up follows made by other workers once
+        it's older than FOLLOW_GRAPH_REFRESH?"""
+        me, friend, other, popular = self.ids
+        graph = app_module.get_follow_graph()
+
+        Follows.add(me, popular)
+        db.session.commit()
+        self.assertIs(app_module.get_follow_graph(), graph)
+
+        with patch.dict(app.config, FOLLOW_GRAPH_REFRESH=0):
+            app_module.get_follow_graph()
+            # Wait for the background rebuild to finish.
+            with app_module.follow_graph_rebuilding:
+                pass
+        self.assertIsNot(app_module.follow_graph, graph)
+        self.assertIn(popular, app_module.get_follow_graph().following(me))
+
+    def test_follows_during_rebuild_kept(self):
+        """Are follows made while the graph is rebuilt on the new one?"""
+        me, friend, other, popular = self.ids
+        graph = app_module.get_follow_graph()
+        from_db = FollowGraph.from_db
+
+        def from_db_meanwhile():
+            rebuilt = from_db()
+            graph.add(me, popular)
+            return rebuilt
+
+        with patch.object(FollowGraph, 'from_db', from_db_meanwhile), \
+                patch.dict(app.config, FOLLOW_GRAPH_REFRESH=0):
+            app_module.get_follow_graph()
+            with app_module.follow_graph_rebuilding:
+                pass
+        self.assertIsNot(app_module.follow_graph, graph)
+        self.assertIn(popular, app_module.follow_graph.following(me))
+
+    def test_suggestions_logged_out(self):
+        """Are logged-out visitors turned away?"""
+        resp = self.client.get("/users/suggestions", follow_redirects=True)
+        self.assertIn("Access unauthorized.", resp.get_data(as_text=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
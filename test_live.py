@@ -0,0 +1,196 @@
+"""Live timeline stream tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+import asyncio
+import os
+import threading
+import time
+import unittest
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import live
+import outbox
+from live import Hub, LocalBackend, PostgresBackend, asgi_app
+
+
+class LiveStreamTestCase(unittest.TestCase):
+    """Test the ASGI stream app and its hub."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+        db.create_all()
+
+        self.testuser1 = User.signup(username="testuser1",
+                                     email="test1@test.com",
+                                     password="test1password",
+                                     image_url=None)
+        self.testuser2 = User.signup(username="testuser2",
+                                     email="test2@test.com",
+                                     password="test2password",
+                                     image_url=None)
+        self.testuser3 = User.signup(username="testuser3",
+                                     email="test3@test.com",
+                                     password="test3password",
+                                     image_url=None)
+        db.session.commit()
+        self.user1_id = self.testuser1.id
+        self.user2_id = self.testuser2.id
+        self.user3_id = self.testuser3.id
+
+        Follows.add(self.user1_id, self.user2_id)
+        db.session.commit()
+
+        self.hub = Hub(LocalBackend())
+        self.asgi = asgi_app(app, self.hub, Follows.followed_ids, CURR_USER_KEY)
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def session_cookie(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        value = self.client.get_cookie(app.config['SESSION_COOKIE_NAME']).value
+        return f"{app.config['SESSION_COOKIE_NAME']}={value}".encode()
+
+    def run_stream(self, cookie, posts):
+        """Open a stream, publish `posts` once it's up, return what's sent."""
+
+        sent = []
+        disconnect = None
+
+        async def receive():
+            await disconnect
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            if message['type'] == 'http.response.start':
+                asyncio.get_running_loop().call_later(0.05, publish)
+            elif b'event: warble' in message.get('body', b''):
+                disconnect.set_result(True)
+
+        def publish():
+            for user_id, message_id in posts:
+                self.hub.publish(user_id, message_id)
+            asyncio.get_running_loop().call_later(0.2, finish)
+
+        def finish():
+            if not disconnect.done():
+                disconnect.set_result(True)
+
+        async def main():
+            nonlocal disconnect
+            disconnect = asyncio.get_running_loop().create_future()
+            scope = {'type': 'http', 'path': '/stream',
+                     'headers': [(b'cookie', cookie)] if cookie else []}
+            await asyncio.wait_for(self.asgi(scope, receive, send), 5)
+
+        asyncio.run(main())
+        return sent
+
+    def test_requires_login(self):
+        """Is a stream without a session refused?"""
+        sent = self.run_stream(None, [])
+        self.assertEqual(sent[0]['status'], 401)
+
+    def test_followed_warble_is_pushed(self):
+        """Does a followed user's new warble reach the stream?"""
+        sent = self.run_stream(self.session_cookie(self.user1_id),
+                               [(self.user3_id, 1), (self.user2_id, 2)])
+
+        self.assertEqual(sent[0]['status'], 200)
+        frames = b''.join(m.get('body', b'') for m in sent[1:])
+        self.assertEqual(frames, b'event: warble\ndata: {"id":2,"user_id":%d}\n\n'
+                         % self.user2_id)
+        self.assertEqual(self.hub._subscribers, {})
+
+    def test_messages_add_publishes(self):
+        """Is a posted warble published to the app's hub, from the outbox?"""
+        import app as app_module
+
+        published = []
+        app_module.hub.backend.listen(published.append)
+        self.addCleanup(app_module.hub.backend._callbacks.remove, published.append)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+            c.post("/messages/new", data={"text": "live!"})
+        self.assertEqual(published, [])
+        outbox.run_pending(app_module.OUTBOX_CONSUMERS)
+
+        msg = Message.query.one()
+        self.assertIn(f'{{"id": {msg.id}, "user_id": {self.user2_id}}}', published)
+
+
+    def test_postgres_backend_reconnects(self):
+        """Does the LISTEN side come back after failing to connect and after
+        its connection is killed?"""
+        import psycopg2
+
+        self.addCleanup(setattr, live, 'RECONNECT_MIN', live.RECONNECT_MIN)
+        live.RECONNECT_MIN = 0.01
+
+        backend = PostgresBackend("dbname=warbler-test")
+        connect = backend._connect
+        listeners = []
+        down = [True]
+
+        def flaky_connect():
+            if down[0] and threading.current_thread() is not threading.main_thread():
+                raise psycopg2.OperationalError("database is down")
+            conn = connect()
+            if threading.current_thread() is not threading.main_thread():
+                listeners.append(conn)
+            return conn
+
+        backend._connect = flaky_connect
+        received = []
+        backend.listen(received.append)
+
+        def published(payload):
+            # LISTEN may not be registered yet, so keep sending until it lands.
+            for _ in range(200):
+                backend.publish(payload)
+                time.sleep(0.025)
+                if payload in received:
+                    return True
+            return False
+
+        time.sleep(0.05)
+        down[0] = False
+        self.assertTrue(published("first"))
+
+        with backend._conn.cursor() as cur:
+            cur.execute("SELECT pg_terminate_backend(%s)", (listeners[-1].get_backend_pid(),))
+        self.assertTrue(published("second"))
+        self.assertEqual(len(listeners), 2)
+
+        # Leave the listener thread retrying quietly instead of holding a
+        # connection to the test database.
+        down[0] = True
+        live.RECONNECT_MIN = 60
+        with backend._conn.cursor() as cur:
+            cur.execute("SELECT pg_terminate_backend(%s)", (listeners[-1].get_backend_pid(),))
+        backend._conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+"""Uploaded picture tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_media.py
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from PIL import Image
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+import media
+from media import MediaStore, BadImage
+
+
+def image_bytes(size=(640, 480), fmt='JPEG', color='teal'):
+    out = io.BytesIO()
+    Image.new('RGB', size, color).save(out, fmt)
+    return out.getvalue()
+
+
+class MediaStoreTestCase(unittest.TestCase):
+    """Test storing uploads and rendering their variants."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = MediaStore(self.root)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.root)
+
+    def digest(self, url):
+        return url[len(media.URL_PREFIX):]
+
+    def test_variants_rendered(self):
+        """Are an avatar's square variants rendered at their sizes?"""
+        url = self.store.save(image_bytes(fmt='PNG'), 'avatar')
+        digest = self.digest(url)
+        self.assertTrue(self.store.ready(digest, 'timeline', timeout=5))
+
+        for variant, size in [('timeline', (48, 48)), ('card', (128, 128))]:
+            with Image.open(self.store.variant_path(digest, variant)) as image:
+                self.assertEqual(image.format, 'JPEG')
+                self.assertEqual(image.size, size)
+        self.assertFalse(os.path.exists(self.store.variant_path(digest, 'hero')))
+
+    def test_hero_keeps_aspect(self):
+        """Is a header shrunk to fit, not cropped?"""
+        digest = self.digest(self.store.save(image_bytes((3000, 1500)), 'header'))
+        self.assertTrue(self.store.ready(digest, 'hero', timeout=5))
+        with Image.open(self.store.variant_path(digest, 'hero')) as image:
+            self.assertEqual(image.size, (1000, 500))
+
+    def test_content_addressed(self):
+        """Is the same picture stored once, whoever uploads it?"""
+        data = image_bytes()
+        self.assertEqual(self.store.save(data, 'avatar'), self.store.save(data, 'avatar'))
+        self.assertNotEqual(self.store.save(data, 'avatar'),
+                            self.store.save(image_bytes(color='red'), 'avatar'))
+
+    def test_render_missing_by_kind(self):
+        """Are only the variants of each upload's kind rendered again?"""
+        avatar = self.digest(self.store.save(image_bytes(), 'avatar'))
+        header = self.digest(self.store.save(image_bytes(color='red'), 'header'))
+        self.store.close()
+        for digest, variant in [(avatar, 'card'), (header, 'hero')]:
+            os.remove(self.store.variant_path(digest, variant))
+
+        self.store = MediaStore(self.root)
+        self.assertEqual(self.store.render_missing(), 2)
+        self.assertTrue(os.path.exists(self.store.variant_path(avatar, 'card')))
+        self.assertTrue(os.path.exists(self.store.variant_path(header, 'hero')))
+        self.assertFalse(os.path.exists(self.store.variant_path(avatar, 'hero')))
+        self.assertFalse(os.path.exists(self.store.variant_path(header, 'card')))
+
+    def test_rejects_non_images(self):
+        """Are files that aren't images turned away?"""
+        with self.assertRaises(BadImage):
+            self.store.save(b"not a picture", 'avatar')
+        with self.assertRaises(BadImage):
+            self.store.save(b"x" * (media.MAX_BYTES + 1), 'avatar')
+
+    def test_media_url(self):
+        """Are only uploads mapped to variants?"""
+        self.assertEqual(media.media_url('/media/abc', 'card'), '/media/abc/card.jpg')
+        self.assertEqual(media.media_url('http://example.com/a.png', 'card'),
+                         'http://example.com/a.png')
+
+
+class MediaViewsTestCase(unittest.TestCase):
+    """Test uploading pictures and serving their variants."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+        app_module.follow_graph = None
+        self.root = tempfile.mkdtemp()
+        self.store = app_module.media_store
+        app_module.media_store = MediaStore(self.root)
+
+        db.create_all()
+
+        user = User.signup(username="artist", email="artist@test.com",
+                           password="password", image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        app_module.media_store.close()
+        app_module.media_store = self.store
+        shutil.rmtree(self.root)
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_profile_upload(self):
+        """Does an uploaded avatar show in its timeline size, served with
+        immutable cache headers?"""
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.post("/users/profile", data={
+            "username": "artist", "email": "artist@test.com", "password": "password",
+            "image_file": (io.BytesIO(image_bytes()), "me.jpg"),
+        }, content_type="multipart/form-data")
+        self.assertEqual(resp.status_code, 302)
+
+        url = db.session.get(User, self.user_id).image_url
+        self.assertTrue(url.startswith(media.URL_PREFIX))
+
+        db.session.add(Message(text="look at me", user_id=self.user_id))
+        db.session.commit()
+        html = self.client.get(f"/users/{self.user_id}").get_data(as_text=True)
+        self.assertIn(f"{url}/timeline.jpg", html)
+
+        resp = self.client.get(f"{url}/timeline.jpg")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertLess(len(resp.data), 5000)
+
+    def test_bad_upload_refused(self):
+        """Is a file that isn't an image refused, keeping the old picture?"""
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.post("/users/profile", data={
+            "username": "artist", "email": "artist@test.com", "password": "password",
+            "image_file": (io.BytesIO(b"not a picture"), "me.png"),
+        }, content_type="multipart/form-data")
+        self.assertIn("isn&#39;t an image", resp.get_data(as_text=True))
+        self.assertEqual(db.session.get(User, self.user_id).image_url,
+                         "/static/images/default-pic.png")
+
+    def test_signup_upload(self):
+        """Can a picture be uploaded when signing up?"""
+        self.client.post("/signup", data={
+            "username": "newbie", "email": "newbie@test.com", "password": "password",
+            "image_file": (io.BytesIO(image_bytes(fmt='PNG')), "me.png"),
+        }, content_type="multipart/form-data")
+        user = User.query.filter_by(username="newbie").one()
+        self.assertTrue(user.image_url.startswith(media.URL_PREFIX))
+
+    def test_failed_signup_discards_upload(self):
+        """Is the picture of a signup that fails not left behind?"""
+        # As if "artist" was taken by another worker after the check.
+        with patch.object(app_module.availability, 'taken', return_value=set()):
+            resp = self.client.post("/signup", data={
+                "username": "artist", "email": "another@test.com", "password": "password",
+                "image_file": (io.BytesIO(image_bytes(fmt='PNG')), "me.png"),
+            }, content_type="multipart/form-data")
+        self.assertIn("Username already taken", resp.get_data(as_text=True))
+        self.assertEqual(list(app_module.media_store.digests()), [])
+
+    def test_unknown_media_404(self):
+        """Are unknown uploads and variants not found?"""
+        self.assertEqual(self.client.get(f"/media/{'0' * 64}/card.jpg").status_code, 404)
+        self.assertEqual(self.client.get(f"/media/{'0' * 64}/huge.jpg").status_code, 404)
+        self.assertEqual(self.client.get("/media/..%2F..%2Fapp.py/card.jpg").status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
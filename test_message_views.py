@@ -8,7 +8,11 @@
 import os
 import unittest
 from unittest import TestCase
-from models import db, connect_db, Message, User
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from models import db, connect_db, Message, User, Likes, Follows, Rewarbles
 from flask import session
 
 
@@ -22,7 +26,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
+import app as app_module
 from app import app, CURR_USER_KEY
+import deletion
 from flask import g
 
 # Create our tables (we do this here, so we only create the tables
@@ -121,8 +127,16 @@ class MessageViewTestCase(TestCase):
             resp = c.post(f"/messages/{msg.id}/delete", follow_redirects=True)
             self.assertEqual(resp.status_code, 200)
 
+            # The message is hidden right away...
+            resp = c.get(f"/messages/{msg.id}")
+            self.assertEqual(resp.status_code, 404)
+
+            # ...and gone once the background purge has run.
+            msg_id = msg.id
+            deletion.run_pending()
+
             # Ensure the message was deleted
-            deleted_msg = Message.query.get(msg.id)
+            deleted_msg = Message.query.get(msg_id)
             self.assertIsNone(deleted_msg)
 
 
@@ -166,5 +180,130 @@ class MessageViewTestCase(TestCase):
             self.assertIn(b"viewable message", resp.data)
 
 
+    def test_view_message_like_summary(self):
+        """Does a message show its like count and who liked it?"""
+        msg = Message(text="popular message", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        for i in range(3):
+            fan = User.signup(username=f"fan{i}", email=f"fan{i}@test.com",
+                              password="fanpassword", image_url=None)
+            db.session.commit()
+            Likes.add(fan.id, msg.id)
+        Likes.add(self.other_user.id, msg.id)
+        Follows.add(self.testuser.id, self.other_user.id)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get(f"/messages/{msg.id}").get_data(as_text=True)
+            # Someone the viewer follows is named first.
+            self.assertIn("Liked by otheruser and 3 others", html)
+
+
+    def make_rewarblers(self, count):
+        ids = []
+        for i in range(count):
+            user = User.signup(username=f"rewarbler{i}", email=f"rewarbler{i}@test.com",
+                               password="password", image_url=None)
+            db.session.commit()
+            Follows.add(self.testuser.id, user.id)
+            ids.append(user.id)
+        db.session.commit()
+        return ids
+
+
+    def test_rewarble(self):
+        """Is a re-warble a pointer, and can it be undone?"""
+        msg = Message(text="worth sharing", user_id=self.other_user.id)
+        own = Message(text="my own", user_id=self.testuser.id)
+        db.session.add_all([msg, own])
+        db.session.commit()
+        msg_id, own_id = msg.id, own.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/messages/{msg_id}/rewarble")
+            c.post(f"/messages/{msg_id}/rewarble")
+            self.assertEqual(Rewarbles.query.count(), 1)
+            self.assertEqual(Message.query.count(), 2)
+
+            resp = c.post(f"/messages/{own_id}/rewarble", follow_redirects=True)
+            self.assertIn("You cannot re-warble your own warbles!", resp.get_data(as_text=True))
+
+            c.post(f"/messages/{msg_id}/unrewarble")
+            self.assertEqual(Rewarbles.query.count(), 0)
+
+
+    def test_feed_dedupes_rewarbles(self):
+        """Does a warble re-warbled by several followed users, and posted
+        by one, show once at its latest activity, naming who re-warbled it?"""
+        first, second = self.make_rewarblers(2)
+        Follows.add(self.testuser.id, self.other_user.id)
+        now = datetime.utcnow()
+        old = Message(text="old warble", user_id=self.other_user.id,
+                      timestamp=now - timedelta(days=2))
+        newer = Message(text="newer warble", user_id=self.other_user.id,
+                        timestamp=now - timedelta(days=1))
+        db.session.add_all([old, newer])
+        db.session.commit()
+        db.session.add_all([
+            Rewarbles(user_id=first, message_id=old.id, timestamp=now - timedelta(hours=2)),
+            Rewarbles(user_id=second, message_id=old.id, timestamp=now - timedelta(hours=1)),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertEqual(html.count("<p>old warble</p>"), 1)
+            self.assertLess(html.index("old warble"), html.index("newer warble"))
+            self.assertIn("Re-warbled by rewarbler1 and rewarbler0", html)
+
+
+    def test_feed_statements_same_with_rewarbles(self):
+        """Does the homepage cost the same queries however many re-warbles?"""
+        rewarblers = self.make_rewarblers(3)
+        Follows.add(self.testuser.id, self.other_user.id)
+        msgs = [Message(text=f"warble {i}", user_id=self.other_user.id) for i in range(5)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        msg_ids = [msg.id for msg in msgs]
+
+        statements = []
+        def count(*args):
+            statements.append(args)
+
+        def measure():
+            db.session.expunge_all()
+            g.pop("following_ids", None)
+            g.pop("hidden_ids", None)
+            app_module.cache.clear()
+            del statements[:]
+            c.get("/")
+            return len(statements)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            plain = measure()
+            db.session.add_all([Rewarbles(user_id=user_id, message_id=msg_id)
+                                for user_id in rewarblers for msg_id in msg_ids])
+            db.session.commit()
+            rewarbled = measure()
+        event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertEqual(rewarbled, plain)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
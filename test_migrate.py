@@ -0,0 +1,149 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrate.py
+
+import os
+import unittest
+from datetime import datetime
+
+from sqlalchemy import MetaData, inspect
+
+from models import db, User, Message, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import migrate
+
+# The tables as the first release made them.
+BASELINE = """
+CREATE TABLE users (
+    id SERIAL NOT NULL,
+    email TEXT NOT NULL,
+    username TEXT NOT NULL,
+    image_url TEXT,
+    header_image_url TEXT,
+    bio TEXT,
+    location TEXT,
+    password TEXT NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE (email),
+    UNIQUE (username)
+);
+CREATE TABLE follows (
+    user_being_followed_id INTEGER NOT NULL,
+    user_following_id INTEGER NOT NULL,
+    PRIMARY KEY (user_being_followed_id, user_following_id),
+    FOREIGN KEY(user_being_followed_id) REFERENCES users (id) ON DELETE cascade,
+    FOREIGN KEY(user_following_id) REFERENCES users (id) ON DELETE cascade
+);
+CREATE TABLE messages (
+    id SERIAL NOT NULL,
+    text VARCHAR(140) NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE
+);
+CREATE TABLE likes (
+    id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    PRIMARY KEY (id, user_id, message_id),
+    FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE cascade,
+    FOREIGN KEY(message_id) REFERENCES messages (id) ON DELETE cascade
+);
+INSERT INTO users (email, username, password) VALUES
+    ('a@test.com', 'a', 'x'), ('b@test.com', 'b', 'x');
+INSERT INTO messages (text, timestamp, user_id) VALUES
+    ('first', '2020-01-01 12:00', 1), ('second', '2020-02-01 12:00', 1);
+INSERT INTO likes (id, user_id, message_id) VALUES
+    (1, 2, 1), (2, 2, 1), (2, 2, 2);
+"""
+
+
+def drop_tables():
+    """Drop every table, whatever schema it was made with."""
+    tables = MetaData()
+    tables.reflect(db.engine)
+    tables.drop_all(db.engine)
+
+
+class MigrateTestCase(unittest.TestCase):
+    """Test upgrading a database made by an older release."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+
+        self.app_context = app.app_context()
+        self.app_context.push()
+        drop_tables()
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(BASELINE)
+
+    def tearDown(self):
+        db.session.rollback()
+        drop_tables()
+        db.create_all()
+        self.app_context.pop()
+
+    def test_upgrade_from_baseline(self):
+        """Does an old database get the keys the models expect, keeping its
+        data, and only once?"""
+        self.assertEqual(migrate.upgrade(db.engine), [name for name, _ in migrate.scripts()])
+        self.assertEqual(migrate.upgrade(db.engine), [])
+
+        with db.engine.begin() as conn:
+            # The doubled like is gone, and liking again is a no-op.
+            self.assertEqual(conn.exec_driver_sql(
+                "SELECT user_id, message_id FROM likes ORDER BY message_id").all(),
+                [(2, 1), (2, 2)])
+            conn.exec_driver_sql("INSERT INTO likes (user_id, message_id, timestamp) "
+                                 "VALUES (2, 1, now()), (1, 2, now()) ON CONFLICT DO NOTHING")
+            ids = conn.exec_driver_sql("SELECT id FROM likes").scalars().all()
+        self.assertEqual(len(set(ids)), 3)
+
+        # Nothing is tombstoned yet.
+        with db.engine.begin() as conn:
+            self.assertEqual(conn.exec_driver_sql(
+                "SELECT count(*) FROM users WHERE deleted_at IS NULL").scalar(), 2)
+            self.assertEqual(conn.exec_driver_sql(
+                "SELECT count(*) FROM messages WHERE deleted_at IS NULL").scalar(), 2)
+
+        # Old likes take their message's time.
+        with db.engine.begin() as conn:
+            self.assertEqual(conn.exec_driver_sql(
+                "SELECT message_id, timestamp FROM likes WHERE user_id = 2 ORDER BY message_id"
+            ).all(), [(1, datetime(2020, 1, 1, 12)), (2, datetime(2020, 2, 1, 12))])
+
+        # And the models can use every column they expect.
+        tables = inspect(db.engine)
+        for model in (User, Message, Likes):
+            columns = {c['name'] for c in tables.get_columns(model.__tablename__)}
+            self.assertLessEqual(set(model.__table__.columns.keys()), columns)
+        self.assertIn('ix_likes_user_id_timestamp_message_id',
+                      {i['name'] for i in tables.get_indexes('likes')})
+        self.assertIn('ix_messages_user_id_timestamp',
+                      {i['name'] for i in tables.get_indexes('messages')})
+        # Likes outlive archived messages.
+        self.assertEqual([fk['referred_table'] for fk in tables.get_foreign_keys('likes')],
+                         ['users'])
+
+        Likes.add(2, 1)
+        Likes.add(2, 2)
+        db.session.commit()
+        self.assertEqual(Likes.query.count(), 3)
+
+    def test_upgrade_new_database(self):
+        """Do the scripts run cleanly on a database create_all just made?"""
+        drop_tables()
+        db.create_all()
+        self.assertEqual(migrate.upgrade(db.engine), [name for name, _ in migrate.scripts()])
+
+
+if __name__ == '__main__':
+    unittest.main()
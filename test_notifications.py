@@ -0,0 +1,189 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+import os
+import unittest
+from datetime import datetime, timedelta
+
+from models import (db, User, Message, Follows, NotificationCounter,
+                    NotificationEvent, NotificationGroup)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+import outbox
+from notifications import (compact, from_outbox, mark_read, notifications_for,
+                           unread_count)
+
+
+class NotificationsTestCase(unittest.TestCase):
+    """Test notifying, collapsing, counting and compacting notifications."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+        app_module.follow_graph = None
+
+        db.create_all()
+
+        users = [User(username=f"user{i}", email=f"user{i}@test.com", password="x")
+                 for i in range(43)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.author_id = users[0].id
+        self.fan_ids = [user.id for user in users[1:]]
+
+        msg = Message(text="popular", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def like_as(self, user_id):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post(f"/users/add_like/{self.msg_id}")
+
+    def record(self, kind, user_id, target_id):
+        outbox.record(kind, user_id, target_id)
+        db.session.commit()
+
+    def deliver(self):
+        """Run the notifications consumer; returns how many events it wrote."""
+        written = []
+        outbox.run_pending({'notifications':
+                            lambda events: written.append(from_outbox(events))})
+        return sum(written)
+
+    def test_likes_collapse(self):
+        """Do many likes show as one line, naming the latest liker?"""
+        for fan_id in self.fan_ids:
+            self.like_as(fan_id)
+        self.assertEqual(NotificationEvent.query.count(), 0)
+
+        self.assertEqual(self.deliver(), 42)
+        found = notifications_for(self.author_id)
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0].message.id, self.msg_id)
+        self.assertEqual(found[0].count, 42)
+        self.assertRegex(found[0].text, r"^user\d+ and 41 others liked your warble$")
+
+    def test_repeat_likes_notify_once(self):
+        """Does a double-clicked like make one event?"""
+        self.record('like.added', self.fan_ids[0], self.msg_id)
+        self.record('like.added', self.fan_ids[0], self.msg_id)
+        self.assertEqual(self.deliver(), 1)
+        self.record('like.added', self.fan_ids[0], self.msg_id)
+        self.assertEqual(self.deliver(), 0)
+        self.assertEqual(unread_count(self.author_id), 1)
+
+    def test_follow_back(self):
+        """Is following someone who follows you a follow-back?"""
+        Follows.add(self.author_id, self.fan_ids[0])
+        db.session.commit()
+        self.record('follow.added', self.author_id, self.fan_ids[0])
+        self.record('follow.added', self.fan_ids[0], self.author_id)
+        self.deliver()
+
+        self.assertEqual([n.text for n in notifications_for(self.fan_ids[0])],
+                         ["user0 followed you"])
+        self.assertEqual([n.text for n in notifications_for(self.author_id)],
+                         ["user1 followed you back"])
+
+    def test_unread_count(self):
+        """Does the nav count unread notifications until they're read?"""
+        self.like_as(self.fan_ids[0])
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan_ids[1]
+            c.post(f"/users/follow/{self.author_id}")
+        self.deliver()
+        self.assertEqual(db.session.get(NotificationCounter, self.author_id).unread, 2)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn('<span class="badge badge-primary">2</span>', html)
+
+            html = c.get("/notifications").get_data(as_text=True)
+            self.assertIn("user1 liked your warble", html)
+            self.assertIn("user2 followed you", html)
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn('badge-primary', html)
+
+    def test_unread_counts_groups(self):
+        """Do many likes of one warble count as one unread notification,
+        and more after reading it as one more?"""
+        for fan_id in self.fan_ids[:10]:
+            self.record('like.added', fan_id, self.msg_id)
+        self.deliver()
+        self.assertEqual(unread_count(self.author_id), 1)
+
+        mark_read(self.author_id)
+        db.session.commit()
+        self.assertEqual(unread_count(self.author_id), 0)
+
+        for fan_id in self.fan_ids[10:20]:
+            self.record('like.added', fan_id, self.msg_id)
+        self.deliver()
+        self.assertEqual(unread_count(self.author_id), 1)
+
+    def test_compaction(self):
+        """Are old events folded into groups, and read along with new ones?"""
+        for fan_id in self.fan_ids[:30]:
+            self.record('like.added', fan_id, self.msg_id)
+        self.deliver()
+
+        self.assertEqual(compact(now=datetime.utcnow() + timedelta(hours=2)), 30)
+        self.assertEqual(NotificationEvent.query.count(), 0)
+        group = NotificationGroup.query.one()
+        self.assertEqual(group.count, 30)
+        self.assertEqual(len(group.actor_ids.split(',')), 3)
+
+        for fan_id in self.fan_ids[30:]:
+            self.record('like.added', fan_id, self.msg_id)
+        self.deliver()
+
+        found = notifications_for(self.author_id)
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0].count, 42)
+        self.assertEqual(compact(now=datetime.utcnow() + timedelta(hours=2)), 12)
+        self.assertEqual(NotificationGroup.query.one().count, 42)
+
+    def test_repeats_after_compaction(self):
+        """Is a re-like after its group was compacted left uncounted?"""
+        for fan_id in self.fan_ids[:5]:
+            self.record('like.added', fan_id, self.msg_id)
+        self.deliver()
+        compact(now=datetime.utcnow() + timedelta(hours=2))
+
+        for fan_id in self.fan_ids[:6]:
+            self.record('like.added', fan_id, self.msg_id)
+        self.assertEqual(self.deliver(), 1)
+
+        found = notifications_for(self.author_id)
+        self.assertEqual(found[0].count, 6)
+        compact(now=datetime.utcnow() + timedelta(hours=2))
+        self.assertEqual(NotificationGroup.query.one().count, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+"""Transactional outbox tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_outbox.py
+
+import os
+import unittest
+from datetime import datetime, timedelta
+from threading import Event
+
+from sqlalchemy import func, insert, select, update
+
+from models import db, User, Message, Follows, OutboxEvent, OutboxCheckpoint
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+import outbox
+
+
+class OutboxTestCase(unittest.TestCase):
+    """Test recording events with writes, and delivering them."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+        app_module.follow_graph = None
+
+        db.create_all()
+
+        author = User.signup(username="author",
+                             email="author@test.com",
+                             password="password",
+                             image_url=None)
+        fan = User.signup(username="fan",
+                          email="fan@test.com",
+                          password="password",
+                          image_url=None)
+        db.session.commit()
+        self.author_id = author.id
+        self.fan_id = fan.id
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def events(self):
+        return [(e.kind, e.user_id, e.target_id)
+                for e in OutboxEvent.query.order_by(OutboxEvent.id)]
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_writes_record_events(self):
+        """Does each kind of write leave its event in the outbox?"""
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "hello"})
+            msg_id = Message.query.one().id
+
+            self.login(c, self.fan_id)
+            c.post(f"/users/add_like/{msg_id}")
+            c.post(f"/users/un_like/{msg_id}")
+            c.post(f"/users/follow/{self.author_id}")
+            c.post(f"/users/stop-following/{self.author_id}")
+            c.post("/users/profile", data={"username": "fan2", "email": "fan@test.com",
+                                           "password": "password"})
+
+            self.login(c, self.author_id)
+            c.post(f"/messages/{msg_id}/delete")
+            c.post("/users/delete")
+
+        self.assertEqual(self.events(), [
+            ('message.created', self.author_id, msg_id),
+            ('like.added', self.fan_id, msg_id),
+            ('like.removed', self.fan_id, msg_id),
+            ('follow.added', self.fan_id, self.author_id),
+            ('follow.removed', self.fan_id, self.author_id),
+            ('user.updated', self.fan_id, None),
+            ('message.deleted', self.author_id, msg_id),
+            ('user.deleted', self.author_id, None),
+        ])
+
+    def test_rolled_back_write_records_nothing(self):
+        """Is an event only there if its change was committed?"""
+        outbox.record('user.updated', self.fan_id)
+        db.session.rollback()
+        self.assertEqual(self.events(), [])
+
+    def test_delivers_in_order_with_checkpoint(self):
+        """Does a consumer get each event once, in order, across batches?"""
+        outbox.record_many(('user.updated', user_id, None)
+                           for user_id in range(1, 8))
+        db.session.commit()
+
+        seen = []
+        consumers = {'log': lambda events: seen.extend(e.user_id for e in events)}
+        self.assertEqual(outbox.run_pending(consumers, batch_size=3), 7)
+        self.assertEqual(outbox.run_pending(consumers, batch_size=3), 0)
+        self.assertEqual(seen, list(range(1, 8)))
+        self.assertEqual(db.session.get(OutboxCheckpoint, 'log').position,
+                         OutboxEvent.query.order_by(OutboxEvent.id.desc()).first().id)
+
+    def test_failed_batch_is_redelivered(self):
+        """Does a consumer that raises get the same batch again?"""
+        outbox.record_many([('user.updated', 1, None), ('user.updated', 2, None)])
+        db.session.commit()
+
+        seen = []
+
+        def flaky(events):
+            seen.append([e.user_id for e in events])
+            if len(seen) == 1:
+                raise RuntimeError("downstream is down")
+
+        with self.assertRaises(RuntimeError):
+            outbox.run_pending({'flaky': flaky})
+        outbox.run_pending({'flaky': flaky})
+        self.assertEqual(seen, [[1, 2], [1, 2]])
+
+    def test_late_commit_delivered(self):
+        """Is an event whose transaction commits after later ones delivered
+        once it does, however long that takes?"""
+        outbox.record('user.updated', 1)
+        db.session.commit()
+
+        with db.engine.connect() as slow:
+            slow.execute(insert(OutboxEvent).values(kind='user.updated', user_id=2))
+            late_id = slow.scalar(select(func.max(OutboxEvent.id)))
+            outbox.record('user.updated', 3)
+            db.session.commit()
+
+            seen = []
+            consumers = {'log': lambda events: seen.extend(e.user_id for e in events)}
+            outbox.run_pending(consumers)
+            self.assertEqual(seen, [1, 3])
+            self.assertFalse(outbox.handled('log', late_id))
+
+            slow.commit()
+
+        outbox.run_pending(consumers)
+        self.assertEqual(seen, [1, 3, 2])
+        self.assertTrue(outbox.handled('log', late_id))
+        self.assertEqual(db.session.get(OutboxCheckpoint, 'log').gaps, '{}')
+
+    def test_rolled_back_gap_forgotten(self):
+        """Is a gap left by a rollback stopped being looked for?"""
+        outbox.record('user.updated', 1)
+        db.session.rollback()
+        outbox.record('user.updated', 2)
+        db.session.commit()
+
+        outbox.run_pending({'log': lambda events: None})
+        self.assertEqual(db.session.get(OutboxCheckpoint, 'log').gaps, '{}')
+
+    def test_prune_keeps_unhandled(self):
+        """Are only events every consumer has handled pruned?"""
+        outbox.record_many([('user.updated', 1, None), ('user.updated', 2, None)])
+        db.session.commit()
+        consumers = {'a': lambda events: None, 'b': lambda events: None}
+        later = datetime.utcnow() + outbox.KEEP + timedelta(days=1)
+
+        self.assertEqual(outbox.prune(consumers, now=later), 0)
+        outbox.run_pending(consumers)
+        self.assertEqual(outbox.prune(consumers, now=later), 2)
+
+    def test_runner_prunes(self):
+        """Does the runner prune handled events as it goes?"""
+        outbox.record_many([('user.updated', 1, None), ('user.updated', 2, None)])
+        db.session.execute(update(OutboxEvent).values(
+            created_at=datetime.utcnow() - outbox.KEEP - timedelta(days=1)))
+        db.session.commit()
+
+        stop = Event()
+        outbox.work(app, {'log': lambda events: stop.set()}, stop)
+        self.assertEqual(OutboxEvent.query.count(), 0)
+
+    def test_own_change_read_fresh(self):
+        """Does a user see their own change before the cache consumer has
+        handled it, while others see it once it has?"""
+        self.assertEqual(app_module.message_count(self.author_id), 0)
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "hello"})
+            self.assertIn(f'/users/{self.author_id}">1<',
+                          c.get(f"/users/{self.author_id}").get_data(as_text=True))
+        self.assertEqual(app_module.message_count(self.author_id), 0)
+
+        outbox.run_pending(app_module.OUTBOX_CONSUMERS)
+        self.assertEqual(app_module.message_count(self.author_id), 1)
+        with self.client as c:
+            c.get(f"/users/{self.author_id}")
+            with c.session_transaction() as sess:
+                self.assertNotIn(app_module.LAST_WRITE_KEY, sess)
+
+    def test_deleted_follower_leaves_cached_count(self):
+        """Does the cache consumer drop a deleted follower from counts?"""
+        Follows.add(self.fan_id, self.author_id)
+        db.session.commit()
+        self.assertEqual(app_module.follower_count(self.author_id), 1)
+
+        with self.client as c:
+            self.login(c, self.fan_id)
+            c.post("/users/delete")
+        self.assertEqual(app_module.follower_count(self.author_id), 1)
+
+        outbox.run_pending(app_module.OUTBOX_CONSUMERS)
+        self.assertEqual(app_module.follower_count(self.author_id), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+"""Ranked feed tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ranking.py
+
+import os
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from models import db, User, Message, Likes, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from ranking import ranked_feed, score, top_indices
+
+
+class ScoreTestCase(unittest.TestCase):
+    """Test the vectorized scoring on its own."""
+
+    def test_signals(self):
+        """Does each signal raise a warble over an otherwise equal one?"""
+        age = np.array([1.0, 1.0, 1.0, 1.0, 30.0])
+        likes = np.array([0.0, 10.0, 0.0, 0.0, 0.0])
+        affinity = np.array([0.0, 0.0, 0.5, 0.0, 0.0])
+        distance = np.array([1, 1, 1, 2, 1])
+
+        scores = score(age, likes, affinity, distance)
+        self.assertGreater(scores[1], scores[0])
+        self.assertGreater(scores[2], scores[0])
+        self.assertGreater(scores[0], scores[3])
+        self.assertGreater(scores[0], scores[4])
+
+    def test_top_indices(self):
+        """Are the best indices returned best first?"""
+        scores = np.array([0.1, 0.9, 0.5, 0.7, 0.3])
+        self.assertEqual(top_indices(scores, 3).tolist(), [1, 3, 2])
+        self.assertEqual(top_indices(scores, 10).tolist(), [1, 3, 2, 4, 0])
+
+
+class RankedFeedTestCase(unittest.TestCase):
+    """Test ranking warbles from the database and the ?feed=top page."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+        app_module.follow_graph = None
+
+        db.create_all()
+
+        self.ids = []
+        for name in ("viewer", "friend", "fan", "stranger"):
+            user = User.signup(username=name,
+                               email=f"{name}@test.com",
+                               password="password",
+                               image_url=None)
+            db.session.commit()
+            self.ids.append(user.id)
+        viewer, friend, fan, stranger = self.ids
+        Follows.add(viewer, friend)
+        db.session.commit()
+
+        now = datetime.utcnow()
+        self.newest = Message(text="newest, unloved", user_id=friend, timestamp=now)
+        self.popular = Message(text="older, popular", user_id=friend,
+                               timestamp=now - timedelta(hours=2))
+        self.stale = Message(text="too old", user_id=friend, timestamp=now - timedelta(days=5))
+        self.other = Message(text="not followed", user_id=stranger, timestamp=now)
+        db.session.add_all([self.newest, self.popular, self.stale, self.other])
+        db.session.commit()
+
+        for user_id in (viewer, fan, stranger):
+            Likes.add(user_id, self.popular.id)
+        db.session.commit()
+
+    def tearDown(self):
+        app_module.follow_graph = None
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_ranked_feed(self):
+        """Are liked warbles ranked up and stale or unfollowed ones left out?"""
+        viewer, friend, fan, stranger = self.ids
+        feed = ranked_feed(viewer, {friend})
+        self.assertEqual([msg.text for msg in feed], ["older, popular", "newest, unloved"])
+
+    def test_second_degree(self):
+        """Are second-degree accounts mixed in when given?"""
+        viewer, friend, fan, stranger = self.ids
+        feed = ranked_feed(viewer, {friend}, [stranger])
+        self.assertIn("not followed", [msg.text for msg in feed])
+
+    def test_top_feed_page(self):
+        """Does ?feed=top render the ranked order?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids[0]
+
+            html = c.get("/?feed=top").get_data(as_text=True)
+            self.assertLess(html.index("older, popular"), html.index("newest, unloved"))
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertLess(html.index("newest, unloved"), html.index("older, popular"))
+
+
+if __name__ == '__main__':
+    unittest.main()
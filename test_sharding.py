@@ -0,0 +1,340 @@
+"""Shard router tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+#
+# The router tests use throwaway SQLite files, one per shard, so no Postgres
+# is needed; the app tests put the main database on Postgres as usual.
+
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, select, func
+
+from sharding import ShardRouter, shard_messages, shard_likes
+from models import db, User, Message, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from archive import Archive
+from notifications import notifications_for
+import deletion
+import notifications
+import outbox
+
+
+def sqlite_router(tmpdir):
+    path = lambda name: os.path.join(tmpdir, name)
+    router = ShardRouter(
+        [create_engine(f"sqlite:///{path(f'shard{i}.db')}") for i in range(3)],
+        create_engine(f"sqlite:///{path('main.db')}"),
+        id_block=5,
+    )
+    router.create_all()
+    return router
+
+
+class ShardRouterTestCase(unittest.TestCase):
+    """Test routing, scatter-gather and resharding over 3 SQLite shards."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.router = sqlite_router(self.tmpdir.name)
+        self.now = datetime(2024, 1, 1)
+
+    def tearDown(self):
+        for engine in self.router.engines + [self.router.directory_engine]:
+            engine.dispose()
+        self.tmpdir.cleanup()
+
+    def count(self, shard, table, *where):
+        with self.router.engines[shard].connect() as conn:
+            return conn.execute(
+                select(func.count()).select_from(table).where(*where)).scalar()
+
+    def test_messages_go_to_author_shard(self):
+        """Is each message stored on its author's shard only?"""
+        for user_id in (1, 2, 3):
+            self.router.add_message(user_id, f"hi from {user_id}")
+
+        for user_id in (1, 2, 3):
+            shard = self.router.shard_for(user_id)
+            self.assertEqual(shard, user_id % 3)
+            self.assertEqual(self.count(shard, shard_messages), 1)
+
+    def test_message_ids_unique_across_shards(self):
+        """Are message ids unique even though shards are separate DBs?"""
+        ids = [self.router.add_message(user_id % 3, "x") for user_id in range(12)]
+        self.assertEqual(len(set(ids)), 12)
+
+    def test_timeline_merges_top_k(self):
+        """Does the scatter-gather timeline return the newest k overall?"""
+        for i in range(10):
+            for user_id in (1, 2, 3):
+                self.router.add_message(
+                    user_id, f"{user_id}-{i}",
+                    timestamp=self.now + timedelta(minutes=i * 3 + user_id))
+
+        rows = self.router.timeline([1, 2, 3], limit=4)
+        self.assertEqual([row.text for row in rows],
+                         ["3-9", "2-9", "1-9", "3-8"])
+
+    def test_likes_colocated_with_message(self):
+        """Are likes stored on the author's shard and found by the liker?"""
+        mid = self.router.add_message(2, "likeable")
+        self.router.add_like(1, 2, mid)
+        self.router.add_like(1, 2, mid)
+
+        self.assertEqual(self.count(2, shard_likes), 1)
+        self.assertEqual(self.router.liked_message_ids(1), {mid})
+
+        self.router.remove_like(1, 2, mid)
+        self.assertEqual(self.router.liked_message_ids(1), set())
+
+        for author_id in (0, 2):
+            self.router.add_like(1, author_id, self.router.add_message(author_id, "likeable"))
+        self.assertEqual(self.router.count_likes(1), 2)
+
+    def test_move_user(self):
+        """Does resharding move messages and likes and re-route the user?"""
+        mids = [self.router.add_message(1, f"m{i}",
+                                        timestamp=self.now + timedelta(minutes=i))
+                for i in range(7)]
+        self.router.add_like(2, 1, mids[0])
+
+        self.router.move_user(1, 0, chunk=3)
+
+        self.assertEqual(self.router.shard_for(1), 0)
+        self.assertEqual(self.count(1, shard_messages), 0)
+        self.assertEqual(self.count(1, shard_likes), 0)
+        self.assertEqual(self.count(0, shard_messages), 7)
+        self.assertEqual(self.router.liked_message_ids(2), {mids[0]})
+        self.assertEqual(self.router.user_messages(1, limit=1)[0].text, "m6")
+
+        # Running the move again is a no-op.
+        self.router.move_user(1, 0)
+        self.assertEqual(self.count(0, shard_messages), 7)
+
+    def test_move_keeps_warbles_posted_after_flip(self):
+        """Are warbles written to the new shard during a move's catch-up,
+        and only warbles deleted from the old shard, kept and dropped?"""
+        kept = self.router.add_message(1, "before", timestamp=self.now)
+        deleted = self.router.add_message(1, "deleted", timestamp=self.now)
+        real = self.router._copy_user
+        posted = []
+
+        def copy_user(user_id, source, dest, chunk):
+            if posted == []:
+                copied = real(user_id, source, dest, chunk)
+                # Deleted from the old shard before the directory flips...
+                self.router.delete_message(1, deleted)
+                posted.append(None)
+                return copied
+            # ...and posted to the new one right after it has.
+            posted.append(self.router.add_message(1, "after", timestamp=self.now))
+            return real(user_id, source, dest, chunk)
+
+        with patch.object(self.router, '_copy_user', side_effect=copy_user):
+            self.router.move_user(1, 0)
+
+        self.assertEqual(self.router.shard_for(1), 0)
+        self.assertEqual(sorted(row.id for row in self.router.user_messages(1)),
+                         sorted([kept, posted[1]]))
+
+    def test_write_racing_move_replayed(self):
+        """Is a write that looked up the old shard before a move finished
+        replayed on the new one, instead of being purged with the old?"""
+        mid = self.router.add_message(1, "popular")
+        self.router.move_user(1, 0)
+
+        # The like looked up shard 1 just before the directory flipped.
+        real = self.router.shard_for
+        lookups = iter([1])
+        with patch.object(self.router, 'shard_for',
+                          side_effect=lambda uid: next(lookups, None) or real(uid)):
+            self.router.add_like(2, 1, mid)
+
+        self.assertEqual(self.count(0, shard_likes), 1)
+        self.assertEqual(self.router.liked_message_ids(2), {mid})
+
+    def test_tombstones_hidden_and_moved(self):
+        """Are tombstoned messages hidden from reads, and still tombstoned
+        after a move?"""
+        kept = self.router.add_message(1, "kept", timestamp=self.now)
+        gone = self.router.add_message(1, "gone", timestamp=self.now + timedelta(minutes=1))
+        self.router.add_like(2, 1, gone)
+        self.router.tombstone_message(1, gone)
+
+        self.assertEqual([row.id for row in self.router.user_messages(1)], [kept])
+        self.assertEqual(self.router.liked_message_ids(2), set())
+
+        self.router.move_user(1, 2)
+        self.assertEqual([row.id for row in self.router.user_messages(1)], [kept])
+        self.assertEqual(self.count(2, shard_messages, shard_messages.c.deleted_at.isnot(None)), 1)
+
+    def test_timeline_pages(self):
+        """Do `before` and `after` keys page through the merged timeline?"""
+        for i in range(6):
+            self.router.add_message(1 + i % 3, f"m{i}", timestamp=self.now + timedelta(minutes=i))
+
+        first = self.router.timeline([1, 2, 3], limit=4)
+        rest = self.router.timeline([1, 2, 3], limit=4,
+                                    before=(first[-1].timestamp, first[-1].id))
+        self.assertEqual([row.text for row in first + rest],
+                         ["m5", "m4", "m3", "m2", "m1", "m0"])
+
+        newer = self.router.timeline([1, 2, 3], limit=2, after=(rest[0].timestamp, rest[0].id))
+        self.assertEqual([row.text for row in newer], ["m2", "m3"])
+
+
+class ShardedViewsTestCase(unittest.TestCase):
+    """Test that the routes read and write messages through the router."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+        app_module.follow_graph = None
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.router = sqlite_router(self.tmpdir.name)
+        app_module.shard_router = self.router
+        app.extensions['shard_router'] = self.router
+
+        db.create_all()
+        self.author = User.signup(username="author", email="author@test.com",
+                                  password="password", image_url=None)
+        self.fan = User.signup(username="fan", email="fan@test.com",
+                               password="password", image_url=None)
+        db.session.commit()
+        self.author_id = self.author.id
+        self.fan_id = self.fan.id
+
+    def tearDown(self):
+        app_module.shard_router = None
+        app.extensions['shard_router'] = None
+        for engine in self.router.engines + [self.router.directory_engine]:
+            engine.dispose()
+        self.tmpdir.cleanup()
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def shard_rows(self, table, *where):
+        with self.router.engines[self.router.shard_for(self.author_id)].connect() as conn:
+            return conn.execute(select(table).where(*where)).all()
+
+    def test_messages_written_and_read_through_router(self):
+        """Does a new warble land only on its author's shard, and are
+        profiles and the API read from there?"""
+        self.login(self.author_id)
+        self.client.post("/messages/new", data={"text": "sharded warble"})
+
+        (row,) = self.shard_rows(shard_messages)
+        self.assertEqual(row.text, "sharded warble")
+        self.assertEqual(Message.query.count(), 0)
+
+        self.router.add_message(self.author_id, "written straight to the shard")
+        self.assertIn("straight to the shard",
+                      self.client.get(f"/users/{self.author_id}").get_data(as_text=True))
+        resp = self.client.get(f"/api/v1/users/{self.author_id}/messages")
+        self.assertEqual([m['text'] for m in resp.get_json()['messages']],
+                         ["written straight to the shard", "sharded warble"])
+        self.assertIn("sharded warble",
+                      self.client.get(f"/messages/{row.id}").get_data(as_text=True))
+        self.assertEqual(self.client.get(f"/api/v1/messages/{row.id}").get_json()['messages'][0]['text'],
+                         "sharded warble")
+
+    def test_failed_commit_takes_message_back(self):
+        """Is a warble whose outbox event can't be committed taken off its
+        shard again?"""
+        self.login(self.author_id)
+        with patch.object(db.session, 'commit', side_effect=RuntimeError("database down")):
+            with self.assertRaises(RuntimeError):
+                self.client.post("/messages/new", data={"text": "never posted"})
+
+        self.assertEqual(self.shard_rows(shard_messages), [])
+
+    def test_likes_and_deletes_through_router(self):
+        """Are likes written only to the shard, and deletes tombstoned
+        there and then purged?"""
+        self.login(self.author_id)
+        self.client.post("/messages/new", data={"text": "soon gone"})
+        (row,) = self.shard_rows(shard_messages)
+        msg_id = row.id
+
+        self.login(self.fan_id)
+        self.client.post(f"/users/add_like/{msg_id}")
+        (like,) = self.shard_rows(shard_likes)
+        self.assertEqual((like.user_id, like.message_id), (self.fan_id, msg_id))
+        self.assertIsNotNone(like.timestamp)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertIn("soon gone",
+                      self.client.get(f"/users/{self.fan_id}/likes").get_data(as_text=True))
+        self.client.post(f"/users/un_like/{msg_id}")
+        self.assertEqual(self.shard_rows(shard_likes), [])
+
+        self.login(self.author_id)
+        self.client.post(f"/messages/{msg_id}/delete")
+        (row,) = self.shard_rows(shard_messages)
+        self.assertIsNotNone(row.deleted_at)
+        self.assertEqual(self.client.get(f"/api/v1/users/{self.author_id}/messages")
+                         .get_json()['messages'], [])
+
+        deletion.run_pending()
+        self.assertEqual(self.shard_rows(shard_messages), [])
+
+    def test_homepage_and_notifications_from_shards(self):
+        """Do the homepage (with a re-warble) and like notifications find
+        the warbles on the shards?"""
+        self.login(self.author_id)
+        self.client.post("/messages/new", data={"text": "worth sharing"})
+        (row,) = self.shard_rows(shard_messages)
+
+        self.login(self.fan_id)
+        self.client.post(f"/messages/{row.id}/rewarble")
+        self.client.post(f"/users/add_like/{row.id}")
+        page = self.client.get("/").get_data(as_text=True)
+        self.assertIn("worth sharing", page)
+        self.assertIn("Liked by fan", page)
+
+        outbox.run_pending({'notifications': notifications.from_outbox})
+        (found,) = notifications_for(self.author_id)
+        self.assertEqual((found.kind, found.message.id), ('like', row.id))
+
+    def test_archive_moves_shard_rows(self):
+        """Does archiving take old warbles off the shard, keeping their
+        likes, and are they still shown from the archive?"""
+        self.router.add_message(self.author_id, "long ago",
+                                timestamp=datetime.utcnow() - timedelta(days=400))
+        (row,) = self.shard_rows(shard_messages)
+        self.login(self.fan_id)
+        self.client.post(f"/users/add_like/{row.id}")
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(Archive(directory).archive_old(), 1)
+            self.assertEqual(Archive(directory).get(row.id).likes, 1)
+
+        self.assertEqual(self.shard_rows(shard_messages), [])
+        self.assertEqual(len(self.shard_rows(shard_likes)), 1)
+        self.assertEqual(self.router.count_likes(self.fan_id), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+"""Trending terms tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+import os
+import unittest
+from datetime import datetime, timedelta
+
+from models import db, User, Message, OutboxEvent
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from trending import CountMinSketch, TopK, Trending, terms
+import outbox
+
+NOW = datetime(2024, 5, 1, 12, 0)
+
+
+class SketchTestCase(unittest.TestCase):
+    """Test the sketch, the heap and the windows on their own."""
+
+    def test_terms(self):
+        """Are hashtags kept whole and stopwords dropped?"""
+        self.assertEqual(terms("Loving the #Flask talk at PyCon"),
+                         {"#flask", "loving", "talk", "pycon"})
+
+    def test_count_min_never_undercounts(self):
+        """Are estimates at least the true counts, even in a tiny table?"""
+        sketch = CountMinSketch(width=16, depth=3)
+        truth = {f"term{i}": i % 7 + 1 for i in range(100)}
+        for term, count in truth.items():
+            sketch.add(term, count)
+        for term, count in truth.items():
+            self.assertGreaterEqual(sketch.estimate(term), count)
+
+    def test_top_k_keeps_heaviest(self):
+        """Does the heap keep the k highest estimates?"""
+        top = TopK(k=3)
+        for term, estimate in [("a", 1), ("b", 5), ("c", 2), ("d", 9), ("a", 7), ("e", 3)]:
+            top.offer(term, estimate)
+        self.assertEqual(top.counts, {"a": 7, "b": 5, "d": 9})
+
+    def test_windows_slide(self):
+        """Do old buckets fall out of the hour but stay in the day?"""
+        trending = Trending()
+        for i in range(3):
+            trending.record("#launch day", NOW - timedelta(hours=2))
+        trending.record("#lunch", NOW - timedelta(minutes=10))
+        trending.record("#lunch again", NOW)
+
+        self.assertEqual(trending.top("hour", now=NOW), [("#lunch", 2), ("again", 1)])
+        self.assertEqual(trending.top("day", now=NOW)[:2], [("#launch", 3), ("day", 3)])
+        self.assertEqual(trending.top("day", now=NOW + timedelta(days=2)), [])
+
+
+class TrendingViewTestCase(unittest.TestCase):
+    """Test recording, backfill and the homepage panel."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+        app_module.trending = Trending()
+
+        db.create_all()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testpassword",
+                                    image_url=None)
+        db.session.commit()
+        self.user_id = self.testuser.id
+
+    def tearDown(self):
+        app_module.trending = Trending()
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_backfill(self):
+        """Are recent visible warbles counted, and old or deleted ones not?"""
+        now = datetime.utcnow()
+        db.session.add_all([
+            Message(text="#warbler rocks", user_id=self.user_id, timestamp=now),
+            Message(text="#warbler again", user_id=self.user_id, timestamp=now),
+            Message(text="#ancient", user_id=self.user_id, timestamp=now - timedelta(days=3)),
+            Message(text="#hidden", user_id=self.user_id, timestamp=now, deleted_at=now),
+        ])
+        db.session.commit()
+
+        trending = Trending()
+        self.assertEqual(trending.backfill(), 2)
+        self.assertEqual(trending.top("hour")[0], ("#warbler", 2))
+        self.assertNotIn("#ancient", dict(trending.top("day")))
+
+    def post(self, text):
+        """Post a warble the way messages_add does."""
+        msg = Message(text=text, user_id=self.user_id, timestamp=datetime.utcnow())
+        db.session.add(msg)
+        db.session.flush()
+        outbox.record('message.created', self.user_id, msg.id)
+        db.session.commit()
+        return msg
+
+    def test_catch_up(self):
+        """Are warbles posted by other processes counted, and each once?"""
+        trending = Trending()
+        trending.backfill()
+        mine = self.post("Mine #warbler")
+        trending.record(mine.text, mine.timestamp, mine.id)
+
+        self.post("Theirs #warbler")
+
+        self.assertEqual(trending.catch_up(), 1)
+        self.assertEqual(trending.catch_up(), 0)
+        self.assertEqual(trending.top("hour")[0], ("#warbler", 2))
+
+    def test_catch_up_late_commit(self):
+        """Is a warble whose transaction commits after a later one's still
+        counted, however long it took?"""
+        trending = Trending()
+        trending.backfill()
+
+        with db.engine.connect() as slow:
+            msg_id = slow.execute(db.insert(Message).values(
+                text="Slow #warbler", user_id=self.user_id,
+                timestamp=datetime.utcnow()).returning(Message.id)).scalar()
+            slow.execute(db.insert(OutboxEvent).values(
+                kind='message.created', user_id=self.user_id, target_id=msg_id))
+
+            self.post("Quick #warbler")
+            self.assertEqual(trending.catch_up(), 1)
+            slow.commit()
+
+        self.assertEqual(trending.catch_up(), 1)
+        self.assertEqual(trending.top("hour")[0], ("#warbler", 2))
+        self.assertEqual(len(trending._tail.gaps), 0)
+
+    def test_deleted_taken_out(self):
+        """Are deleted warbles and accounts taken back out of the counts?"""
+        trending = Trending()
+        trending.backfill()
+        first = self.post("#warbler one")
+        self.post("#warbler two")
+        self.assertEqual(trending.catch_up(), 2)
+        self.assertEqual(trending.top("hour")[0], ("#warbler", 2))
+
+        first.deleted_at = datetime.utcnow()
+        outbox.record('message.deleted', self.user_id, first.id)
+        db.session.commit()
+        trending.catch_up()
+        self.assertEqual(trending.top("hour")[0], ("#warbler", 1))
+
+        outbox.record('user.deleted', self.user_id)
+        db.session.commit()
+        trending.catch_up()
+        self.assertEqual(trending.top("hour"), [])
+
+    def test_panel_reads_no_messages(self):
+        """Does a posted hashtag trend from recorded state, not the table?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post("/messages/new", data={"text": "Hello #warbler"})
+            app_module.trending.catch_up()
+            db.session.execute(db.delete(Message))
+            db.session.commit()
+
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertNotIn("Hello #warbler", html)
+        self.assertIn("Trending", html)
+        self.assertIn("#warbler", html)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,12 @@
 import os
+import re
 import unittest
-from flask import session
-from models import db, connect_db, User, Message
+from unittest.mock import patch
+from datetime import datetime
+from sqlalchemy import event
+from flask import session, g
+from models import db, connect_db, User, Message, Likes, Follows
+import app as app_module
 from app import app, CURR_USER_KEY
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
@@ -22,6 +27,8 @@ class UserViewsTestCase(unittest.TestCase):
         self.client = app.test_client()
         self.app_context = app.app_context()
         self.app_context.push()
+        app_module.cache.clear()
+        app_module.follow_graph = None
        
         db.session.rollback()
        
@@ -92,6 +99,104 @@ class UserViewsTestCase(unittest.TestCase):
             self.assertIn("Access unauthorized", str(resp.data))
 
     
+    def test_follow_twice_and_unfollow(self):
+        """Are follow/unfollow idempotent (double-clicks don't error)?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            for _ in range(2):
+                resp = c.post(f"/users/follow/{self.testuser2.id}")
+                self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.count(), 1)
+
+            for _ in range(2):
+                resp = c.post(f"/users/stop-following/{self.testuser2.id}")
+                self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.count(), 0)
+
+
+    def test_like_twice_and_unlike(self):
+        """Are like/unlike idempotent (double-clicks don't error)?"""
+        msg = Message(text="likeable", user_id=self.testuser2.id)
+        db.session.add(msg)
+        Follows.add(self.testuser1.id, self.testuser2.id)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            for _ in range(2):
+                resp = c.post(f"/users/add_like/{msg.id}")
+                self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Likes.query.filter_by(message_id=msg.id).count(), 1)
+
+            resp = c.get("/")
+            self.assertIn("Unlike", resp.get_data(as_text=True))
+
+            for _ in range(2):
+                resp = c.post(f"/users/un_like/{msg.id}")
+                self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Likes.query.count(), 0)
+
+
+    def test_like_own_message(self):
+        """Is a user prevented from liking their own warble?"""
+        msg = Message(text="mine", user_id=self.testuser1.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            resp = c.post(f"/users/add_like/{msg.id}", follow_redirects=True)
+            self.assertIn("You cannot like your own warbles!", resp.get_data(as_text=True))
+            self.assertEqual(Likes.query.count(), 0)
+
+
+    def test_homepage_like_summaries_batched(self):
+        """Does the homepage cost the same queries however many likes?"""
+        Follows.add(self.testuser1.id, self.testuser2.id)
+        msgs = [Message(text=f"warble {i}", user_id=self.testuser2.id) for i in range(5)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        msg_ids = [msg.id for msg in msgs]
+
+        statements = []
+        def count(*args):
+            statements.append(args)
+
+        def measure():
+            # Tests share one app context (and so one session and `g`) with
+            # the requests; reset both (and the cache) so every request starts cold.
+            db.session.expunge_all()
+            g.pop("following_ids", None)
+            app_module.cache.clear()
+            del statements[:]
+            html = c.get("/").get_data(as_text=True)
+            return len(statements), html
+
+        event.listen(db.engine, "before_cursor_execute", count)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            without_likes, _ = measure()
+
+            for msg_id in msg_ids:
+                Likes.add(self.testuser1.id, msg_id)
+            db.session.commit()
+
+            with_likes, html = measure()
+            event.remove(db.engine, "before_cursor_execute", count)
+
+            self.assertIn("Liked by testuser1", html)
+            self.assertEqual(with_likes, without_likes)
+
+
     def test_add_message_logged_in_user(self):
         """Can a logged-in user add a message?"""
         with self.client as c:
@@ -115,9 +220,83 @@ class UserViewsTestCase(unittest.TestCase):
             self.assertIn("Access unauthorized", str(resp.data))
 
 
+    def test_follow_lists_streamed(self):
+        """Are follower/following pages streamed, without deleted users?"""
+        gone = User.signup(username="gone", email="gone@test.com",
+                           password="gonepassword", image_url=None)
+        db.session.commit()
+        Follows.add(self.testuser2.id, self.testuser1.id)
+        Follows.add(gone.id, self.testuser1.id)
+        Follows.add(self.testuser1.id, self.testuser2.id)
+        gone.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        # Outside a `with` block, so the client doesn't hold the request
+        # contexts open and the page really streams.
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser1.id
 
+        resp = self.client.get(f"/users/{self.testuser1.id}/followers")
+        self.assertTrue(resp.is_streamed)
+        html = resp.get_data(as_text=True)
+        self.assertIn("@testuser2", html)
+        self.assertNotIn("@gone", html)
 
+        html = self.client.get(f"/users/{self.testuser1.id}/following").get_data(as_text=True)
+        self.assertIn("@testuser2", html)
 
-    
 
-    
\ No newline at end of file
+    def test_liked_warbles_streamed(self):
+        """Does the liked warbles page stream the liked messages?"""
+        msg = Message(text="likeable", user_id=self.testuser2.id)
+        db.session.add(msg)
+        db.session.commit()
+        Likes.add(self.testuser1.id, msg.id)
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{self.testuser1.id}/likes")
+        self.assertTrue(resp.is_streamed)
+        html = resp.get_data(as_text=True)
+        self.assertIn("likeable", html)
+        self.assertIn("@testuser2", html)
+
+    def test_liked_warbles_paginated(self):
+        """Is the liked page newest like first, in pages that follow each
+        other without gaps, each loaded in one query?"""
+        msgs = [Message(text=f"liked number {n}", user_id=self.testuser2.id)
+                for n in range(5)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        # Liked in the reverse of the order they were written.
+        liked_at = datetime(2024, 1, 1)
+        db.session.execute(db.insert(Likes), [
+            dict(user_id=self.testuser1.id, message_id=msg.id,
+                 timestamp=liked_at.replace(minute=5 - n))
+            for n, msg in enumerate(msgs)
+        ])
+        db.session.commit()
+
+        statements = []
+        def count(*args):
+            statements.append(args)
+
+        seen = []
+        url = f"/users/{self.testuser1.id}/likes"
+        pages = 0
+        while url:
+            event.listen(db.engine, "before_cursor_execute", count)
+            with patch.object(app_module, 'LIKES_PAGE', 2):
+                html = self.client.get(url).get_data(as_text=True)
+            event.remove(db.engine, "before_cursor_execute", count)
+            seen += [n for n in range(5) if f"liked number {n}" in html]
+            pages += 1
+            older = re.search(r'href="(/users/\d+/likes\?cursor=[^"]+)"', html)
+            url = older and older.group(1)
+
+        self.assertEqual(seen, [0, 1, 2, 3, 4])
+        self.assertEqual(pages, 3)
+        # The user, then the page with its authors.
+        self.assertLessEqual(len(statements), 2 * pages)
+
+        resp = self.client.get(f"/users/{self.testuser1.id}/likes?cursor=nonsense")
+        self.assertEqual(resp.status_code, 302)
@@ -0,0 +1,139 @@
+"""Unique view count tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_views.py
+
+import os
+import unittest
+
+import numpy as np
+
+from models import db, User, Message, MessageViews
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from views import (MEMORY_BUDGET, REGISTERS, ViewCounter, empty, estimate,
+                   register_for)
+
+
+def sketch_of(viewer_ids):
+    registers = empty()
+    for viewer_id in viewer_ids:
+        index, rank = register_for(viewer_id)
+        registers[index] = max(registers[index], rank)
+    return registers
+
+
+class HyperLogLogTestCase(unittest.TestCase):
+    """Test the sketch's accuracy, size and merging."""
+
+    def test_error_bounds(self):
+        """Are estimates within 3 standard errors across magnitudes?"""
+        bound = 3 * 1.04 / np.sqrt(REGISTERS)
+        for n in (1, 10, 100, 1000, 10000, 100000):
+            got = int(estimate(sketch_of(range(n))))
+            self.assertLessEqual(abs(got - n), max(1, bound * n), f"{n} viewers: {got}")
+
+    def test_repeat_views_dont_count(self):
+        """Does seeing a message again leave the count alone?"""
+        once = sketch_of(range(500))
+        twice = sketch_of(list(range(500)) * 2)
+        self.assertTrue((once == twice).all())
+
+    def test_merge_equals_union(self):
+        """Is merging two workers' sketches the sketch of all their viewers?"""
+        merged = np.maximum(sketch_of(range(0, 3000)), sketch_of(range(2000, 5000)))
+        self.assertTrue((merged == sketch_of(range(5000))).all())
+
+    def test_memory_budget(self):
+        """Does a message's sketch fit its memory budget?"""
+        self.assertLessEqual(empty().nbytes, MEMORY_BUDGET)
+
+
+class ViewCounterTestCase(unittest.TestCase):
+    """Test recording, flushing and showing view counts."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+        app_module.view_counter = ViewCounter(app)
+
+        db.create_all()
+
+        self.author = User.signup(username="author",
+                                  email="author@test.com",
+                                  password="password",
+                                  image_url=None)
+        self.viewer = User.signup(username="viewer",
+                                  email="viewer@test.com",
+                                  password="password",
+                                  image_url=None)
+        db.session.commit()
+        self.author_id = self.author.id
+        self.viewer_id = self.viewer.id
+
+        msg = Message(text="look at me", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        app_module.view_counter = ViewCounter(app)
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_workers_merge_on_flush(self):
+        """Do two workers' flushes add up, with repeat viewers counted once?"""
+        worker1, worker2 = ViewCounter(app), ViewCounter(app)
+        for viewer_id in range(300):
+            worker1.record(viewer_id, [self.msg_id])
+        for viewer_id in range(200, 500):
+            worker2.record(viewer_id, [self.msg_id])
+
+        self.assertEqual(worker1.flush(), 1)
+        self.assertEqual(worker2.flush(), 1)
+        self.assertEqual(worker2.flush(), 0)
+
+        row = db.session.get(MessageViews, self.msg_id)
+        self.assertEqual(len(row.registers), REGISTERS)
+        seen = ViewCounter(app).seen_by([self.msg_id])[self.msg_id]
+        self.assertAlmostEqual(seen, 500, delta=50)
+
+    def test_flush_skips_deleted_messages(self):
+        """Are views of since-purged messages dropped, not errors?"""
+        counter = ViewCounter(app)
+        counter.record(self.viewer_id, [self.msg_id, self.msg_id + 1000])
+        self.assertEqual(counter.flush(), 1)
+
+    def test_message_page_counts_viewers(self):
+        """Does viewing a warble count once per person, and not its author?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+            html = c.get(f"/messages/{self.msg_id}").get_data(as_text=True)
+            self.assertNotIn("Seen by", html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+            c.get(f"/messages/{self.msg_id}")
+            html = c.get(f"/messages/{self.msg_id}").get_data(as_text=True)
+            self.assertIn("Seen by 1 person", html)
+
+        app_module.view_counter.flush()
+        html = self.client.get(f"/users/{self.author_id}").get_data(as_text=True)
+        self.assertIn("Seen by 1 person", html)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+"""Write-behind edge buffer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_writebehind.py
+
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+from models import db, User, Message, Likes, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from cache import LocalTier
+from writebehind import EdgeBuffer, SharedOverlay
+
+
+class EdgeBufferTestCase(unittest.TestCase):
+    """Test buffering, coalescing, recovery and read-your-writes."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app_module.cache.clear()
+
+        db.create_all()
+
+        self.testuser1 = User.signup(username="testuser1",
+                                     email="test1@test.com",
+                                     password="test1password",
+                                     image_url=None)
+        self.testuser2 = User.signup(username="testuser2",
+                                     email="test2@test.com",
+                                     password="test2password",
+                                     image_url=None)
+        db.session.commit()
+
+        self.msg = Message(text="popular warble", user_id=self.testuser2.id)
+        db.session.add(self.msg)
+        db.session.commit()
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.tmpdir.name, "edges.log")
+
+    def tearDown(self):
+        app_module.edge_buffer = None
+        self.tmpdir.cleanup()
+        db.session.rollback()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_flip_flops_coalesce(self):
+        """Does like/unlike/like in one batch flush as a single like?"""
+        buffer = EdgeBuffer(app, self.log_path)
+        for op in ("add", "remove", "add"):
+            buffer.submit("like", op, self.testuser1.id, self.msg.id)
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(buffer.overlay("like", self.testuser1.id), {self.msg.id: "add"})
+
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(buffer.overlay("like", self.testuser1.id), {})
+
+    def test_recovers_after_crash(self):
+        """Are acknowledged edges still flushed after a restart?"""
+        buffer = EdgeBuffer(app, self.log_path)
+        buffer.submit("follow", "add", self.testuser1.id, self.testuser2.id)
+        buffer._log.close()
+
+        restarted = EdgeBuffer(app, self.log_path)
+        self.assertEqual(restarted.overlay("follow", self.testuser1.id),
+                         {self.testuser2.id: "add"})
+        restarted.flush()
+
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertFalse(os.path.exists(self.log_path + ".flushing"))
+
+    def test_refused_change_set_aside(self):
+        """Does a change the database refuses get set aside, instead of
+        failing its whole batch on every retry?"""
+        buffer = EdgeBuffer(app, self.log_path)
+        buffer.submit("follow", "add", self.testuser1.id, self.testuser2.id)
+        buffer.submit("follow", "add", self.testuser1.id, self.testuser2.id + 1000)
+
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertFalse(os.path.exists(self.log_path + ".flushing"))
+        with open(self.log_path + ".rejected") as rejected:
+            self.assertIn(str(self.testuser2.id + 1000), rejected.read())
+        self.assertEqual(buffer.flush(), 0)
+
+    def test_like_of_purged_message_dropped(self):
+        """Is a like of a message that's gone by the flush left out?"""
+        buffer = EdgeBuffer(app, self.log_path)
+        buffer.submit("like", "add", self.testuser1.id, self.msg.id)
+        buffer.submit("like", "add", self.testuser1.id, self.msg.id + 1000)
+
+        buffer.flush()
+        self.assertEqual([like.message_id for like in Likes.query], [self.msg.id])
+
+    def test_adopts_dead_process_logs(self):
+        """Does a new process take over the log of one that's gone, and
+        leave a live process's log alone?"""
+        base = os.path.join(self.tmpdir.name, "edges")
+        dead = EdgeBuffer(app, f"{base}.999999999")
+        dead.submit("follow", "add", self.testuser1.id, self.testuser2.id)
+        dead._log.close()
+        live = EdgeBuffer(app, f"{base}.1")
+        live.submit("like", "add", self.testuser1.id, self.msg.id)
+
+        buffer = EdgeBuffer.for_process(app, base)
+        self.assertEqual(buffer.log_path, f"{base}.{os.getpid()}")
+        self.assertEqual(buffer.overlay("follow", self.testuser1.id),
+                         {self.testuser2.id: "add"})
+        self.assertEqual(buffer.overlay("like", self.testuser1.id), {})
+        self.assertFalse(os.path.exists(f"{base}.999999999"))
+        self.assertTrue(os.path.exists(f"{base}.1"))
+
+        buffer.flush()
+        self.assertEqual(Follows.query.count(), 1)
+        live._log.close()
+
+    def test_other_workers_see_pending(self):
+        """Does a worker that didn't buffer an edge still show it until
+        it's flushed?"""
+        tier = LocalTier()
+        worker1 = EdgeBuffer(app, self.log_path, shared=SharedOverlay(tier))
+        worker2 = EdgeBuffer(app, self.log_path + ".2", shared=SharedOverlay(tier))
+        worker1.submit("like", "add", self.testuser1.id, self.msg.id)
+        worker1.submit("follow", "add", self.testuser1.id, self.testuser2.id)
+
+        self.assertEqual(worker2.overlay("like", self.testuser1.id), {self.msg.id: "add"})
+        self.assertEqual(worker2.overlay("follow", self.testuser1.id),
+                         {self.testuser2.id: "add"})
+
+        worker2.submit("like", "remove", self.testuser1.id, self.msg.id)
+        self.assertEqual(worker1.overlay("like", self.testuser1.id), {self.msg.id: "remove"})
+
+        # worker1's flush doesn't clear the newer change worker2 buffered.
+        worker1.flush()
+        self.assertEqual(worker2.overlay("follow", self.testuser1.id), {})
+        self.assertEqual(worker1.overlay("like", self.testuser1.id), {self.msg.id: "remove"})
+        worker2.flush()
+        self.assertEqual(worker1.overlay("like", self.testuser1.id), {})
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_like_timed_when_buffered(self):
+        """Does a like get the time it was made, not the time it's flushed?"""
+        buffer = EdgeBuffer(app, self.log_path)
+        before = datetime.utcnow()
+        buffer.submit("like", "add", self.testuser1.id, self.msg.id)
+        time.sleep(0.05)
+        flushed = datetime.utcnow()
+        buffer.flush()
+
+        like = Likes.query.one()
+        self.assertGreaterEqual(like.timestamp, before.replace(microsecond=0))
+        self.assertLess(like.timestamp, flushed)
+
+    def test_routes_read_own_pending_writes(self):
+        """Do a user's pages reflect their edges before they're flushed?"""
+        buffer = app_module.edge_buffer = EdgeBuffer(app, self.log_path)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            c.post(f"/users/follow/{self.testuser2.id}")
+            c.post(f"/users/add_like/{self.msg.id}")
+            self.assertEqual(Follows.query.count(), 0)
+            self.assertEqual(Likes.query.count(), 0)
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("popular warble", html)
+            self.assertIn("Unlike", html)
+
+            buffer.flush()
+            self.assertEqual(Follows.query.count(), 1)
+            self.assertEqual(Likes.query.count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
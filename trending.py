@@ -0,0 +1,369 @@
+"""Trending hashtags and terms over the last hour and day.
+
+Counting every term ever posted would grow without bound, so each window is
+a fixed ring of time buckets (5 minutes x 12 for the hour, 1 hour x 24 for
+the day), and each bucket holds:
+
+- a count-min sketch: a small depth x width table of counters. A term bumps
+  one counter per row (picked by hashing); its count is estimated as the
+  smallest of those counters, which can only overcount, and only by a
+  little when the table is wide enough.
+- a top-k min-heap of the terms with the highest estimates in the bucket,
+  the only terms the bucket remembers by name.
+
+When time moves on, the oldest bucket's slot is cleared and reused, so the
+whole thing is a couple of MB however much is posted. Ranking a window sums
+its live buckets' sketches and re-estimates the union of their top-k terms.
+
+Nothing reads the messages table at request time. Each process keeps its
+own windows, so to count every warble (not just those its own requests
+posted) a background thread in each process (`start_sync`, every
+TRENDING_SYNC seconds) first backfills from ``messages.timestamp`` and then
+tails the outbox from there (an ``outbox.Tail``, which only reads past its
+high-water id and the gaps below it). New warbles are read by id and
+counted, and ids already counted are skipped. Deleted warbles and accounts are
+taken back out: the terms of each counted warble are kept (until it's
+older than the longest window) to subtract.
+
+The backfill can also be run by hand to check the numbers:
+
+    python trending.py backfill
+"""
+
+import hashlib
+import heapq
+import re
+import sys
+from datetime import datetime, timedelta, timezone
+from threading import Event, Lock, Thread
+
+import numpy as np
+
+import sharding
+from models import db, Message, User
+from outbox import Tail
+
+WIDTH = 2048
+DEPTH = 4
+TOP_K = 50
+
+# name: (bucket seconds, buckets)
+WINDOWS = {
+    'hour': (300, 12),
+    'day': (3600, 24),
+}
+
+HASHTAG = re.compile(r'#(\w+)')
+WORD = re.compile(r"[a-z][a-z']{2,}")
+STOPWORDS = frozenset("""
+    the and for are but not you all any can had her was one our out has him
+    his how its may new now old see two who did get got let say she too use
+    this that with have from they will your what when were been than them
+    then into just like some could would there their about which these those
+    other after being doing very more most only also over such even here
+""".split())
+
+
+def terms(text):
+    """The set of hashtags (with their '#') and words in `text`."""
+
+    tags = {f"#{tag.lower()}" for tag in HASHTAG.findall(text)}
+    words = set(WORD.findall(HASHTAG.sub(' ', text.lower()))) - STOPWORDS
+    return tags | words
+
+
+def epoch(timestamp):
+    """Seconds since the epoch of a naive UTC datetime."""
+
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+
+class CountMinSketch:
+    """Approximate counts of strings in a fixed depth x width table."""
+
+    def __init__(self, width=WIDTH, depth=DEPTH):
+        self.width = width
+        self.table = np.zeros((depth, width), dtype=np.int32)
+        self.rows = np.arange(depth)
+
+    def _columns(self, term):
+        digest = hashlib.blake2b(term.encode(), digest_size=8).digest()
+        h1 = int.from_bytes(digest[:4], 'little')
+        h2 = int.from_bytes(digest[4:], 'little') | 1
+        return (h1 + self.rows * h2) % self.width
+
+    def add(self, term, count=1):
+        """Count `term`; returns its new estimate."""
+
+        columns = self._columns(term)
+        self.table[self.rows, columns] += count
+        return int(self.table[self.rows, columns].min())
+
+    def estimate(self, term, table=None):
+        table = self.table if table is None else table
+        return int(table[self.rows, self._columns(term)].min())
+
+    def clear(self):
+        self.table.fill(0)
+
+
+class TopK:
+    """The `k` terms with the highest estimates offered (a min-heap).
+
+    Updated estimates are pushed as new heap entries; stale ones are skipped
+    when they surface and swept out if the heap grows too long.
+    """
+
+    def __init__(self, k=TOP_K):
+        self.k = k
+        self.counts = {}
+        self.heap = []
+
+    def offer(self, term, estimate):
+        if term in self.counts or len(self.counts) < self.k:
+            self.counts[term] = estimate
+            heapq.heappush(self.heap, (estimate, term))
+            if len(self.heap) > 4 * self.k:
+                self.heap = [(count, t) for t, count in self.counts.items()]
+                heapq.heapify(self.heap)
+            return
+
+        while self.counts.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        smallest, evicted = self.heap[0]
+        if estimate > smallest:
+            heapq.heapreplace(self.heap, (estimate, term))
+            del self.counts[evicted]
+            self.counts[term] = estimate
+
+    def lower(self, term, estimate):
+        """Take `term`'s estimate down to `estimate`, if it's kept."""
+
+        if term in self.counts:
+            self.counts[term] = estimate
+            heapq.heappush(self.heap, (estimate, term))
+
+    def clear(self):
+        self.counts.clear()
+        self.heap.clear()
+
+
+class Window:
+    """Counts over the last `buckets` x `bucket_seconds`, in a fixed ring."""
+
+    def __init__(self, bucket_seconds, buckets, width=WIDTH, depth=DEPTH, k=TOP_K):
+        self.bucket_seconds = bucket_seconds
+        self.numbers = [None] * buckets
+        self.sketches = [CountMinSketch(width, depth) for _ in range(buckets)]
+        self.tops = [TopK(k) for _ in range(buckets)]
+
+    def _live(self, number):
+        return [slot for slot, n in enumerate(self.numbers)
+                if n is not None and number - len(self.numbers) < n <= number]
+
+    def add(self, words, when):
+        number = int(when // self.bucket_seconds)
+        slot = number % len(self.numbers)
+        if self.numbers[slot] != number:
+            if self.numbers[slot] is not None and self.numbers[slot] > number:
+                return  # older than the window
+            self.numbers[slot] = number
+            self.sketches[slot].clear()
+            self.tops[slot].clear()
+
+        for word in words:
+            self.tops[slot].offer(word, self.sketches[slot].add(word))
+
+    def remove(self, words, when):
+        """Take back an `add` of `words` at `when`, if its bucket is live."""
+
+        number = int(when // self.bucket_seconds)
+        slot = number % len(self.numbers)
+        if self.numbers[slot] != number:
+            return
+        for word in words:
+            self.tops[slot].lower(word, self.sketches[slot].add(word, -1))
+
+    def top(self, now, n):
+        """[(term, estimated count)] of the `n` commonest terms, most first."""
+
+        live = self._live(int(now // self.bucket_seconds))
+        if not live:
+            return []
+
+        table = sum(self.sketches[slot].table for slot in live)
+        sketch = self.sketches[live[0]]
+        candidates = set().union(*(self.tops[slot].counts for slot in live))
+        estimates = ((term, sketch.estimate(term, table)) for term in candidates)
+        return heapq.nsmallest(
+            n, (item for item in estimates if item[1] > 0),
+            key=lambda item: (-item[1], item[0]))
+
+
+class Trending:
+    """Trending terms over each of WINDOWS."""
+
+    def __init__(self, windows=WINDOWS):
+        self.windows = {name: Window(*shape) for name, shape in windows.items()}
+        self.longest = max(seconds * buckets for seconds, buckets in windows.values())
+        self._lock = Lock()
+        # message id -> (user id, when, terms) of each warble counted
+        self._counted = {}
+        self._tail = Tail()
+
+    def record(self, text, timestamp, message_id=None, user_id=None):
+        """Count a warble posted at `timestamp` (naive UTC), unless
+        `message_id` was counted already. Returns whether it was."""
+
+        words = terms(text)
+        when = epoch(timestamp)
+        with self._lock:
+            if message_id is not None:
+                if message_id in self._counted:
+                    return False
+                self._counted[message_id] = (user_id, when, words)
+            for window in self.windows.values():
+                window.add(words, when)
+        return True
+
+    def discard(self, message_id):
+        """Take a counted warble back out. Returns whether it was counted."""
+
+        with self._lock:
+            counted = self._counted.pop(message_id, None)
+            if counted is None:
+                return False
+            _, when, words = counted
+            for window in self.windows.values():
+                window.remove(words, when)
+        return True
+
+    def discard_user(self, user_id):
+        """Take all of `user_id`'s counted warbles back out."""
+
+        with self._lock:
+            message_ids = [message_id for message_id, (author_id, _, _) in self._counted.items()
+                           if author_id == user_id]
+        for message_id in message_ids:
+            self.discard(message_id)
+
+    def top(self, window, n=10, now=None):
+        """[(term, count)] trending in `window` ('hour' or 'day')."""
+
+        now = epoch(now or datetime.utcnow())
+        with self._lock:
+            return self.windows[window].top(now, n)
+
+    def _visible(self, where, chunk, since=None, ids=None):
+        """(id, text, timestamp, user_id) of the visible warbles posted
+        after `since` or among `ids`, oldest first; `where` says the same
+        for the main database."""
+
+        router = sharding.current_router()
+        if router is None:
+            return db.session.execute(
+                db.select(Message.id, Message.text, Message.timestamp, Message.user_id)
+                .join(User, User.id == Message.user_id)
+                .where(*where,
+                       Message.deleted_at.is_(None),
+                       User.deleted_at.is_(None))
+                .order_by(Message.timestamp)
+                .execution_options(yield_per=chunk))
+
+        excluded = sharding.deleted_user_ids()
+        if since is not None:
+            rows = router.messages_since(since, chunk, excluded)
+        else:
+            rows = sorted((row for row in router.messages(ids).values()
+                           if row.user_id not in excluded),
+                          key=lambda row: (row.timestamp, row.id))
+        return ((row.id, row.text, row.timestamp, row.user_id) for row in rows)
+
+    def backfill(self, now=None, chunk=1000):
+        """Count visible warbles from the longest window (in app context).
+
+        Returns how many were counted.
+        """
+
+        now = now or datetime.utcnow()
+        # Tail from before the read, so nothing posted meanwhile is missed.
+        self._tail.start()
+        counted = 0
+        since = now - timedelta(seconds=self.longest)
+        for message_id, text, timestamp, user_id in self._visible(
+                [Message.timestamp > since], chunk, since=since):
+            counted += self.record(text, timestamp, message_id, user_id)
+        self._forget(now)
+        return counted
+
+    def catch_up(self, chunk=1000):
+        """Count the warbles posted, and take out those deleted, since the
+        last backfill or catch_up (in app context). Returns how many were
+        counted."""
+
+        counted = 0
+        while True:
+            events = self._tail.read(chunk)
+            created = [event.target_id for event in events if event.kind == 'message.created']
+            if created:
+                for message_id, text, timestamp, user_id in self._visible(
+                        [Message.id.in_(created)], chunk, ids=created):
+                    counted += self.record(text, timestamp, message_id, user_id)
+            for event in events:
+                if event.kind == 'message.deleted':
+                    self.discard(event.target_id)
+                elif event.kind == 'user.deleted':
+                    self.discard_user(event.user_id)
+            if len(events) < chunk:
+                break
+        self._forget(datetime.utcnow())
+        return counted
+
+    def _forget(self, now):
+        """Stop keeping warbles older than every window."""
+
+        cutoff = epoch(now) - self.longest
+        with self._lock:
+            self._counted = {message_id: counted for message_id, counted in self._counted.items()
+                             if counted[1] > cutoff}
+
+
+def sync(app, trending, stop, interval):
+    """Backfill `trending`, then catch up every `interval` secs until
+    `stop` is set."""
+
+    backfilled = False
+    while not stop.is_set():
+        try:
+            with app.app_context():
+                if backfilled:
+                    trending.catch_up()
+                else:
+                    trending.backfill()
+                    backfilled = True
+        except Exception:
+            app.logger.exception("Trending sync failed; retrying")
+        stop.wait(interval)
+
+
+def start_sync(app, trending, interval):
+    """Run `sync` in a background thread; returns its stop Event."""
+
+    stop = Event()
+    Thread(target=sync, args=(app, trending, stop, interval), daemon=True).start()
+    return stop
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['backfill']:
+        sys.exit(__doc__)
+
+    from app import app
+
+    trending = Trending()
+    with app.app_context():
+        print(f"Counted {trending.backfill()} warbles.")
+    for name in trending.windows:
+        print(f"\nLast {name}:")
+        for term, count in trending.top(name):
+            print(f"  {count:>6}  {term}")
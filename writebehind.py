@@ -0,0 +1,396 @@
+"""Write-behind buffering of like and follow edges.
+
+With the buffer on, ``add_like``/``un_like``/``add_follow``/``stop_following``
+don't touch the database at all. Each edge change is appended (and fsync'd)
+to a local log, which is what makes it durable, and the request returns. A
+background worker wakes up every `interval` seconds (or once `batch_size`
+changes are waiting), coalesces the pending changes and writes them to the
+database in a few bulk statements.
+
+Coalescing keeps only the last change per edge, so a like/unlike/like
+flip-flop inside one batch turns into a single insert.
+
+Until an edge is flushed, `overlay()` tells readers about it; the routes
+use that so a user always sees their own likes and follows right away.
+With several workers, a user's next request may land on another one, so
+each buffer also keeps its pending edges in a `SharedOverlay`: a cache tier
+every worker reads (the outermost one, see cache.py), cleared as they're
+flushed.
+
+A like is stored with the time it was buffered, not the time it's flushed.
+With sharding on, likes are written to their message's shard instead of the
+``likes`` table (see sharding.py); those writes are idempotent, so a flush
+that fails after them just writes them again.
+
+Each process appends to its own log, WRITE_BEHIND_LOG with its pid
+appended (`EdgeBuffer.for_process`), since the log is rotated and removed
+while flushing. On start, a process adopts the logs left by processes that
+are no longer running. (So don't create the buffer before gunicorn forks,
+e.g. with --preload, or the workers share the master's pid.)
+
+A change the database refuses (a follow of an account purged meanwhile, say)
+would fail its whole batch on every retry. When a batch fails, its changes
+are written one by one instead. Those that violate a constraint are moved
+to ``<log>.rejected`` and dropped.
+"""
+
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Condition, Thread
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.exc import IntegrityError
+
+from models import db, insert_ignore, Likes, Follows, Message
+import outbox
+from sharding import current_router
+
+# kind -> (table, column holding the actor, column holding the target)
+EDGE_TABLES = {
+    'like': (Likes.__table__, 'user_id', 'message_id'),
+    'follow': (Follows.__table__, 'user_following_id', 'user_being_followed_id'),
+}
+
+# How long an edge stays in the shared overlay if no flush clears it (its
+# process died, say); by then another process has adopted and flushed it.
+SHARED_TTL = 3600
+LOCK_TIMEOUT = 5.0
+POLL_INTERVAL = 0.01
+
+
+def write_edges(changes, at=None):
+    """Apply {(kind, user_id, target_id): 'add'|'remove'} in bulk.
+
+    Issues at most one INSERT and one DELETE per kind of edge (likes go to
+    the shards instead when sharding is on), and records each change in
+    the outbox. Added edges with a timestamp column get their time from
+    {(kind, user_id, target_id): datetime} `at`, or now. Likes of messages
+    that are gone are skipped. Caller commits.
+    """
+
+    at = at or {}
+    now = datetime.utcnow()
+    router = current_router()
+    dropped = set()
+    for kind, (table, actor, target) in EDGE_TABLES.items():
+        adds = [{actor: user_id, target: target_id}
+                for (k, user_id, target_id), op in changes.items()
+                if k == kind and op == 'add']
+        removes = [(user_id, target_id)
+                   for (k, user_id, target_id), op in changes.items()
+                   if k == kind and op == 'remove']
+        authors = {}
+        liked = {row[target] for row in adds} if kind == 'like' else set()
+        if liked or (kind == 'like' and router and removes):
+            # Likes have no foreign key to messages (see archive.py), so
+            # skip likes of messages purged since they were made. A like
+            # removed from a shard needs its message's author too.
+            if router:
+                liked |= {message_id for _, message_id in removes}
+                authors = {message_id: row.user_id for message_id, row
+                           in router.messages(liked, deleted=True).items()}
+            else:
+                authors = dict(db.session.execute(
+                    select(Message.id, Message.user_id).where(Message.id.in_(liked))).all())
+            dropped.update(('like', row[actor], row[target])
+                           for row in adds if row[target] not in authors)
+            adds = [row for row in adds if row[target] in authors]
+        if 'timestamp' in table.c:
+            adds = [{**row, 'timestamp': at.get((kind, row[actor], row[target]), now)}
+                    for row in adds]
+
+        if kind == 'like' and router:
+            # The like of an archived message has no author to find; it's
+            # looked for on every shard.
+            router.save_likes(
+                [(row[actor], authors[row[target]], row[target], row['timestamp'])
+                 for row in adds],
+                [(user_id, authors.get(message_id), message_id)
+                 for user_id, message_id in removes])
+            continue
+        if adds:
+            db.session.execute(insert_ignore(table), adds)
+        if removes:
+            db.session.execute(db.delete(table).where(
+                tuple_(table.c[actor], table.c[target]).in_(removes)))
+
+    outbox.record_many((f"{kind}.{'added' if op == 'add' else 'removed'}", user_id, target_id)
+                       for (kind, user_id, target_id), op in changes.items()
+                       if (kind, user_id, target_id) not in dropped)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedOverlay:
+    """The pending edges of every worker, in a cache `tier` they all read.
+
+    Entries are {target_id: (op, time buffered)} per (kind, user), updated
+    read-modify-write under a lock in the tier itself.
+    """
+
+    def __init__(self, tier, ttl=SHARED_TTL, lock_timeout=LOCK_TIMEOUT):
+        self.tier = tier
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+
+    @staticmethod
+    def _key(kind, user_id):
+        return f"edges:{kind}:{user_id}"
+
+    @contextmanager
+    def _locked(self, key):
+        # A lock left by a dead worker expires after lock_timeout.
+        while not self.tier.add(key + ':lock', True, self.lock_timeout):
+            time.sleep(POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            self.tier.delete(key + ':lock')
+
+    def _update(self, changes, apply):
+        by_user = {}
+        for (kind, user_id, target_id), entry in changes.items():
+            by_user.setdefault((kind, user_id), {})[target_id] = entry
+        for (kind, user_id), entries in by_user.items():
+            key = self._key(kind, user_id)
+            with self._locked(key):
+                current = self.tier.get_many([key]).get(key, {})
+                apply(current, entries)
+                if current:
+                    self.tier.set(key, current, self.ttl)
+                else:
+                    self.tier.delete(key)
+
+    def add(self, changes):
+        """Add {(kind, user_id, target_id): (op, at)} `changes`."""
+
+        self._update(changes, lambda current, entries: current.update(entries))
+
+    def remove(self, changes):
+        """Drop `changes` once they're written, unless changed since."""
+
+        def drop(current, entries):
+            for target_id, entry in entries.items():
+                if current.get(target_id) == entry:
+                    del current[target_id]
+
+        self._update(changes, drop)
+
+    def get(self, kind, user_id):
+        """{target_id: (op, at)} pending for `user_id`."""
+
+        key = self._key(kind, user_id)
+        return self.tier.get_many([key]).get(key, {})
+
+
+class EdgeBuffer:
+    """Durable, coalescing write-behind buffer for like/follow edges."""
+
+    def __init__(self, app, log_path, batch_size=500, interval=0.5, shared=None):
+        self.app = app
+        self.log_path = log_path
+        self.batch_size = batch_size
+        self.interval = interval
+        # A SharedOverlay, for readers in other processes.
+        self.shared = shared
+
+        self._cond = Condition()
+        # (kind, user_id, target_id) -> (op, time.time() when buffered)
+        self._pending = {}
+        self._flushing = {}
+        self._stopped = False
+
+        # Anything still on disk from before a crash or restart is pending.
+        for path in (self._flushing_path, self.log_path):
+            for key, entry in self._read_log(path):
+                self._pending[key] = entry
+        self._log = open(self.log_path, 'a')
+        self._worker = None
+
+    @classmethod
+    def for_process(cls, app, base_path, **kwargs):
+        """A buffer logging to `base_path`.<pid>, having adopted the logs
+        of dead processes."""
+
+        buffer = cls(app, f"{base_path}.{os.getpid()}", **kwargs)
+        buffer.adopt_orphans(base_path)
+        return buffer
+
+    def adopt_orphans(self, base_path):
+        """Take over the pending changes in the logs of processes that
+        aren't running any more. Returns how many changes were adopted."""
+
+        directory = os.path.dirname(base_path) or '.'
+        pattern = re.compile(re.escape(os.path.basename(base_path)) + r'\.(\d+)$')
+        adopted = 0
+        for name in sorted(os.listdir(directory)):
+            match = pattern.match(name)
+            if not match or int(match.group(1)) == os.getpid() or _alive(int(match.group(1))):
+                continue
+            log_path = os.path.join(directory, name)
+            for path in (log_path + '.flushing', log_path):
+                for (kind, user_id, target_id), (op, at) in self._read_log(path):
+                    self.submit(kind, op, user_id, target_id, at)
+                    adopted += 1
+            for path in (log_path + '.flushing', log_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        return adopted
+
+    @property
+    def _flushing_path(self):
+        return self.log_path + '.flushing'
+
+    @property
+    def _rejected_path(self):
+        return self.log_path + '.rejected'
+
+    @staticmethod
+    def _read_log(path):
+        """Yield ((kind, user_id, target_id), (op, at)) entries from a log
+        file."""
+
+        if not os.path.exists(path):
+            return
+        with open(path) as log:
+            for line in log:
+                try:
+                    kind, op, user_id, target_id, *at = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-write; it was never
+                    # acknowledged, so dropping it is correct.
+                    continue
+                # Logs written before entries were timed have no time.
+                yield (kind, user_id, target_id), (op, at[0] if at else None)
+
+    def submit(self, kind, op, user_id, target_id, at=None):
+        """Durably record an edge change. Returns once it is on disk."""
+
+        at = at or time.time()
+        line = json.dumps([kind, op, user_id, target_id, at], separators=(',', ':'))
+        with self._cond:
+            self._log.write(line + '\n')
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._pending[(kind, user_id, target_id)] = (op, at)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+        if self.shared:
+            self.shared.add({(kind, user_id, target_id): (op, at)})
+
+    def overlay(self, kind, user_id):
+        """{target_id: op} for `user_id`'s edges that haven't been flushed
+        yet, by this process or (with `shared`) any other."""
+
+        with self._cond:
+            changes = {**self._flushing, **self._pending}
+        found = {target_id: entry
+                 for (k, uid, target_id), entry in changes.items()
+                 if k == kind and uid == user_id}
+        if self.shared:
+            for target_id, entry in self.shared.get(kind, user_id).items():
+                if target_id not in found or (entry[1] or 0) > (found[target_id][1] or 0):
+                    found[target_id] = entry
+        return {target_id: op for target_id, (op, _) in found.items()}
+
+    def flush(self):
+        """Write every pending change to the database in one transaction."""
+
+        with self._cond:
+            if not self._pending and not os.path.exists(self._flushing_path):
+                return 0
+            # Rotate the log: entries submitted from now on go to a fresh
+            # file, so the rotated one can be dropped once it's committed.
+            if not os.path.exists(self._flushing_path):
+                self._log.close()
+                os.replace(self.log_path, self._flushing_path)
+                self._log = open(self.log_path, 'a')
+            self._flushing = dict(self._read_log(self._flushing_path))
+            self._pending = dict(
+                (key, entry) for key, entry in self._pending.items()
+                if self._flushing.get(key) != entry)
+            flushing = self._flushing
+
+        changes = {key: op for key, (op, _) in flushing.items()}
+        at = {key: datetime.utcfromtimestamp(when)
+              for key, (_, when) in flushing.items() if when}
+        with self.app.app_context():
+            try:
+                write_edges(changes, at)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                changes = self._write_each(changes, at)
+
+        with self._cond:
+            os.remove(self._flushing_path)
+            self._flushing = {}
+        if self.shared:
+            self.shared.remove(flushing)
+        return len(changes)
+
+    def _write_each(self, changes, at):
+        """Write `changes` one at a time, setting aside those that violate
+        a constraint. Returns the ones written."""
+
+        written = {}
+        rejected = []
+        for key, op in changes.items():
+            try:
+                with db.session.begin_nested():
+                    write_edges({key: op}, at)
+                written[key] = op
+            except IntegrityError:
+                rejected.append((key, op))
+        db.session.commit()
+
+        if rejected:
+            with open(self._rejected_path, 'a') as log:
+                for (kind, user_id, target_id), op in rejected:
+                    log.write(json.dumps([kind, op, user_id, target_id],
+                                         separators=(',', ':')) + '\n')
+            self.app.logger.warning("Dropped %d edge changes the database refused; see %s",
+                                    len(rejected), self._rejected_path)
+        return written
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                self._cond.wait(self.interval)
+            try:
+                self.flush()
+            except Exception as exc:
+                # Leave everything in the log; the next round retries it.
+                self.app.logger.exception("Edge flush failed: %s", exc)
+
+    def start(self):
+        """Start the background flush worker."""
+
+        self._worker = Thread(target=self._run, daemon=True)
+        self._worker.start()
+        return self
+
+    def stop(self):
+        """Stop the worker and flush whatever is left."""
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._worker:
+            self._worker.join()
+        self.flush()
+        self._log.close()